@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class LibrarysystemConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'librarySystem'
+
+    def ready(self):
+        from . import signals  # noqa: F401  connect model signal handlers
@@ -0,0 +1,71 @@
+"""
+JWT authentication backed by a cached user snapshot.
+
+simplejwt's JWTAuthentication loads the user row on every request. Here the
+fields views actually read (identity, permissions, quota and location
+settings) are cached per token subject for AUTH_USER_CACHE_TIMEOUT seconds,
+and the user is rebuilt from them with no query. The snapshot is dropped
+whenever the user is saved or deleted (see signals.py).
+
+Counters maintained with set-based UPDATEs that never fire post_save
+(`active_borrows`, `penalty_total`) are left out of the snapshot: they stay
+deferred on the rebuilt user and are read fresh from the database if used.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .models import User
+
+
+SNAPSHOT_FIELDS = (
+    'id', 'username', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser',
+    'max_borrows', 'restricted', 'location_lat', 'location_long', 'penalty_amount', 'borrow_max_days',
+)
+
+
+def user_cache_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def forget_user(user_id):
+    cache.delete(user_cache_key(user_id))
+
+
+def _snapshot(user):
+    snapshot = {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+    if api_settings.CHECK_REVOKE_TOKEN:
+        snapshot['password_hash'] = get_md5_hash_password(user.password)
+    return snapshot
+
+
+def _from_snapshot(snapshot):
+    # from_db takes the values in model field order; fields left out stay deferred
+    fields = [f.attname for f in User._meta.concrete_fields if f.attname in SNAPSHOT_FIELDS]
+    return User.from_db(DEFAULT_DB_ALIAS, fields, [snapshot[field] for field in fields])
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        key = user_cache_key(user_id)
+        snapshot = cache.get(key)
+        if snapshot is None:
+            # the regular lookup and checks, then remember the result
+            user = super().get_user(validated_token)
+            cache.set(key, _snapshot(user), getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 60))
+            return user
+
+        if not snapshot['is_active']:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != snapshot['password_hash']:
+            raise AuthenticationFailed("The user's password has been changed.", code="password_changed")
+        return _from_snapshot(snapshot)
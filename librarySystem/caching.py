@@ -0,0 +1,133 @@
+"""
+Versioned read-through caching for catalog data.
+
+Every catalog model has a version counter in the shared cache, bumped after
+each committed write (see signals.py). Cache keys embed the versions of the
+models a response was built from, so a write makes the old entries
+unreachable instead of deleting them, and stale data is never served.
+The same keys double as HTTP ETags. No Last-Modified date is kept: HTTP dates
+have one-second resolution, and a write within the second of a cached
+response would go unnoticed by If-Modified-Since.
+"""
+import asyncio
+import hashlib
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Author, Book, BookStock, Library, LibraryBranch
+
+
+CATALOG_MODELS = (Author, Book, BookStock, Library, LibraryBranch)
+
+LOCK_TIMEOUT = 30  # seconds a computation may hold a key before others give up waiting
+LOCK_POLL_INTERVAL = 0.05
+
+
+def version_key(model):
+    return f'catalog:version:{model._meta.model_name}'
+
+
+def _init_version(key):
+    # start from a random base so a lost counter never matches an old version
+    cache.add(key, random.randrange(1 << 30), timeout=None)
+    return cache.get(key)
+
+
+def get_versions(models):
+    """Return {model: version} for `models`, with one cache round trip when warm."""
+    keys = {version_key(model): model for model in models}
+    found = cache.get_many(list(keys))
+    return {
+        model: found[key] if key in found else _init_version(key)
+        for key, model in keys.items()
+    }
+
+
+def get_version(model):
+    return get_versions([model])[model]
+
+
+def bump_version(model):
+    """Invalidate everything cached from `model` and return its new version."""
+    key = version_key(model)
+    _init_version(key)
+    try:
+        return cache.incr(key)
+    except ValueError:  # evicted between add and incr
+        return _init_version(key)
+
+
+def make_key(prefix, parts, models):
+    """Cache key for `parts` (any reprs) computed from the current data of `models`."""
+    versions = get_versions(models)
+    raw = repr((parts, sorted((model._meta.model_name, version) for model, version in versions.items())))
+    return f'{prefix}:{hashlib.sha1(raw.encode()).hexdigest()}'
+
+
+def get_or_compute(key, compute, timeout=None):
+    """
+    Return the cached value for `key`, computing and storing it on a miss.
+
+    Concurrent misses on the same key are coalesced: the first caller takes a
+    lock with cache.add (atomic on LocMem and Redis) and computes, the others
+    wait for its result. `compute` may return None for values not worth caching.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            value = compute()
+            if value is not None:
+                cache.set(key, value, timeout)
+            return value
+        finally:
+            cache.delete(lock_key)
+
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if cache.get(lock_key) is None:
+            break  # the holder finished without caching anything
+    return compute()
+
+
+async def aget_or_compute(key, compute, timeout=None):
+    """get_or_compute for async views: `compute` is a coroutine function and waiting does not block the event loop."""
+    if timeout is None:
+        timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+
+    value = await cache.aget(key)
+    if value is not None:
+        return value
+
+    lock_key = f'{key}:lock'
+    if await cache.aadd(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            value = await compute()
+            if value is not None:
+                await cache.aset(key, value, timeout)
+            return value
+        finally:
+            await cache.adelete(lock_key)
+
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+        value = await cache.aget(key)
+        if value is not None:
+            return value
+        if await cache.aget(lock_key) is None:
+            break
+    return await compute()
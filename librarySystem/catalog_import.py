@@ -0,0 +1,206 @@
+"""
+Bulk catalog import from vendor feeds.
+
+Each input record describes one book and, optionally, its stock at one branch:
+
+    isbn, name, category, authors, library, branch_address, lat, long, count
+
+In CSV, `authors` is a `|` separated list; in JSONL it may also be a JSON list.
+Records are read lazily and written in batches, each batch in its own
+transaction with a handful of set-based statements (upserts keyed on
+Author.name, Book.ISBN and (book, branch)), so memory stays bounded by the
+batch size whatever the size of the feed. A record's `count` is the copies the
+branch owns; the stored stock is that less the copies out on open borrows.
+
+Bulk writes bypass model signals, so every batch refreshes the search index of
+its books itself and bumps the catalog versions once it commits.
+"""
+import csv
+import json
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import Count
+
+from . import search
+from .caching import bump_version
+from .models import Author, Book, BookStock, Borrow, Library, LibraryBranch
+
+
+FIELDS = ('isbn', 'name', 'category', 'authors', 'library', 'branch_address', 'lat', 'long', 'count')
+AUTHOR_SEPARATOR = '|'
+BATCH_SIZE = 1000
+ID_CHUNK_SIZE = 500  # ids per IN list, well under every database's parameter limit
+
+
+class CatalogImportError(ValueError):
+    pass
+
+
+def read_csv(stream):
+    for row in csv.DictReader(stream):
+        yield row
+
+
+def read_jsonl(stream):
+    for number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as exc:
+                raise CatalogImportError(f"line {number}: invalid JSON ({exc})")
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+
+
+def _text(record, field):
+    value = record.get(field)
+    return '' if value is None else str(value).strip()
+
+
+def _authors(record):
+    value = record.get('authors') or []
+    if isinstance(value, str):
+        value = value.split(AUTHOR_SEPARATOR)
+    names = []
+    for name in value:
+        name = str(name).strip()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def parse_record(record, number):
+    """Validate one raw record into a dict with typed values."""
+    row = {field: _text(record, field) for field in ('isbn', 'name', 'category', 'library', 'branch_address')}
+    for field in ('isbn', 'name', 'category'):
+        if not row[field]:
+            raise CatalogImportError(f"record {number}: '{field}' is required")
+    row['authors'] = _authors(record)
+
+    if bool(row['library']) != bool(row['branch_address']):
+        raise CatalogImportError(f"record {number}: 'library' and 'branch_address' go together")
+    try:
+        row['lat'] = float(_text(record, 'lat')) if _text(record, 'lat') else None
+        row['long'] = float(_text(record, 'long')) if _text(record, 'long') else None
+        row['count'] = int(_text(record, 'count') or 0)
+    except ValueError:
+        raise CatalogImportError(f"record {number}: 'lat', 'long' and 'count' must be numbers")
+    if row['count'] < 0:
+        raise CatalogImportError(f"record {number}: 'count' must not be negative")
+    return row
+
+
+class CatalogImporter:
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self._branches = None  # (library name, address) -> branch id; branches are few
+
+    def run(self, records, progress=None):
+        """Import `records` (dicts) batch by batch; call `progress(totals)` after each commit."""
+        totals = {'records': 0, 'books': 0, 'authors': 0, 'stock': 0, 'branches': 0}
+        numbered = enumerate(records, 1)
+        while True:
+            batch = [parse_record(record, number) for number, record in islice(numbered, self.batch_size)]
+            if not batch:
+                return totals
+            for key, value in self.import_batch(batch).items():
+                totals[key] += value
+            totals['records'] += len(batch)
+            if progress:
+                progress(totals)
+
+    def import_batch(self, rows):
+        try:
+            with transaction.atomic():
+                counts = self._write(rows)
+                transaction.on_commit(lambda: [bump_version(model) for model in (Author, Book, BookStock)])
+        except Exception:
+            self._branches = None  # may hold branches created by the rolled back batch
+            raise
+        return counts
+
+    def _write(self, rows):
+        # last record wins for repeated books and stock lines within a batch
+        books = {row['isbn']: row for row in rows}
+
+        author_names = {name for row in books.values() for name in row['authors']}
+        Author.objects.bulk_create(
+            [Author(name=name) for name in author_names],
+            update_conflicts=True, unique_fields=['name'], update_fields=['name'],
+        )
+        author_ids = dict(Author.objects.filter(name__in=author_names).values_list('name', 'id'))
+
+        Book.objects.bulk_create(
+            [Book(ISBN=isbn, name=row['name'], category=row['category']) for isbn, row in books.items()],
+            update_conflicts=True, unique_fields=['ISBN'], update_fields=['name', 'category'],
+        )
+        book_ids = dict(Book.objects.filter(ISBN__in=books).values_list('ISBN', 'id'))
+
+        # a record with authors replaces the book's author list; one without leaves it alone
+        Through = Book.authors.through
+        credited = {book_ids[isbn]: row['authors'] for isbn, row in books.items() if row['authors']}
+        Through.objects.filter(book_id__in=credited).delete()
+        Through.objects.bulk_create(
+            [Through(book_id=book_id, author_id=author_ids[name]) for book_id, names in credited.items() for name in names],
+            ignore_conflicts=True,
+        )
+
+        created_branches = 0
+        stock = {}
+        for row in rows:
+            if row['library']:
+                branch_id, created = self._branch(row)
+                created_branches += created
+                stock[book_ids[row['isbn']], branch_id] = row['count']
+        # the feed counts the copies a branch owns, BookStock the copies on its shelf: leave
+        # out those on open borrows. The stock rows are locked first, so no borrow or return
+        # of them can commit between the count and the upsert. Rows are selected by book
+        # and branch ids, in chunks, and matched to the pairs here (an OR of one term per
+        # pair overflows SQLite's expression depth at about 1000 terms), so a few rows of
+        # other pairs may be locked too.
+        branch_ids = {branch_id for _, branch_id in stock}
+        stocked_books = sorted({book_id for book_id, _ in stock})
+        for start in range(0, len(stocked_books), ID_CHUNK_SIZE):
+            chunk = stocked_books[start:start + ID_CHUNK_SIZE]
+            list(
+                BookStock.objects.select_for_update()
+                .filter(book_id__in=chunk, library_branch_id__in=branch_ids).order_by('id').values_list('id')
+            )
+            lent = (
+                Borrow.objects.filter(book_id__in=chunk, library_branch_id__in=branch_ids, return_date__isnull=True)
+                .values('book_id', 'library_branch_id').annotate(n=Count('id'))
+            )
+            for row in lent:
+                key = row['book_id'], row['library_branch_id']
+                if key in stock:
+                    stock[key] = max(stock[key] - row['n'], 0)
+        BookStock.objects.bulk_create(
+            [BookStock(book_id=book_id, library_branch_id=branch_id, count=count) for (book_id, branch_id), count in stock.items()],
+            update_conflicts=True, unique_fields=['book', 'library_branch'], update_fields=['count'],
+        )
+
+        search.index_books(book_ids.values())
+        return {'books': len(books), 'authors': len(author_names), 'stock': len(stock), 'branches': created_branches}
+
+    def _branch(self, row):
+        """Return (branch id, created) for the record's branch, creating it (and its library) if needed."""
+        if self._branches is None:
+            self._branches = {
+                (library, address): branch_id
+                for branch_id, library, address in LibraryBranch.objects.values_list('id', 'library__name', 'address')
+            }
+        key = (row['library'], row['branch_address'])
+        if key in self._branches:
+            return self._branches[key], False
+        if row['lat'] is None or row['long'] is None:
+            raise CatalogImportError(f"new branch {key[1]!r} of {key[0]!r} needs 'lat' and 'long'")
+
+        # saved one by one so the usual signals keep the branch index and caches current
+        library, _ = Library.objects.get_or_create(name=row['library'])
+        branch = LibraryBranch.objects.create(
+            library=library, address=row['branch_address'], location_lat=row['lat'], location_long=row['long']
+        )
+        self._branches[key] = branch.id
+        return branch.id, True
@@ -0,0 +1,213 @@
+"""
+Spatial lookups over library branch locations.
+
+Branch coordinates are projected onto the unit sphere and bucketed in a uniform
+3D grid. The straight-line (chord) distance from a point to a grid cell's box is
+a lower bound for the great-circle distance to every branch inside it, so cells
+can be visited nearest-first and the search stops as soon as no unvisited cell
+can beat the answers found so far.
+"""
+import heapq
+import math
+import threading
+from collections import Counter
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_unit_vector(lat, long):
+    phi = math.radians(lat)
+    lam = math.radians(long)
+    cos_phi = math.cos(phi)
+    return (cos_phi * math.cos(lam), cos_phi * math.sin(lam), math.sin(phi))
+
+
+def chord_to_km(chord):
+    # chord length on the unit sphere -> great-circle distance on earth
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def haversine_km(lat1, long1, lat2, long2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lam = math.radians(long2 - long1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lam / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, long, radius_km):
+    """
+    Return (min_lat, max_lat, long_ranges) enclosing the circle of `radius_km`
+    around (lat, long). Longitude is split in two ranges across the antimeridian.
+    """
+    angle = radius_km / EARTH_RADIUS_KM
+    d_lat = math.degrees(angle)
+    min_lat, max_lat = lat - d_lat, lat + d_lat
+    if min_lat <= -90 or max_lat >= 90 or angle >= math.pi / 2:
+        # the circle reaches a pole: every longitude is in range
+        return max(min_lat, -90.0), min(max_lat, 90.0), [(-180.0, 180.0)]
+
+    ratio = math.sin(angle) / math.cos(math.radians(lat))
+    if ratio >= 1:
+        return min_lat, max_lat, [(-180.0, 180.0)]
+    d_long = math.degrees(math.asin(ratio))
+    min_long, max_long = long - d_long, long + d_long
+    if min_long < -180:
+        return min_lat, max_lat, [(min_long + 360, 180.0), (-180.0, max_long)]
+    if max_long > 180:
+        return min_lat, max_lat, [(min_long, 180.0), (-180.0, max_long - 360)]
+    return min_lat, max_lat, [(min_long, max_long)]
+
+
+class BranchIndex:
+    """
+    In-memory grid index of (branch, library, position) entries.
+
+    `cell_size` is the grid edge on the unit sphere (0.1 is roughly 640km).
+    """
+
+    def __init__(self, cell_size=0.1):
+        self.cell_size = cell_size
+        self.version = None
+        self.loaded = False
+        self._cells = {}        # cell -> list of (branch_id, library_id, x, y, z)
+        self._branch_cells = {} # branch_id -> cell
+        self._libraries = Counter()  # library_id -> number of indexed branches
+        self._lock = threading.RLock()
+
+    def _cell_for(self, point):
+        size = self.cell_size
+        return (math.floor(point[0] / size), math.floor(point[1] / size), math.floor(point[2] / size))
+
+    def _cell_bound(self, cell, point):
+        # squared distance from `point` to the axis-aligned box of `cell`
+        size = self.cell_size
+        total = 0.0
+        for index, coord in zip(cell, point):
+            low = index * size
+            high = low + size
+            if coord < low:
+                total += (low - coord) ** 2
+            elif coord > high:
+                total += (coord - high) ** 2
+        return total
+
+    def load(self, rows):
+        """Replace the index contents with `rows` of (branch_id, library_id, lat, long)."""
+        with self._lock:
+            self._cells = {}
+            self._branch_cells = {}
+            self._libraries = Counter()
+            for branch_id, library_id, lat, long in rows:
+                self._insert(branch_id, library_id, lat, long)
+            self.loaded = True
+
+    def add(self, branch_id, library_id, lat, long):
+        with self._lock:
+            self._remove(branch_id)
+            self._insert(branch_id, library_id, lat, long)
+
+    def remove(self, branch_id):
+        with self._lock:
+            self._remove(branch_id)
+
+    def _insert(self, branch_id, library_id, lat, long):
+        point = to_unit_vector(lat, long)
+        cell = self._cell_for(point)
+        self._cells.setdefault(cell, []).append((branch_id, library_id) + point)
+        self._branch_cells[branch_id] = cell
+        self._libraries[library_id] += 1
+
+    def _remove(self, branch_id):
+        cell = self._branch_cells.pop(branch_id, None)
+        if cell is None:
+            return
+        entries = []
+        for entry in self._cells[cell]:
+            if entry[0] == branch_id:
+                self._libraries[entry[1]] -= 1
+                if not self._libraries[entry[1]]:
+                    del self._libraries[entry[1]]
+            else:
+                entries.append(entry)
+        if entries:
+            self._cells[cell] = entries
+        else:
+            del self._cells[cell]
+
+    def nearest_by_library(self, lat, long, library_ids=None):
+        """
+        Return {library_id: km} with the distance from (lat, long) to each
+        library's closest branch. Restrict to `library_ids` when given.
+        """
+        qx, qy, qz = point = to_unit_vector(lat, long)
+        targets = set(library_ids) if library_ids is not None else None
+        best = {}  # library_id -> squared chord
+
+        with self._lock:
+            heap = [(self._cell_bound(cell, point), cell) for cell in self._cells]
+            heapq.heapify(heap)
+            if targets is None:
+                total = len(self._libraries)
+            else:
+                total = len(targets.intersection(self._libraries))
+            if not total:
+                return {}
+            worst = None
+
+            while heap:
+                bound, cell = heapq.heappop(heap)
+                if worst is not None and bound >= worst:
+                    # every target has a candidate; stop once nothing left can improve one
+                    worst = max(best.values())
+                    if bound >= worst:
+                        break
+
+                for _, library_id, x, y, z in self._cells[cell]:
+                    if targets is not None and library_id not in targets:
+                        continue
+                    dist = (x - qx) ** 2 + (y - qy) ** 2 + (z - qz) ** 2
+                    if dist < best.get(library_id, math.inf):
+                        best[library_id] = dist
+
+                if worst is None and len(best) == total:
+                    worst = max(best.values())
+
+        return {library_id: chord_to_km(math.sqrt(dist)) for library_id, dist in best.items()}
+
+
+branch_index = BranchIndex()
+
+
+def get_branch_index():
+    """Return the process-wide branch index, (re)loading it if it is stale."""
+    from .caching import get_version
+    from .models import LibraryBranch
+
+    # the LibraryBranch catalog version changes whenever any process edits a branch
+    version = get_version(LibraryBranch)
+    if not branch_index.loaded or version != branch_index.version:
+        rows = LibraryBranch.objects.values_list('id', 'library_id', 'location_lat', 'location_long')
+        branch_index.load(rows.iterator(chunk_size=5000))
+        branch_index.version = version
+    return branch_index
+
+
+# Both hooks run after the transaction commits, with the LibraryBranch version
+# it bumped, so rolled back saves leave no trace in the index.
+def branch_saved(branch_id, library_id, lat, long, version):
+    previous = branch_index.version
+    if branch_index.loaded:
+        branch_index.add(branch_id, library_id, lat, long)
+        # only adopt the new version if no other process changed branches in between
+        if previous is not None and version == previous + 1:
+            branch_index.version = version
+
+
+def branch_deleted(branch_id, version):
+    previous = branch_index.version
+    if branch_index.loaded:
+        branch_index.remove(branch_id)
+        if previous is not None and version == previous + 1:
+            branch_index.version = version
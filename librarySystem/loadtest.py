@@ -0,0 +1,476 @@
+"""
+In-process load tests.
+
+A `Workload` turns a seeded random stream into requests for every route of
+librarySystem/urls.py, mixed by the MIX weights: mostly catalog reads, then
+borrows and returns (a return gives back books an earlier borrow took, so
+stock and quotas stay level over a run), some logins and registrations, the
+admin reports and exports, and the password reset pages. Catalog reads pick
+books from a Zipf distributed hot set, as real traffic does.
+
+`run_load` replays a workload against Django's WSGI application from a thread
+pool, or its ASGI application from asyncio tasks, with `concurrency` requests
+in flight. Requests are handed to the applications in this process: no server
+or network is involved, so the numbers measure the Django stack and the
+database, and compare well between commits run on one machine and dataset.
+
+`summarize` reduces the samples to a JSON serializable report: p50/p95/p99
+latency, throughput, queries per request (the X-Query-Count header) and
+status counts, overall and per route. `compare` diffs two reports.
+"""
+import asyncio
+import io
+import itertools
+import json
+import math
+import random
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Callable, NamedTuple, Optional
+from urllib.parse import urlencode
+
+from django.core.asgi import get_asgi_application
+from django.core.handlers.asgi import ASGIHandler
+from django.core.wsgi import get_wsgi_application
+from django.urls import reverse
+from django.utils.http import urlsafe_base64_encode
+from django.utils.timezone import now
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .export import EXPORTS
+from .models import Author, Book, BookStock, Borrow, CirculationStat, Library, LibraryBranch
+
+
+SAMPLE_SIZE = 2000  # books, authors and stock rows the workload draws from
+PERCENTILES = (50, 95, 99)
+
+# route name -> (relative weight, Workload method building its requests)
+MIX = {
+    'library-list': (6, 'list_libraries'),
+    'branch-nearby': (6, 'nearby'),
+    'author-list': (5, 'list_authors'),
+    'author-loaded-list': (2, 'list_loaded_authors'),
+    'book-list': (10, 'list_books'),
+    'book-search': (10, 'search'),
+    'book-related': (8, 'related'),
+    'penalties': (4, 'penalties'),
+    'borrow-book': (4, 'borrow_one'),
+    'return-book': (4, 'return_one'),
+    'borrow-batch': (1, 'borrow_batch'),
+    'return-batch': (1, 'return_batch'),
+    'async-library-list': (3, 'list_libraries'),
+    'async-branch-nearby': (3, 'nearby'),
+    'async-author-list': (2, 'list_authors'),
+    'async-author-loaded-list': (1, 'list_loaded_authors'),
+    'async-book-list': (5, 'list_books'),
+    'async-book-search': (5, 'search'),
+    'async-book-related': (4, 'related'),
+    'async-penalties': (2, 'penalties'),
+    'async-borrow-book': (2, 'borrow_one'),
+    'async-return-book': (2, 'return_one'),
+    'penalty-report': (0.5, 'penalty_report'),
+    'circulation-stats': (0.5, 'circulation_stats'),
+    'export': (0.2, 'export'),
+    'register': (0.3, 'register'),
+    'login': (0.5, 'login'),
+    'password_reset': (0.2, 'page'),
+    'password_reset_done': (0.1, 'page'),
+    'password_reset_confirm': (0.1, 'reset_confirm'),
+    'password_reset_complete': (0.1, 'page'),
+}
+
+
+class Request(NamedTuple):
+    route: str
+    method: str
+    path: str
+    query: str = ''
+    data: Any = None  # sent as a JSON body
+    user: Optional['LoadUser'] = None  # None for anonymous requests
+    done: Optional[Callable] = None  # called with (status, body) once answered
+
+
+class LoadUser:
+    def __init__(self, user):
+        self.user = user
+        self.authorization = None
+        self.renew_at = 0
+
+    def header(self):
+        if time.monotonic() >= self.renew_at:
+            # renewed halfway through its lifetime so no request carries an expired token
+            token = AccessToken.for_user(self.user)
+            self.authorization = f'Bearer {token}'
+            self.renew_at = time.monotonic() + token.lifetime.total_seconds() / 2
+        return self.authorization
+
+
+class Workload:
+    def __init__(self, users, admin, password, seed=0, sample_size=SAMPLE_SIZE, routes=None):
+        self.users = [LoadUser(user) for user in users]
+        self.admin = LoadUser(admin) if admin else None
+        self.password = password
+        self.seed = seed
+        self.routes = [route for route in (routes or MIX)]
+        self.cum_weights = list(itertools.accumulate(MIX[route][0] for route in self.routes))
+        self.registered = itertools.count(1)
+        self._load_sample(random.Random(seed), sample_size)
+
+        # borrows a return may give back: (user index, book ids), seeded with what the users have out
+        index = {load_user.user.pk: number for number, load_user in enumerate(self.users)}
+        self.outstanding = deque(
+            (index[user_id], [book_id])
+            for user_id, book_id in Borrow.objects.filter(user_id__in=list(index), return_date__isnull=True)
+            .order_by('id').values_list('user_id', 'book_id')
+        )
+
+    def _load_sample(self, rng, size):
+        book_ids = list(Book.objects.values_list('id', flat=True).order_by('id'))
+        book_ids = rng.sample(book_ids, min(size, len(book_ids)))
+        books = Book.objects.in_bulk(book_ids)
+        self.books = [books[book_id] for book_id in book_ids]
+        # the hot set: the n-th sampled book is requested about 1/n as often as the first
+        self.book_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(self.books) + 1)))
+        self.words = sorted({word for book in self.books for word in book.name.split() if len(word) > 3})
+
+        author_names = list(Author.objects.values_list('name', flat=True).order_by('id'))
+        self.author_names = rng.sample(author_names, min(size, len(author_names)))
+        self.library_names = list(Library.objects.values_list('name', flat=True).order_by('id'))
+        self.branches = list(LibraryBranch.objects.values_list('location_lat', 'location_long').order_by('id'))
+        self.stock = [
+            pair for start in range(0, len(book_ids), 500)
+            for pair in BookStock.objects.filter(book_id__in=book_ids[start:start + 500], count__gt=0)
+            .order_by('id').values_list('book_id', 'library_branch_id')
+        ]
+        self.categories = list(Book.objects.values_list('category', flat=True).distinct().order_by('category')) or ['Fiction']
+
+    def next_request(self, rng):
+        route = rng.choices(self.routes, cum_weights=self.cum_weights)[0]
+        return getattr(self, MIX[route][1])(route, rng)
+
+    # helpers
+
+    def user(self, rng):
+        # the first users are the most active
+        return rng.randrange(len(self.users)) if rng.random() < 0.5 else rng.randrange(max(len(self.users) // 10, 1))
+
+    def book(self, rng):
+        return rng.choices(self.books, cum_weights=self.book_weights)[0]
+
+    def get(self, route, rng, params=None, args=(), user=True):
+        load_user = self.users[self.user(rng)] if user is True else user
+        return Request(route, 'GET', reverse(route, args=args), urlencode(params or {}), user=load_user)
+
+    def filters(self, rng, *names):
+        # half the catalog reads are unfiltered; the rest filter on one attribute
+        name = rng.choice(names + (None,) * len(names))
+        if name == 'category':
+            return {'category': rng.choice(self.categories)}
+        if name == 'author' and self.author_names:
+            return {'author': rng.choice(self.author_names)}
+        if name == 'library' and self.library_names:
+            return {'library': rng.choice(self.library_names)}
+        return {}
+
+    def due_date(self, rng):
+        return (now().date() + timedelta(days=rng.choice([7, 14, 21, 28]))).isoformat()
+
+    # scenarios, one per MIX entry
+
+    def list_libraries(self, route, rng):
+        return self.get(route, rng, self.filters(rng, 'category', 'author'))
+
+    def nearby(self, route, rng):
+        if not self.branches or rng.random() < 0.5:
+            return self.get(route, rng)  # around the user's own location
+        lat, long = rng.choice(self.branches)
+        return self.get(route, rng, {'lat': round(lat + rng.gauss(0, 0.05), 4), 'long': round(long + rng.gauss(0, 0.05), 4)})
+
+    def list_authors(self, route, rng):
+        return self.get(route, rng, self.filters(rng, 'category', 'library'))
+
+    def list_loaded_authors(self, route, rng):
+        return self.get(route, rng, self.filters(rng, 'category', 'library'))
+
+    def list_books(self, route, rng):
+        return self.get(route, rng, self.filters(rng, 'category', 'library', 'author'))
+
+    def search(self, route, rng):
+        if not self.words:
+            return self.get(route, rng, {'q': 'the'})
+        words = rng.sample(self.words, min(rng.choice([1, 1, 2]), len(self.words)))
+        # people type prefixes, in any case
+        return self.get(route, rng, {'q': ' '.join(word[:rng.randint(3, len(word))].lower() for word in words)})
+
+    def related(self, route, rng):
+        isbn = self.book(rng).ISBN if self.books else 'none'
+        return self.get(route, rng, args=[isbn])
+
+    def penalties(self, route, rng):
+        return self.get(route, rng)
+
+    def borrow_one(self, route, rng, count=1):
+        number = self.user(rng)
+        items = [
+            {'book': book, 'library_branch': branch, 'expected_return_date': self.due_date(rng)}
+            for book, branch in rng.sample(self.stock, min(count, len(self.stock)))
+        ] or [{'book': 0, 'library_branch': 0, 'expected_return_date': self.due_date(rng)}]
+
+        def done(status, body):
+            if status == 201:
+                if count == 1:
+                    self.outstanding.append((number, [items[0]['book']]))
+                else:
+                    borrowed = [result['book'] for result in json.loads(body)['results'] if result['status'] == 'borrowed']
+                    self.outstanding.append((number, borrowed))
+
+        data = items[0] if count == 1 else {'items': items}
+        return Request(route, 'POST', reverse(route), data=data, user=self.users[number], done=done)
+
+    def borrow_batch(self, route, rng):
+        return self.borrow_one(route, rng, count=rng.randint(2, 4))
+
+    def _take_outstanding(self, rng):
+        try:
+            return self.outstanding.popleft()
+        except IndexError:  # nothing out: a return the API refuses
+            return self.user(rng), [self.book(rng).id if self.books else 0]
+
+    def return_one(self, route, rng):
+        number, book_ids = self._take_outstanding(rng)
+        if len(book_ids) > 1:
+            self.outstanding.appendleft((number, book_ids[1:]))
+        return Request(route, 'POST', reverse(route), data={'book': book_ids[0]}, user=self.users[number])
+
+    def return_batch(self, route, rng):
+        number, book_ids = self._take_outstanding(rng)
+        return Request(route, 'POST', reverse(route), data={'books': book_ids}, user=self.users[number])
+
+    def penalty_report(self, route, rng):
+        return self.get(route, rng, user=self.admin)
+
+    def circulation_stats(self, route, rng):
+        params = {'from': (now().date() - timedelta(days=rng.choice([7, 30, 90]))).isoformat()}
+        return self.get(route, rng, params, args=[rng.choice(CirculationStat.DIMENSIONS)], user=self.admin)
+
+    def export(self, route, rng):
+        params = {'output': rng.choice(['ndjson', 'csv'])}
+        return self.get(route, rng, params, args=[rng.choice(sorted(EXPORTS))], user=self.admin)
+
+    def register(self, route, rng):
+        username = f'load-{self.seed}-{time.time_ns()}-{next(self.registered)}'
+        data = {'username': username, 'email': f'{username}@example.com', 'password': self.password,
+                'password_confirm': self.password}
+        return Request(route, 'POST', reverse(route), data=data)
+
+    def login(self, route, rng):
+        load_user = self.users[self.user(rng)]
+        return Request(route, 'POST', reverse(route), data={'username': load_user.user.username, 'password': self.password})
+
+    def page(self, route, rng):
+        return self.get(route, rng, user=None)
+
+    def reset_confirm(self, route, rng):
+        # a link with a stale token, which renders the "invalid link" page
+        uid = urlsafe_base64_encode(str(self.users[self.user(rng)].user.pk).encode())
+        return self.get(route, rng, args=[uid, 'set-password-0000'], user=None)
+
+
+def _body(request):
+    return b'' if request.data is None else json.dumps(request.data).encode()
+
+
+def _headers(request):
+    headers = {'Host': 'localhost'}
+    if request.user is not None:
+        headers['Authorization'] = request.user.header()
+    if request.data is not None:
+        headers['Content-Type'] = 'application/json'
+    return headers
+
+
+def wsgi_request(application, method, path, query='', body=b'', headers=None):
+    """Hand one request to a WSGI application; return (status, headers, body)."""
+    environ = {
+        'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'REMOTE_ADDR': '127.0.0.1',
+        'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'http',
+    }
+    for name, value in (headers or {}).items():
+        key = name.upper().replace('-', '_')
+        environ[key if key == 'CONTENT_TYPE' else f'HTTP_{key}'] = value
+    started = []
+
+    def start_response(status, response_headers, exc_info=None):
+        started.append((int(status.split()[0]), dict(response_headers)))
+
+    response = application(environ, start_response)
+    try:
+        content = b''.join(response)
+    finally:
+        response.close()
+    return started[0][0], started[0][1], content
+
+
+async def asgi_request(application, method, path, query='', body=b'', headers=None):
+    """Hand one request to an ASGI application; return (status, headers, body)."""
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+        'root_path': '', 'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+        'headers': [(b'content-length', str(len(body)).encode())] + [
+            (name.lower().encode(), value.encode()) for name, value in (headers or {}).items()
+        ],
+    }
+    requested = asyncio.Event()
+    sent = []
+
+    async def receive():
+        if requested.is_set():
+            await asyncio.Event().wait()  # the client never disconnects
+        requested.set()
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    await application(scope, receive, send)
+    headers = {key.decode(): value.decode() for key, value in sent[0]['headers']}
+    return sent[0]['status'], headers, b''.join(message.get('body', b'') for message in sent[1:])
+
+
+class Sample(NamedTuple):
+    route: str
+    status: int
+    seconds: float
+    queries: int
+
+
+def _sample(request, started, status, headers, content):
+    seconds = time.perf_counter() - started
+    if request.done:
+        request.done(status, content)
+    return Sample(request.route, status, seconds, int(headers.get('X-Query-Count', 0)))
+
+
+def get_application(interface):
+    return get_asgi_application() if interface == 'asgi' else get_wsgi_application()
+
+
+def run_load(workload, application, concurrency=8, requests=None, duration=None, seed=0):
+    """
+    Replay `workload` against a WSGI or ASGI `application` until `requests`
+    were sent or `duration` seconds passed; return (samples, elapsed seconds).
+    Each of the `concurrency` workers draws its own reproducible stream of
+    requests from `seed`.
+    """
+    numbers = itertools.count() if requests is None else iter(range(requests))
+    deadline = None if duration is None else time.perf_counter() + duration
+    samples = []
+
+    def budget():
+        # shared iterator: each request number is taken once
+        for _ in numbers:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            yield
+
+    started = time.perf_counter()
+    if not isinstance(application, ASGIHandler):
+        def worker(number):
+            rng = random.Random(f'{seed}-{number}')
+            for _ in budget():
+                request = workload.next_request(rng)
+                start = time.perf_counter()
+                response = wsgi_request(application, request.method, request.path, request.query, _body(request), _headers(request))
+                samples.append(_sample(request, start, *response))
+
+        with ThreadPoolExecutor(concurrency) as pool:
+            for future in [pool.submit(worker, number) for number in range(concurrency)]:
+                future.result()
+    else:
+        async def worker(number):
+            rng = random.Random(f'{seed}-{number}')
+            for _ in budget():
+                request = workload.next_request(rng)
+                start = time.perf_counter()
+                response = await asgi_request(application, request.method, request.path, request.query, _body(request), _headers(request))
+                samples.append(_sample(request, start, *response))
+
+        async def main():
+            await asyncio.gather(*(worker(number) for number in range(concurrency)))
+
+        asyncio.run(main())
+    return samples, time.perf_counter() - started
+
+
+def percentile(values, p):
+    """The nearest-rank p-th percentile of sorted `values`."""
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def _stats(samples, elapsed):
+    timings = sorted(sample.seconds * 1000 for sample in samples)
+    statuses = Counter(sample.status for sample in samples)
+    stats = {
+        'requests': len(samples),
+        'throughput': round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(statistics.mean(timings), 3),
+        **{f'p{p}_ms': round(percentile(timings, p), 3) for p in PERCENTILES},
+        'max_ms': round(timings[-1], 3),
+        'queries': round(statistics.mean(sample.queries for sample in samples), 3),
+        'max_queries': max(sample.queries for sample in samples),
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+        'errors': sum(count for code, count in statuses.items() if code >= 500),
+    }
+    return stats
+
+
+def summarize(samples, elapsed, config=None):
+    """The report of a run: overall and per route statistics of `samples`."""
+    by_route = defaultdict(list)
+    for sample in samples:
+        by_route[sample.route].append(sample)
+    return {
+        'config': config or {},
+        'elapsed_s': round(elapsed, 3),
+        'total': _stats(samples, elapsed) if samples else {'requests': 0},
+        'routes': {route: _stats(by_route[route], elapsed) for route in sorted(by_route)},
+    }
+
+
+def compare(report, baseline, threshold=0.1, min_requests=30):
+    """
+    Compare `report` with `baseline` route by route (and overall, as 'total').
+    Return rows of (route, metric, baseline, current, change, regressed); a
+    latency or throughput change is a regression past `threshold` (a fraction),
+    a query count one as soon as it rises by half a query or more. Routes with
+    fewer than `min_requests` requests in either run, and percentiles beyond
+    what their samples can tell, are too noisy to compare.
+    """
+    rows = []
+    current = {'total': report['total'], **report['routes']}
+    previous = {'total': baseline['total'], **baseline['routes']}
+    for route in [route for route in current if route in previous]:
+        now_, then = current[route], previous[route]
+        if min(now_.get('requests', 0), then.get('requests', 0)) < min_requests:
+            continue
+        requests = min(now_['requests'], then['requests'])
+        # a pXX needs 100 / (100 - XX) samples to be more than the maximum
+        metrics = [f'p{p}_ms' for p in PERCENTILES if requests * (100 - p) >= 100]
+        for metric in metrics + ['throughput', 'queries']:
+            change = (now_[metric] - then[metric]) / then[metric] if then[metric] else 0.0
+            if metric == 'queries':
+                regressed = now_[metric] - then[metric] >= 0.5
+            elif metric == 'throughput':
+                regressed = route == 'total' and change < -threshold  # per route, it follows the mix
+            else:
+                regressed = change > threshold
+            rows.append((route, metric, then[metric], now_[metric], change, regressed))
+    return rows
+
@@ -0,0 +1,127 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from librarySystem.loadtest import asgi_request, wsgi_request
+from librarySystem.models import Book, User
+
+
+# sync route -> query string; each is also served at async-<route>
+ROUTES = {
+    'library-list': {},
+    'branch-nearby': {'lat': 40.7, 'long': -74.0},
+    'author-list': {},
+    'author-loaded-list': {},
+    'book-list': {},
+    'book-search': {'q': 'the'},
+    'book-related': {},
+    'penalties': {},
+}
+MODES = ('wsgi', 'asgi-sync', 'asgi-async')
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the read endpoints served three ways: the sync views through "
+        "Django's WSGI application from a thread pool, the same views through its "
+        "ASGI application, and their /api/async/ twins through the ASGI application, "
+        "with --concurrency requests in flight. Requests are handed to the "
+        "applications in this process, so this measures the Django stack without "
+        "a server or network; see the README for a uvicorn run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Requests per route and mode.")
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--routes', nargs='+', choices=sorted(ROUTES), default=list(ROUTES))
+        parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+        parser.add_argument('--username', help="User to authenticate as; defaults to the first active user.")
+        parser.add_argument('--cold', action='store_true', help="Give every request a unique query string so it misses the catalog cache.")
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--requests and --concurrency must be positive.")
+        users = User.objects.filter(is_active=True).order_by('id')
+        user = users.filter(username=options['username']).first() if options['username'] else users.first()
+        if user is None:
+            raise CommandError("No such active user; create one or pass --username.")
+        self.headers = {'Host': 'localhost', 'Authorization': f'Bearer {RefreshToken.for_user(user).access_token}'}
+        self.isbn = Book.objects.values_list('ISBN', flat=True).order_by('id').first() or 'none'
+        self.cold = options['cold']
+
+        # without rates the token buckets let everything through
+        rest_framework = {**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': {}}
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'localhost'], REST_FRAMEWORK=rest_framework):
+            self.stdout.write(f"{options['requests']} requests per row, {options['concurrency']} in flight, as {user.username}\n")
+            self.stdout.write(f"{'route':<20} {'mode':<11} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'queries':>8} {'errors':>7}")
+            for route in options['routes']:
+                for mode in options['modes']:
+                    result = self.run(route, mode, options['requests'], options['concurrency'])
+                    self.stdout.write(
+                        f"{route:<20} {mode:<11} {result['throughput']:>8.0f} {result['p50']:>8.2f} "
+                        f"{result['p95']:>8.2f} {result['queries']:>8.1f} {result['errors']:>7}"
+                    )
+
+    def url(self, route, mode, n):
+        name = f'async-{route}' if mode == 'asgi-async' else route
+        path = reverse(name, args=[self.isbn] if route == 'book-related' else [])
+        params = dict(ROUTES[route])
+        if self.cold:
+            params['nocache'] = f'{mode}-{n}'
+        return path, urlencode(params)
+
+    def run(self, route, mode, requests, concurrency):
+        samples = []  # (seconds, status, queries)
+        started = time.perf_counter()
+        if mode == 'wsgi':
+            self.run_threads(route, mode, requests, concurrency, samples)
+        else:
+            asyncio.run(self.run_tasks(route, mode, requests, concurrency, samples))
+        elapsed = time.perf_counter() - started
+
+        timings = sorted(seconds * 1000 for seconds, _, _ in samples)
+        return {
+            'throughput': len(samples) / elapsed,
+            'p50': statistics.median(timings),
+            'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            'queries': statistics.mean(queries for _, _, queries in samples),
+            'errors': sum(status >= 400 for _, status, _ in samples),
+        }
+
+    def run_threads(self, route, mode, requests, concurrency, samples):
+        application = get_wsgi_application()
+        numbers = iter(range(requests))
+
+        def worker():
+            for n in numbers:  # shared iterator: each number is taken once
+                path, query = self.url(route, mode, n)
+                start = time.perf_counter()
+                status, headers, _ = wsgi_request(application, 'GET', path, query, headers=self.headers)
+                samples.append((time.perf_counter() - start, status, int(headers['X-Query-Count'])))
+
+        with ThreadPoolExecutor(concurrency) as pool:
+            for future in [pool.submit(worker) for _ in range(concurrency)]:
+                future.result()
+
+    async def run_tasks(self, route, mode, requests, concurrency, samples):
+        application = get_asgi_application()
+        numbers = iter(range(requests))
+
+        async def worker():
+            for n in numbers:
+                path, query = self.url(route, mode, n)
+                start = time.perf_counter()
+                status, headers, _ = await asgi_request(application, 'GET', path, query, headers=self.headers)
+                samples.append((time.perf_counter() - start, status, int(headers['X-Query-Count'])))
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
@@ -0,0 +1,159 @@
+import random
+import statistics
+import time
+import uuid
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from librarySystem.models import Book, Borrow, Library, LibraryBranch, User
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a large borrow history and compare query plans and latencies of the "
+        "borrow access patterns with and without the open-borrow indexes. "
+        "Everything runs in one transaction that is rolled back at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--borrows', type=int, default=2_000_000, help="Historical borrows to seed.")
+        parser.add_argument('--users', type=int, default=20_000)
+        parser.add_argument('--books', type=int, default=5_000)
+        parser.add_argument('--open-ratio', type=float, default=0.01, help="Share of seeded borrows still open.")
+        parser.add_argument('--repeat', type=int, default=200, help="Timed executions per access pattern.")
+        parser.add_argument('--batch-size', type=int, default=10_000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        with transaction.atomic():
+            users, books = self.seed(options)
+            patterns = self.patterns(users, books, options['repeat'])
+
+            present = self.index_names()
+            for index in Borrow._meta.indexes:
+                if index.name in present:
+                    self.run_sql(f"DROP INDEX {connection.ops.quote_name(index.name)}")
+            self.analyze()
+            before = self.measure(patterns)
+
+            for index in Borrow._meta.indexes:
+                self.run_sql(index.create_sql(Borrow, connection.schema_editor()))
+            self.analyze()
+            after = self.measure(patterns)
+
+            self.report(patterns, before, after)
+            # leave the database exactly as we found it
+            transaction.set_rollback(True)
+
+    def seed(self, options):
+        tag = uuid.uuid4().hex[:8]
+        library = Library.objects.create(name=f"bench-{tag}")
+        branch = LibraryBranch.objects.create(library=library, location_lat=0.0, location_long=0.0, address=tag)
+        users = User.objects.bulk_create(
+            [User(username=f"bench-{tag}-{i}", password='!') for i in range(options['users'])],
+            batch_size=options['batch_size'],
+        )
+        books = Book.objects.bulk_create(
+            [Book(ISBN=f"bench-{tag}-{i}", name=f"Book {i}", category='bench') for i in range(options['books'])],
+            batch_size=options['batch_size'],
+        )
+        user_ids = [user.pk for user in users]
+        book_ids = [book.pk for book in books]
+
+        today = date.today()
+        total, batch_size, open_ratio = options['borrows'], options['batch_size'], options['open_ratio']
+        started = time.perf_counter()
+        for start in range(0, total, batch_size):
+            batch = []
+            for _ in range(min(batch_size, total - start)):
+                if self.random.random() < open_ratio:
+                    borrowed = today - timedelta(days=self.random.randrange(30))
+                    returned = None
+                else:
+                    borrowed = today - timedelta(days=self.random.randrange(30, 5 * 365))
+                    returned = borrowed + timedelta(days=self.random.randrange(1, 45))
+                batch.append(Borrow(
+                    user_id=self.random.choice(user_ids),
+                    book_id=self.random.choice(book_ids),
+                    library_branch=branch,
+                    borrow_date=borrowed,
+                    expected_return_date=borrowed + timedelta(days=30),
+                    return_date=returned,
+                ))
+            Borrow.objects.bulk_create(batch)
+            self.stdout.write(f"Seeded {start + len(batch)}/{total} borrows ({time.perf_counter() - started:.1f}s)")
+        return user_ids, book_ids
+
+    def patterns(self, user_ids, book_ids, repeat):
+        """The Borrow lookups made by views/borrows.py and the reminder sweep, with sampled arguments."""
+        today = date.today()
+        open_pairs = list(
+            Borrow.objects.filter(user_id__in=user_ids[:1000], return_date__isnull=True).values_list('user_id', 'book_id')[:repeat]
+        ) or [(user_ids[0], book_ids[0])]
+        pairs = [self.random.choice(open_pairs) for _ in range(repeat)]
+        users = [self.random.choice(user_ids) for _ in range(repeat)]
+        return [
+            ("validate return (user, book, open).exists()",
+             lambda p: Borrow.objects.filter(user_id=p[0], book_id=p[1], return_date__isnull=True), pairs,
+             lambda qs: qs.exists()),
+            ("return lookup (user, book, open).first()",
+             lambda p: Borrow.objects.filter(user_id=p[0], book_id=p[1], return_date__isnull=True), pairs,
+             lambda qs: qs.first()),
+            ("open borrows of user (penalty)",
+             lambda u: Borrow.objects.filter(user_id=u, return_date__isnull=True), users,
+             list),
+            ("due soon (reminder sweep)",
+             lambda _: Borrow.objects.filter(
+                 return_date__isnull=True, expected_return_date__range=(today, today + timedelta(days=3))
+             ).values_list('id', flat=True), [None] * max(1, repeat // 20),
+             list),
+        ]
+
+    def measure(self, patterns):
+        results = []
+        for _, build, params, run in patterns:
+            plan = build(params[0]).explain()
+            timings = []
+            for param in params:
+                start = time.perf_counter()
+                run(build(param))
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            results.append({
+                'plan': plan,
+                'p50': statistics.median(timings),
+                'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            })
+        return results
+
+    def report(self, patterns, before, after):
+        for (name, *_), old, new in zip(patterns, before, after):
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(f"  without indexes: p50 {old['p50']:.3f}ms  p95 {old['p95']:.3f}ms")
+            self.stdout.write(self.indent(old['plan']))
+            self.stdout.write(f"  with indexes:    p50 {new['p50']:.3f}ms  p95 {new['p95']:.3f}ms")
+            self.stdout.write(self.indent(new['plan']))
+            speedup = old['p50'] / new['p50'] if new['p50'] else float('inf')
+            self.stdout.write(self.style.SUCCESS(f"  speedup (p50): {speedup:.1f}x"))
+
+    def indent(self, text):
+        return '\n'.join('      ' + line for line in str(text).splitlines())
+
+    def index_names(self):
+        with connection.cursor() as cursor:
+            return set(connection.introspection.get_constraints(cursor, Borrow._meta.db_table))
+
+    def run_sql(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(str(sql))
+
+    def analyze(self):
+        # refresh planner statistics so both runs see the seeded distribution
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute("ANALYZE")
+            else:
+                cursor.execute(f"ANALYZE {connection.ops.quote_name(Borrow._meta.db_table)}")
@@ -0,0 +1,24 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from librarySystem.export import CHUNK_SIZE, CONTENT_TYPES, EXPORTS, export_lines
+
+
+class Command(BaseCommand):
+    help = "Stream a catalog table or the borrow history as NDJSON or CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument('entity', choices=sorted(EXPORTS))
+        parser.add_argument('--output', choices=sorted(CONTENT_TYPES), default='ndjson')
+        parser.add_argument('--file', help="Write to this file instead of stdout.")
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        lines = export_lines(options['entity'], options['output'], options['chunk_size'])
+        if options['file']:
+            with open(options['file'], 'w', newline='', encoding='utf-8') as stream:
+                stream.writelines(lines)
+        else:
+            for chunk in lines:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from librarySystem.catalog_import import BATCH_SIZE, READERS, CatalogImporter, CatalogImportError
+
+
+class Command(BaseCommand):
+    help = (
+        "Import books, authors, branches and stock from CSV or JSONL feeds. "
+        "Each batch is committed on its own; a failing record stops the import "
+        "after the batches before it were committed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help="Feed files, or - for stdin.")
+        parser.add_argument('--input-format', choices=sorted(READERS), help="Defaults to the file extension.")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+        importer = CatalogImporter(batch_size=options['batch_size'])
+        started = time.perf_counter()
+
+        def progress(totals):
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"{totals['records']} records: {totals['books']} books, {totals['stock']} stock rows, "
+                f"{totals['branches']} new branches ({totals['records'] / elapsed:.0f} records/s)"
+            )
+
+        for path in options['paths']:
+            input_format = options['input_format'] or os.path.splitext(path)[1].lstrip('.').lower()
+            if input_format not in READERS:
+                raise CommandError(f"Cannot tell the format of {path}; pass --input-format.")
+            try:
+                if path == '-':
+                    totals = importer.run(READERS[input_format](sys.stdin), progress)
+                else:
+                    with open(path, newline='', encoding='utf-8') as stream:
+                        totals = importer.run(READERS[input_format](stream), progress)
+            except (OSError, CatalogImportError) as exc:
+                raise CommandError(f"{path}: {exc}")
+            self.stdout.write(self.style.SUCCESS(f"Imported {totals['records']} records from {path}."))
@@ -0,0 +1,50 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from librarySystem.user_import import BATCH_SIZE, UserImporter, UserImportError
+
+
+class Command(BaseCommand):
+    help = (
+        "Create users and their API tokens from a CSV file (username, email, password, first_name, "
+        "last_name, max_borrows, location_lat, location_long). Passwords are hashed in parallel "
+        "across --workers processes; existing usernames are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV file, or - for stdin.")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--workers', type=int, help="Hashing processes; defaults to the number of CPUs.")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError("--workers must be positive.")
+        importer = UserImporter(batch_size=options['batch_size'], workers=options['workers'])
+        started = time.perf_counter()
+
+        def progress(totals):
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"{totals['records']} records: {totals['users']} users created, {totals['skipped']} skipped "
+                f"({totals['users'] / elapsed:.0f} users/s)"
+            )
+
+        path = options['path']
+        try:
+            if path == '-':
+                totals = importer.run(sys.stdin, progress)
+            else:
+                with open(path, newline='', encoding='utf-8') as stream:
+                    totals = importer.run(stream, progress)
+        except (OSError, UserImportError) as exc:
+            raise CommandError(f"{path}: {exc}")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {totals['users']} users ({totals['skipped']} skipped) in {elapsed:.1f}s, "
+            f"{totals['users'] / elapsed:.0f} users/s with {importer.workers} hashing processes."
+        ))
@@ -0,0 +1,164 @@
+import json
+import logging
+import platform
+import subprocess
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from django.utils.timezone import now
+
+from librarySystem.loadtest import MIX, PERCENTILES, Workload, compare, get_application, run_load, summarize
+from librarySystem.models import Book, Borrow, LibraryBranch, User
+from librarySystem.synthetic import PASSWORD, PREFIX
+
+
+def git_revision():
+    """(commit, whether the work tree has uncommitted changes), or (None, None) outside a checkout."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True)
+        status = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.stdout.strip(), bool(status.stdout.strip())
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a mixed workload over every API route against the WSGI or ASGI application "
+        "in this process, as the users of a seed_synthetic dataset, and report p50/p95/p99 "
+        "latency, throughput and queries per request for each route. Save the report with "
+        "--output and compare a later run (e.g. on another commit) with --compare."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interface', choices=['wsgi', 'asgi'], default='wsgi')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--duration', type=float, help="Seconds to run for, instead of a number of --requests.")
+        parser.add_argument('--warmup', type=int, default=200, help="Requests sent first and left out of the report.")
+        parser.add_argument('--seed', type=int, default=0, help="Seeds the request mix and the data it picks.")
+        parser.add_argument('--prefix', default=PREFIX, help="The seed_synthetic dataset to act as.")
+        parser.add_argument('--users', type=int, default=200, help="Dataset users sending the requests.")
+        parser.add_argument('--password', default=PASSWORD, help="Their password, for the login requests.")
+        parser.add_argument('--routes', nargs='+', choices=sorted(MIX), help="Only these routes; defaults to the whole mix.")
+        parser.add_argument('--throttle', action='store_true', help="Keep the rate limits; by default they are lifted.")
+        parser.add_argument('--output', help="Write the JSON report here.")
+        parser.add_argument('--compare', help="A JSON report to compare this run with.")
+        parser.add_argument('--threshold', type=float, default=0.1, help="Latency or throughput change counted as a regression.")
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        for option in ('concurrency', 'requests', 'users'):
+            if options[option] < 1:
+                raise CommandError(f"--{option} must be positive.")
+        if options['duration'] is not None and options['duration'] <= 0:
+            raise CommandError("--duration must be positive.")
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as stream:
+                    baseline = json.load(stream)
+            except (OSError, ValueError) as exc:
+                raise CommandError(f"{options['compare']}: {exc}")
+
+        prefix = options['prefix']
+        users = list(User.objects.filter(username__startswith=f'{prefix}-user-', is_active=True).order_by('id')[:options['users']])
+        admin = User.objects.filter(username=f'{prefix}-admin').first()
+        if not users or admin is None:
+            raise CommandError(f"No dataset with prefix {prefix!r}; run seed_synthetic first.")
+        workload = Workload(users, admin, options['password'], seed=options['seed'], routes=options['routes'])
+
+        commit, dirty = git_revision()
+        config = {
+            'commit': commit, 'dirty': dirty, 'started_at': now().isoformat(),
+            'python': platform.python_version(), 'django': django.get_version(), 'database': connection.vendor,
+            # the catalog; runs add borrows and users, so those are recorded but not compared
+            'dataset': {'prefix': prefix, 'books': Book.objects.count(), 'branches': LibraryBranch.objects.count()},
+            'borrows': Borrow.objects.count(), 'user_count': User.objects.count(),
+            **{key: options[key] for key in (
+                'interface', 'concurrency', 'requests', 'duration', 'warmup', 'seed', 'users', 'routes', 'throttle',
+            )},
+        }
+        if options['duration'] is not None:
+            config['requests'] = None
+
+        rest_framework = settings.REST_FRAMEWORK
+        if not options['throttle']:
+            # without rates the token buckets let everything through
+            rest_framework = {**rest_framework, 'DEFAULT_THROTTLE_RATES': {}}
+        # loading the application configures logging, so the loggers are quieted after it:
+        # a line per request, and a warning per refused borrow, would dominate the run
+        application = get_application(options['interface'])
+        loggers = {logging.getLogger('librarySystem.queries'): logging.WARNING, logging.getLogger('django.request'): logging.ERROR}
+        levels = {logger: logger.level for logger in loggers}
+        for logger, level in loggers.items():
+            logger.setLevel(level)
+        try:
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'localhost'], REST_FRAMEWORK=rest_framework):
+                if options['warmup']:
+                    run_load(workload, application, options['concurrency'], requests=options['warmup'],
+                             seed=f"warmup-{options['seed']}")
+                samples, elapsed = run_load(
+                    workload, application, options['concurrency'],
+                    requests=config['requests'], duration=options['duration'], seed=options['seed'],
+                )
+        finally:
+            for logger, level in levels.items():
+                logger.setLevel(level)
+        if not samples:
+            raise CommandError("No requests were sent.")
+
+        report = summarize(samples, elapsed, config)
+        self.write_report(report)
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                json.dump(report, stream, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
+        if baseline is not None:
+            regressions = self.write_comparison(compare(report, baseline, options['threshold']), baseline, config)
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f"{len(regressions)} regressions: " + ', '.join(regressions))
+
+    def write_report(self, report):
+        config = report['config']
+        self.stdout.write(
+            f"{report['total']['requests']} requests in {report['elapsed_s']:.1f}s over {config['interface']}, "
+            f"{config['concurrency']} in flight, at {(config['commit'] or 'unknown')[:12]}{' (modified)' if config['dirty'] else ''}\n"
+        )
+        percentiles = ''.join(f"{f'p{p} ms':>9}" for p in PERCENTILES)
+        self.stdout.write(f"{'route':<26} {'requests':>8} {'req/s':>8}{percentiles} {'queries':>8} {'4xx':>5} {'5xx':>5}")
+        for route, stats in [*report['routes'].items(), ('total', report['total'])]:
+            client_errors = sum(count for code, count in stats['statuses'].items() if 400 <= int(code) < 500)
+            self.stdout.write(
+                f"{route:<26} {stats['requests']:>8} {stats['throughput']:>8.1f}"
+                + ''.join(f"{stats[f'p{p}_ms']:>9.2f}" for p in PERCENTILES)
+                + f" {stats['queries']:>8.2f} {client_errors:>5} {stats['errors']:>5}"
+            )
+
+    def write_comparison(self, rows, baseline, config):
+        commit = baseline['config'].get('commit') or 'unknown'
+        self.stdout.write(f"\nCompared with {commit[:12]}:")
+        differences = [
+            key for key in ('interface', 'concurrency', 'requests', 'duration', 'seed', 'users', 'routes', 'throttle', 'database', 'dataset')
+            if baseline['config'].get(key) != config.get(key)
+        ]
+        if differences:
+            self.stdout.write(self.style.WARNING(f"The runs differ in {', '.join(differences)}; the numbers may not be comparable."))
+        self.stdout.write(f"{'route':<26} {'metric':<10} {'before':>10} {'after':>10} {'change':>8}")
+        regressions = []
+        for route, metric, before, after, change, regressed in rows:
+            if route != 'total' and not regressed:
+                continue  # the totals, and whatever got worse
+            line = f"{route:<26} {metric:<10} {before:>10.2f} {after:>10.2f} {change:>+8.1%}"
+            if regressed:
+                regressions.append(f'{route} {metric}')
+                line = self.style.ERROR(line + '  regressed')
+            self.stdout.write(line)
+        if not regressions:
+            self.stdout.write(self.style.SUCCESS("No regressions."))
+        return regressions
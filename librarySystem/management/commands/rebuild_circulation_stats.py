@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from librarySystem import stats
+
+
+class Command(BaseCommand):
+    help = "Recompute the circulation statistics rollups from the Borrow history."
+
+    def handle(self, *args, **options):
+        stats.rebuild()
+        self.stdout.write(self.style.SUCCESS("Circulation statistics rebuilt."))
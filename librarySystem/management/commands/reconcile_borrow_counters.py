@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from librarySystem.models import Borrow, User
+
+
+class Command(BaseCommand):
+    help = "Rebuild User.active_borrows from the open Borrow rows."
+
+    def handle(self, *args, **options):
+        open_borrows = Borrow.objects.filter(user=OuterRef('pk'), return_date__isnull=True).order_by()
+        actual = Coalesce(Subquery(open_borrows.values('user').annotate(count=Count('*')).values('count')), 0)
+
+        # one UPDATE, touching only the users whose counter drifted
+        fixed = User.objects.exclude(active_borrows=actual).update(active_borrows=actual)
+        self.stdout.write(self.style.SUCCESS(f"Reconciled active borrow counters for {fixed} users."))
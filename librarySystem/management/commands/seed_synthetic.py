@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from librarySystem.synthetic import BATCH_SIZE, PASSWORD, PREFIX, SyntheticDataset
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with a synthetic but realistically skewed dataset for load tests: "
+        "libraries and branches clustered in cities, Zipf distributed authorship and book "
+        "popularity, stock and a borrow history consistent with it. The same options and "
+        "--seed always generate the same dataset."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--libraries', type=int, default=20)
+        parser.add_argument('--branches-per-library', type=int, default=3, help="Average; every library has at least one.")
+        parser.add_argument('--authors', type=int, default=2000)
+        parser.add_argument('--books', type=int, default=20000)
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--borrows', type=int, default=50000)
+        parser.add_argument('--days', type=int, default=365, help="Days of borrow history, ending today.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default=PREFIX, help="Starts every generated username, library name and ISBN.")
+        parser.add_argument('--password', default=PASSWORD, help="Password of every generated user.")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        for option in ('libraries', 'branches_per_library', 'authors', 'books', 'users', 'days', 'batch_size'):
+            if options[option] < 1:
+                raise CommandError(f"--{option.replace('_', '-')} must be positive.")
+        if options['borrows'] < 0:
+            raise CommandError("--borrows cannot be negative.")
+
+        dataset = SyntheticDataset(
+            libraries=options['libraries'], branches=options['branches_per_library'], authors=options['authors'],
+            books=options['books'], users=options['users'], borrows=options['borrows'], days=options['days'],
+            seed=options['seed'], prefix=options['prefix'], password=options['password'], batch_size=options['batch_size'],
+        )
+        if dataset.exists():
+            raise CommandError(f"A dataset with prefix {options['prefix']!r} already exists; choose another --prefix.")
+        started = time.perf_counter()
+
+        def progress(stage, totals):
+            self.stdout.write(f"{stage}: {', '.join(f'{value} {key}' for key, value in totals.items())} "
+                              f"({time.perf_counter() - started:.1f}s)")
+
+        dataset.run(progress)
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded dataset {options['prefix']!r} in {time.perf_counter() - started:.1f}s. "
+            f"Users are {options['prefix']}-user-<n> and {options['prefix']}-admin (staff)."
+        ))
@@ -0,0 +1,108 @@
+import heapq
+import json
+import logging
+import time
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger('librarySystem.queries')
+
+
+class QueryRecorder:
+    """`connection.execute_wrapper` callable that times every statement."""
+
+    def __init__(self, keep_slowest=3):
+        self.keep_slowest = keep_slowest
+        self.count = 0
+        self.total_time = 0.0
+        self._slowest = []  # min-heap of (duration, sequence, sql)
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.total_time += duration
+            entry = (duration, self.count, sql)
+            if len(self._slowest) < self.keep_slowest:
+                heapq.heappush(self._slowest, entry)
+            else:
+                heapq.heappushpop(self._slowest, entry)
+
+    @property
+    def slowest(self):
+        return [
+            {'sql': sql, 'ms': round(duration * 1000, 3)}
+            for duration, _, sql in sorted(self._slowest, reverse=True)
+        ]
+
+
+@contextmanager
+def record_queries(recorder):
+    """Run `recorder` around every statement on every database connection."""
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Records query count, total SQL time and the slowest statements of every
+    request. Totals are returned in X-Query-Count / X-Query-Time-Ms headers and
+    everything is logged as one JSON record on the `librarySystem.queries` logger.
+
+    Works in both sync and async chains, so under ASGI async views run without
+    a thread being held for the request.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.keep_slowest = getattr(settings, 'QUERY_LOG_SLOWEST', 3)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = QueryRecorder(self.keep_slowest)
+        start = time.perf_counter()
+        with record_queries(recorder):
+            response = self.get_response(request)
+        return self.finish(request, response, recorder, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder(self.keep_slowest)
+        start = time.perf_counter()
+        # Connections belong to threads, and under ASGI every query of a request
+        # (async ORM, sync views, sync_to_async) runs on the request's one
+        # thread-sensitive worker thread, so the wrappers are installed there
+        with ExitStack() as stack:
+            await sync_to_async(stack.enter_context)(record_queries(recorder))
+            response = await self.get_response(request)
+        return self.finish(request, response, recorder, time.perf_counter() - start)
+
+    def finish(self, request, response, recorder, duration):
+        sql_ms = round(recorder.total_time * 1000, 3)
+        response['X-Query-Count'] = str(recorder.count)
+        response['X-Query-Time-Ms'] = str(sql_ms)
+
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 3),
+            'query_count': recorder.count,
+            'sql_ms': sql_ms,
+            'slowest': recorder.slowest,
+        }
+        logger.info(json.dumps(record), extra={'queries': record})
+        return response
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarySystem', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='librarybranch',
+            index=models.Index(fields=['location_lat', 'location_long'], name='branch_location_idx'),
+        ),
+    ]
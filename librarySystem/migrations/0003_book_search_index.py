@@ -0,0 +1,79 @@
+# Full-text index over books, see librarySystem/search.py
+#
+# The DDL and the backfill are frozen here, against the historical models,
+# rather than imported from librarySystem.search, which follows the current
+# models and may change.
+
+from django.db import migrations
+
+
+INDEX_TABLE = 'librarySystem_booksearch'
+
+
+def _tables(apps, connection):
+    Book = apps.get_model('librarySystem', 'Book')
+    Author = apps.get_model('librarySystem', 'Author')
+    quote = connection.ops.quote_name
+    return {
+        'index': quote(INDEX_TABLE),
+        'book': quote(Book._meta.db_table),
+        'book_authors': quote(Book._meta.get_field('authors').remote_field.through._meta.db_table),
+        'author': quote(Author._meta.db_table),
+        'isbn': quote(Book._meta.get_field('ISBN').column),
+    }
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        return
+    t = _tables(apps, connection)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE {t['index']} USING fts5("
+                "name, isbn, authors, category, "
+                "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+            )
+            cursor.execute(
+                f"INSERT INTO {t['index']} (rowid, name, isbn, authors, category) "
+                f"SELECT b.id, b.name, b.{t['isbn']}, "
+                f"COALESCE((SELECT group_concat(a.name, ' ') FROM {t['book_authors']} ba "
+                f"JOIN {t['author']} a ON a.id = ba.author_id WHERE ba.book_id = b.id), ''), "
+                f"b.category FROM {t['book']} b"
+            )
+        else:
+            cursor.execute(
+                f"CREATE TABLE {t['index']} ("
+                f"book_id bigint PRIMARY KEY REFERENCES {t['book']} (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+                "document tsvector NOT NULL)"
+            )
+            cursor.execute(f"CREATE INDEX booksearch_document_idx ON {t['index']} USING GIN (document)")
+            cursor.execute(
+                f"INSERT INTO {t['index']} (book_id, document) "
+                f"SELECT b.id, "
+                f"setweight(to_tsvector('simple', b.name), 'A') || "
+                f"setweight(to_tsvector('simple', b.{t['isbn']}), 'A') || "
+                f"setweight(to_tsvector('simple', COALESCE((SELECT string_agg(a.name, ' ') FROM {t['book_authors']} ba "
+                f"JOIN {t['author']} a ON a.id = ba.author_id WHERE ba.book_id = b.id), '')), 'B') || "
+                f"setweight(to_tsvector('simple', b.category), 'C') "
+                f"FROM {t['book']} b"
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor in ('sqlite', 'postgresql'):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {connection.ops.quote_name(INDEX_TABLE)}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarySystem', '0002_librarybranch_location_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
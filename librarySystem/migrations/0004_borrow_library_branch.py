@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarySystem', '0003_book_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='borrow',
+            name='library_branch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='librarySystem.librarybranch'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:20
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_active_borrows(apps, schema_editor):
+    User = apps.get_model('librarySystem', 'User')
+    Borrow = apps.get_model('librarySystem', 'Borrow')
+    open_borrows = Borrow.objects.filter(user=OuterRef('pk'), return_date__isnull=True).order_by()
+    User.objects.update(active_borrows=Coalesce(
+        Subquery(open_borrows.values('user').annotate(count=Count('*')).values('count')), 0
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarySystem', '0004_borrow_library_branch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='active_borrows',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_active_borrows, migrations.RunPython.noop),
+    ]
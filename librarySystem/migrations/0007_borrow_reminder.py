@@ -0,0 +1,25 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarySystem', '0006_email_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BorrowReminder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sent_on', models.DateField()),
+                ('borrow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reminders', to='librarySystem.borrow')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('borrow', 'sent_on'), name='unique_borrow_reminder_per_day')],
+            },
+        ),
+    ]
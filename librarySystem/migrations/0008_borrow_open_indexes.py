@@ -0,0 +1,21 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarySystem', '0007_borrow_reminder'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='borrow',
+            index=models.Index(condition=models.Q(('return_date__isnull', True)), fields=['user', 'book'], name='borrow_open_user_book_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='borrow',
+            index=models.Index(condition=models.Q(('return_date__isnull', True)), fields=['expected_return_date'], name='borrow_open_due_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:28
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_stock(apps, schema_editor):
+    # fold duplicate (book, branch) rows into the oldest one before the constraint is added
+    BookStock = apps.get_model('librarySystem', 'BookStock')
+    duplicates = (
+        BookStock.objects.values('book', 'library_branch')
+        .annotate(rows=Count('id'), keep=Min('id'), total=Sum('count'))
+        .filter(rows__gt=1)
+    )
+    for row in duplicates:
+        BookStock.objects.filter(id=row['keep']).update(count=row['total'])
+        BookStock.objects.filter(book=row['book'], library_branch=row['library_branch']).exclude(id=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarySystem', '0008_borrow_open_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_stock, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='bookstock',
+            constraint=models.UniqueConstraint(fields=('book', 'library_branch'), name='bookstock_book_branch_unique'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('librarySystem', '0009_bookstock_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PenaltyAccrual',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('days_overdue', models.PositiveIntegerField()),
+                ('amount', models.FloatField()),
+                ('accrued_on', models.DateField()),
+                ('final', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='penalty_balance',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('penalty_balance__gt', 0)), fields=['-penalty_balance', 'id'], name='user_penalty_balance_idx'),
+        ),
+        migrations.AddField(
+            model_name='penaltyaccrual',
+            name='borrow',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='penalty', to='librarySystem.borrow'),
+        ),
+        migrations.AddField(
+            model_name='penaltyaccrual',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='penalties', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
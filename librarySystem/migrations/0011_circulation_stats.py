@@ -0,0 +1,63 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:38
+
+from django.db import migrations, models
+
+
+def backfill_circulation_stats(apps, schema_editor):
+    # the rollup of librarySystem.stats, frozen here against the historical models:
+    # borrows count on the day they were made, returns on the day they came back
+    Book = apps.get_model('librarySystem', 'Book')
+    Borrow = apps.get_model('librarySystem', 'Borrow')
+    LibraryBranch = apps.get_model('librarySystem', 'LibraryBranch')
+    CirculationStat = apps.get_model('librarySystem', 'CirculationStat')
+    quote = schema_editor.connection.ops.quote_name
+    t = {
+        'stat': quote(CirculationStat._meta.db_table),
+        'key': quote('key'),
+        'borrow': quote(Borrow._meta.db_table),
+        'book': quote(Book._meta.db_table),
+        'branch': quote(LibraryBranch._meta.db_table),
+        'book_authors': quote(Book._meta.get_field('authors').remote_field.through._meta.db_table),
+    }
+    buckets = {
+        'category': ('bk.category', f"JOIN {t['book']} bk ON bk.id = br.book_id"),
+        'library': ('CAST(lb.library_id AS text)', f"JOIN {t['branch']} lb ON lb.id = br.library_branch_id"),
+        'author': ('CAST(ba.author_id AS text)', f"JOIN {t['book_authors']} ba ON ba.book_id = br.book_id"),
+    }
+    selects = ' UNION ALL '.join(
+        f"SELECT br.{column} AS day, '{dimension}' AS dimension, {key} AS bucket, {borrows} AS borrows, {returns} AS returns "
+        f"FROM {t['borrow']} br {join} WHERE br.{column} IS NOT NULL"
+        for column, borrows, returns in (('borrow_date', 1, 0), ('return_date', 0, 1))
+        for dimension, (key, join) in buckets.items()
+    )
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {t['stat']} (day, dimension, {t['key']}, borrows, returns) "
+            f"SELECT day, dimension, bucket, SUM(borrows), SUM(returns) FROM ({selects}) rollup "
+            f"GROUP BY day, dimension, bucket"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarySystem', '0010_penalty_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CirculationStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('dimension', models.CharField(max_length=20)),
+                ('key', models.CharField(max_length=100)),
+                ('borrows', models.PositiveIntegerField(default=0)),
+                ('returns', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('dimension', 'day', 'key'), name='unique_circulation_bucket')],
+            },
+        ),
+        migrations.RunPython(backfill_circulation_stats, migrations.RunPython.noop),
+    ]
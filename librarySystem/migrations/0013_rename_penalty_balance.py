@@ -0,0 +1,26 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarySystem', '0012_related_books'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_penalty_balance_idx',
+        ),
+        migrations.RenameField(
+            model_name='user',
+            old_name='penalty_balance',
+            new_name='penalty_total',
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('penalty_total__gt', 0)), fields=['-penalty_total', 'id'], name='user_penalty_total_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarySystem', '0013_rename_penalty_balance'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='authors',
+            field=models.ManyToManyField(related_name='books', to='librarySystem.author'),
+        ),
+    ]
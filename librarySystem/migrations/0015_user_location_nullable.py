@@ -0,0 +1,44 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:45
+
+import django.core.validators
+from django.db import migrations, models
+
+
+# the previous default, outside the valid range, stood for "no location"
+PLACEHOLDER = 100.0
+
+
+def clear_placeholder_locations(apps, schema_editor):
+    User = apps.get_model('librarySystem', 'User')
+    invalid = (
+        models.Q(location_lat__lt=-90) | models.Q(location_lat__gt=90)
+        | models.Q(location_long__lt=-180) | models.Q(location_long__gt=180)
+    )
+    User.objects.filter(invalid).update(location_lat=None, location_long=None)
+
+
+def restore_placeholder_locations(apps, schema_editor):
+    User = apps.get_model('librarySystem', 'User')
+    User.objects.filter(location_lat__isnull=True).update(location_lat=PLACEHOLDER)
+    User.objects.filter(location_long__isnull=True).update(location_long=PLACEHOLDER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarySystem', '0014_alter_book_authors'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='location_lat',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)]),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='location_long',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)]),
+        ),
+        migrations.RunPython(clear_placeholder_locations, restore_placeholder_locations),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser, Group, Permission
 from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.utils.timezone import now
 
 
@@ -8,10 +9,13 @@ from django.utils.timezone import now
 class User(AbstractUser): # extend default django user model
     max_borrows = models.IntegerField(default=3)
     restricted = models.BooleanField(default=False)
-    location_lat = models.FloatField(default=100.0) # for calc distances between user and nearest library branch
-    location_long = models.FloatField(default=100.0)
+    # for calc distances between user and nearest library branch; null when the user gave no location
+    location_lat = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-90), MaxValueValidator(90)])
+    location_long = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-180), MaxValueValidator(180)])
     penalty_amount = models.FloatField(default=5.0)
     borrow_max_days = models.IntegerField(default=30)
+    active_borrows = models.PositiveIntegerField(default=0) # open borrows, kept in step with Borrow to enforce max_borrows
+    penalty_total = models.FloatField(default=0.0) # lifetime total of the user's PenaltyAccrual amounts, paid or not (librarySystem.penalties)
 
     groups = models.ManyToManyField(
         Group,
@@ -24,6 +28,12 @@ class User(AbstractUser): # extend default django user model
         blank=True
     )
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # penalty totals report: only users who have incurred penalties
+            models.Index(fields=['-penalty_total', 'id'], condition=models.Q(penalty_total__gt=0), name='user_penalty_total_idx'),
+        ]
+
 class Author(models.Model):
     name = models.CharField(max_length=100, unique=True)
 
@@ -42,23 +52,139 @@ class LibraryBranch(models.Model):
     location_long = models.FloatField()
     address = models.CharField(max_length=250)
 
+    class Meta:
+        indexes = [
+            # bounding-box prefilter for nearby branch searches
+            models.Index(fields=['location_lat', 'location_long'], name='branch_location_idx'),
+        ]
+
 # New intermediate model to track the number of books at each branch
 class BookStock(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     library_branch = models.ForeignKey(LibraryBranch, on_delete=models.CASCADE)
     count = models.PositiveIntegerField(default=0)  # Number of copies of the book at the branch
 
+    class Meta:
+        constraints = [
+            # one stock row per book and branch; also the conflict target of catalog imports
+            models.UniqueConstraint(fields=['book', 'library_branch'], name='bookstock_book_branch_unique'),
+        ]
+
 class Borrow(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     book = models.ForeignKey(Book, on_delete=models.DO_NOTHING)
+    library_branch = models.ForeignKey(LibraryBranch, on_delete=models.SET_NULL, null=True, blank=True) # branch the copy was taken from
     borrow_date = models.DateField()
     expected_return_date = models.DateField() # add validation to assign this > today's date?
     return_date = models.DateField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Partial indexes over open borrows only (return_date IS NULL), which
+            # stay small however much history accumulates:
+            # quota/return lookups by (user) and (user, book)...
+            models.Index(fields=['user', 'book'], condition=models.Q(return_date__isnull=True), name='borrow_open_user_book_idx'),
+            # ...and reminder/penalty sweeps by due date
+            models.Index(fields=['expected_return_date'], condition=models.Q(return_date__isnull=True), name='borrow_open_due_idx'),
+        ]
+
     def clean(self): # for expected_return_date validation
         if self.expected_return_date <= now().date():
             raise ValidationError("Expected return date must be in the future.")
         
         # Validate that the return date is after the borrow date
         if self.return_date and self.return_date <= self.borrow_date:
-            raise ValidationError("Return date must be after the borrow date.")
\ No newline at end of file
+            raise ValidationError("Return date must be after the borrow date.")
+
+
+# One row per reminder sent, so a re-run of the daily sweep never emails twice
+class BorrowReminder(models.Model):
+    borrow = models.ForeignKey(Borrow, on_delete=models.CASCADE, related_name='reminders')
+    sent_on = models.DateField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['borrow', 'sent_on'], name='unique_borrow_reminder_per_day'),
+        ]
+
+
+# Emails are written here in the same transaction as the change they announce
+# and sent later in batches by the drain_email_outbox task
+class EmailOutbox(models.Model):
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    recipient = models.CharField(max_length=254)
+    created_at = models.DateTimeField(default=now)
+    next_attempt_at = models.DateTimeField(default=now)
+    attempts = models.PositiveIntegerField(default=0)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at'], condition=models.Q(sent_at__isnull=True), name='outbox_pending_idx'),
+        ]
+
+
+# Penalty ledger: one row per overdue borrow. The nightly accrue_penalties task
+# recomputes the rows of open borrows; a return fixes the row at its final amount.
+class PenaltyAccrual(models.Model):
+    borrow = models.OneToOneField(Borrow, on_delete=models.CASCADE, related_name='penalty')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='penalties')
+    days_overdue = models.PositiveIntegerField()
+    amount = models.FloatField()
+    accrued_on = models.DateField()  # day the amount was computed for
+    final = models.BooleanField(default=False)  # set once the book is returned
+
+
+# Daily borrow/return counts per category, library and author, kept current by
+# every borrow and return (librarySystem.stats) so reports never scan Borrow
+class CirculationStat(models.Model):
+    DIMENSIONS = ['category', 'library', 'author']
+
+    day = models.DateField()
+    dimension = models.CharField(max_length=20)
+    key = models.CharField(max_length=100)  # category name, library id or author id
+    borrows = models.PositiveIntegerField(default=0)
+    returns = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # also serves the stats endpoints' (dimension, day range) reads
+            models.UniqueConstraint(fields=['dimension', 'day', 'key'], name='unique_circulation_bucket'),
+        ]
+
+
+# High-water marks of incremental jobs: how far through a table each has got
+class JobCheckpoint(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)  # e.g. the last processed Borrow id
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+# Sparse co-borrow matrix: how many users borrowed both `book` and `related`.
+# Kept symmetric (both directions are stored) by librarySystem.recommendations.
+class CoBorrow(models.Model):
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    related = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    borrowers = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'related'], name='unique_coborrow_pair'),
+        ]
+
+
+# Top related books of each book, precomputed from CoBorrow
+class RelatedBook(models.Model):
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='related_books')
+    related = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    score = models.PositiveIntegerField()  # users who borrowed both
+    position = models.PositiveSmallIntegerField()  # 1 is the most related
+
+    class Meta:
+        constraints = [
+            # also the index behind /api/books/<ISBN>/related
+            models.UniqueConstraint(fields=['book', 'position'], name='unique_related_book_position'),
+        ]
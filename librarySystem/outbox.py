@@ -0,0 +1,81 @@
+"""
+Transactional email outbox.
+
+Views call `queue_email` inside the transaction that makes the change, so the
+email exists exactly when the change commits and no request waits on SMTP.
+`deliver_pending` (run by the drain_email_outbox task) sends queued emails in
+batches over one SMTP connection and backs off failed ones.
+"""
+import logging
+from datetime import timedelta
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils.timezone import now
+
+from .models import EmailOutbox
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FROM_EMAIL = 'library@example.com'
+MAX_ATTEMPTS = 8
+LEASE = timedelta(minutes=5)  # how long a claimed batch is hidden from other drains
+
+
+def queue_email(subject, body, recipient, from_email=DEFAULT_FROM_EMAIL):
+    if recipient:
+        return EmailOutbox.objects.create(subject=subject, body=body, recipient=recipient, from_email=from_email)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(30 * 2 ** attempts, 3600))
+
+
+def claim_batch(batch_size):
+    """Lease up to `batch_size` due emails so concurrent drains skip them."""
+    current = now()
+    with transaction.atomic():
+        batch = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(sent_at__isnull=True, next_attempt_at__lte=current, attempts__lt=MAX_ATTEMPTS)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        EmailOutbox.objects.filter(id__in=[email.id for email in batch]).update(next_attempt_at=current + LEASE)
+    return batch
+
+
+def deliver_pending(batch_size=100):
+    """Send one batch of due emails; return how many were sent."""
+    batch = claim_batch(batch_size)
+    if not batch:
+        return 0
+
+    sent, failed = [], []
+    connection = get_connection()
+    try:
+        connection.open()
+    except OSError as exc:
+        logger.warning("Email outbox: cannot reach the mail server: %s", exc)
+        failed = [(email, exc) for email in batch]
+    else:
+        try:
+            for email in batch:
+                message = EmailMessage(email.subject, email.body, email.from_email, [email.recipient], connection=connection)
+                try:
+                    connection.send_messages([message])
+                except Exception as exc:
+                    failed.append((email, exc))
+                else:
+                    sent.append(email.id)
+        finally:
+            connection.close()
+
+    EmailOutbox.objects.filter(id__in=sent).update(sent_at=now())
+    for email, exc in failed:
+        EmailOutbox.objects.filter(id=email.id).update(
+            attempts=email.attempts + 1,
+            next_attempt_at=now() + retry_delay(email.attempts),
+            last_error=str(exc),
+        )
+    return len(sent)
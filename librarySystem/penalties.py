@@ -0,0 +1,133 @@
+"""
+Penalty ledger.
+
+Every borrow kept past its expected return date has one PenaltyAccrual row:
+days overdue times the user's penalty_amount. `accrue_penalties` (the nightly
+accrue_penalties task) brings the rows of all open borrows up to date. On
+SQLite and PostgreSQL that is one INSERT ... SELECT ... ON CONFLICT statement
+doing the date arithmetic in the database; other backends compute the rows in
+Python, in chunks. It then refreshes User.penalty_total of the affected users
+with one UPDATE. A return fixes the borrow's row at its final amount
+(`close_penalties`).
+
+User.penalty_total is the lifetime total of a user's penalties, final and
+still accruing: nothing records payments, so it is not a balance owed.
+"""
+from django.db import connection as default_connection, transaction
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils.timezone import now
+
+from .models import Borrow, PenaltyAccrual, User
+
+
+CHUNK_SIZE = 1000
+
+
+def _tables(connection):
+    quote = connection.ops.quote_name
+    return {
+        'ledger': quote(PenaltyAccrual._meta.db_table),
+        'borrow': quote(Borrow._meta.db_table),
+        'user': quote(User._meta.db_table),
+    }
+
+
+def _days_overdue(connection):
+    # whole days from b.expected_return_date to the date passed as %s; None where there is no SQL for it
+    if connection.vendor == 'sqlite':
+        return "CAST(julianday(%s) - julianday(b.expected_return_date) AS INTEGER)"
+    if connection.vendor == 'postgresql':
+        return "(CAST(%s AS date) - b.expected_return_date)"
+    return None
+
+
+def _accrue_in_python(today, connection):
+    # the rows the SQL statement writes, computed here a chunk of borrows at a time;
+    # overdue borrows are open, so their existing rows are never final and can be replaced
+    ledger = PenaltyAccrual.objects.using(connection.alias)
+    overdue = (
+        Borrow.objects.using(connection.alias)
+        .filter(return_date__isnull=True, expected_return_date__lt=today)
+        .order_by('id')
+        .values_list('id', 'user_id', 'expected_return_date', 'user__penalty_amount')
+    )
+    accrued, last = 0, 0
+    with transaction.atomic(using=connection.alias):
+        while chunk := list(overdue.filter(id__gt=last)[:CHUNK_SIZE]):
+            last = chunk[-1][0]
+            accruals = []
+            for borrow_id, user_id, expected_return_date, penalty_amount in chunk:
+                days = (today - expected_return_date).days
+                accruals.append(PenaltyAccrual(
+                    borrow_id=borrow_id, user_id=user_id, days_overdue=days, amount=days * penalty_amount,
+                    accrued_on=today, final=False,
+                ))
+            ledger.filter(borrow_id__in=[accrual.borrow_id for accrual in accruals]).delete()
+            ledger.bulk_create(accruals)
+            accrued += len(accruals)
+    return accrued
+
+
+def _accrue_in_sql(today, connection, days_overdue):
+    t = _tables(connection)
+    with connection.cursor() as cursor:
+        # the WHERE on the outer SELECT keeps SQLite from reading ON CONFLICT as a join clause
+        cursor.execute(
+            f"INSERT INTO {t['ledger']} (borrow_id, user_id, days_overdue, amount, accrued_on, final) "
+            f"SELECT id, user_id, days, days * penalty_amount, %s, %s FROM ("
+            f"SELECT b.id, b.user_id, {days_overdue} AS days, u.penalty_amount "
+            f"FROM {t['borrow']} b JOIN {t['user']} u ON u.id = b.user_id "
+            f"WHERE b.return_date IS NULL AND b.expected_return_date < %s"
+            f") overdue WHERE days > 0 "
+            f"ON CONFLICT (borrow_id) DO UPDATE SET days_overdue = excluded.days_overdue, "
+            f"amount = excluded.amount, accrued_on = excluded.accrued_on",
+            [today, False, today, today],
+        )
+        return cursor.rowcount
+
+
+def accrue_penalties(today=None, connection=None):
+    """Update the ledger rows of every overdue open borrow as of `today`; return the number of rows written."""
+    connection = connection or default_connection
+    today = today or now().date()
+    days_overdue = _days_overdue(connection)
+    if days_overdue is None:
+        accrued = _accrue_in_python(today, connection)
+    else:
+        accrued = _accrue_in_sql(today, connection, days_overdue)
+
+    refresh_totals(PenaltyAccrual.objects.filter(accrued_on=today, final=False).values('user_id'))
+    return accrued
+
+
+def refresh_totals(user_ids):
+    """Recompute the lifetime penalty_total from the ledger for `user_ids` (a list or a values() subquery)."""
+    totals = PenaltyAccrual.objects.filter(user=OuterRef('pk')).order_by().values('user').annotate(total=Sum('amount'))
+    return User.objects.filter(id__in=user_ids).update(
+        penalty_total=Coalesce(Subquery(totals.values('total')), Value(0.0))
+    )
+
+
+def close_penalties(user, borrows):
+    """
+    Record the final penalty of `user`'s just returned `borrows` (return_date
+    set); return {borrow id: (days late, penalty)} for the late ones.
+    """
+    late, accruals = {}, []
+    for borrow in borrows:
+        days_late = (borrow.return_date - borrow.expected_return_date).days
+        if days_late > 0:
+            penalty = days_late * user.penalty_amount
+            late[borrow.id] = (days_late, penalty)
+            accruals.append(PenaltyAccrual(
+                borrow=borrow, user=user, days_overdue=days_late, amount=penalty,
+                accrued_on=borrow.return_date, final=True,
+            ))
+    if accruals:
+        PenaltyAccrual.objects.bulk_create(
+            accruals, update_conflicts=True, unique_fields=['borrow'],
+            update_fields=['days_overdue', 'amount', 'accrued_on', 'final'],
+        )
+        refresh_totals([user.pk])
+    return late
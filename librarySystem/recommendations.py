@@ -0,0 +1,166 @@
+"""
+"Also borrowed" recommendations.
+
+CoBorrow is a sparse, symmetric book x book matrix counting the users who
+borrowed both books; RelatedBook keeps the TOP_K largest entries of each row.
+`update_related_books` (the update_related_books task) folds in only the
+borrows made since its JobCheckpoint high-water mark:
+
+1. read the next chunk of new borrows and the borrow history of their users;
+2. for every user, pair each book borrowed for the first time in this chunk
+   with each other book the user has borrowed, as NumPy arrays of book ids;
+3. sum identical pairs with np.unique and add the counts to CoBorrow with one
+   batched upsert;
+4. re-rank the rows of the books that changed with a window function.
+
+Each chunk commits together with its checkpoint, so an interrupted run resumes
+where it stopped without counting anything twice.
+
+Borrow ids are handed out before their transactions commit, so a borrow can
+become visible after one with a higher id; a high-water mark at the newest id
+would then skip it forever. A run therefore only reads up to the newest id the
+previous run saw (kept in a second JobCheckpoint), an hour earlier on the beat
+schedule, by which time every borrow up to it has committed or rolled back.
+"""
+import numpy as np
+from django.db import connection as default_connection, transaction
+from django.db.models import Max
+
+from .models import Borrow, CoBorrow, JobCheckpoint, RelatedBook
+
+
+CHECKPOINT = 'related-books'
+HORIZON = 'related-books:horizon'  # the newest Borrow id when the last run started
+TOP_K = 10
+CHUNK_SIZE = 100_000  # new borrows per transaction
+IN_BATCH = 2000  # ids per IN (...) clause
+
+
+def _tables(connection):
+    quote = connection.ops.quote_name
+    return {
+        'coborrow': quote(CoBorrow._meta.db_table),
+        'related': quote(RelatedBook._meta.db_table),
+        'position': quote('position'),
+    }
+
+
+def _batches(values, size=IN_BATCH):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def co_borrow_pairs(history, since):
+    """
+    Count co-borrowed book pairs from `history`, an (n, 3) array of (borrow id,
+    user id, book id) rows covering every borrow of the users involved up to
+    the end of the chunk. Only books a user first borrowed after borrow id
+    `since` are paired, so each (user, pair) is counted exactly once over all
+    runs. Returns (book ids, related book ids, counts) arrays.
+    """
+    if not len(history):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    # each user's first borrow of each book, grouped by user
+    history = history[np.lexsort((history[:, 0], history[:, 2], history[:, 1]))]
+    first = np.ones(len(history), dtype=bool)
+    first[1:] = (history[1:, 1] != history[:-1, 1]) | (history[1:, 2] != history[:-1, 2])
+    history = history[first]
+    _, starts = np.unique(history[:, 1], return_index=True)
+
+    keys = []
+    for rows in np.split(history, starts[1:]):
+        is_new = rows[:, 0] > since
+        new, old = rows[is_new, 2], rows[~is_new, 2]
+        if not len(new):
+            continue
+        # new x old in both directions, and new x new without the diagonal
+        left = np.concatenate([np.repeat(new, len(old)), np.tile(old, len(new)), np.repeat(new, len(new))])
+        right = np.concatenate([np.tile(old, len(new)), np.repeat(new, len(old)), np.tile(new, len(new))])
+        distinct = left != right
+        keys.append((left[distinct] << 32) | right[distinct])
+
+    if not keys:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    pairs, counts = np.unique(np.concatenate(keys), return_counts=True)
+    return pairs >> 32, pairs & 0xFFFFFFFF, counts
+
+
+def _add_pairs(books, related, counts, connection):
+    if not len(books):
+        return
+    t = _tables(connection)
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {t['coborrow']} (book_id, related_id, borrowers) VALUES (%s, %s, %s) "
+            f"ON CONFLICT (book_id, related_id) DO UPDATE SET borrowers = {t['coborrow']}.borrowers + excluded.borrowers",
+            list(zip(books.tolist(), related.tolist(), counts.tolist())),
+        )
+
+
+def rank_related(book_ids, top_k=TOP_K, connection=None):
+    """Rebuild the RelatedBook rows of `book_ids` from their CoBorrow rows."""
+    connection = connection or default_connection
+    t = _tables(connection)
+    with connection.cursor() as cursor:
+        for batch in _batches(book_ids):
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute(f"DELETE FROM {t['related']} WHERE book_id IN ({placeholders})", batch)
+            cursor.execute(
+                f"INSERT INTO {t['related']} (book_id, related_id, score, {t['position']}) "
+                f"SELECT book_id, related_id, borrowers, rn FROM ("
+                f"SELECT book_id, related_id, borrowers, "
+                f"ROW_NUMBER() OVER (PARTITION BY book_id ORDER BY borrowers DESC, related_id) AS rn "
+                f"FROM {t['coborrow']} WHERE book_id IN ({placeholders})"
+                f") ranked WHERE rn <= %s",
+                batch + [top_k],
+            )
+
+
+def newest_borrow_id(connection=None):
+    using = (connection or default_connection).alias
+    return Borrow.objects.using(using).aggregate(newest=Max('id'))['newest'] or 0
+
+
+def update_related_books(chunk_size=CHUNK_SIZE, top_k=TOP_K, connection=None, until=None):
+    """
+    Fold borrows made since the last run into CoBorrow and RelatedBook; return
+    how many were processed. Borrows are read up to id `until`, by default the
+    newest id when the previous run started; pass newest_borrow_id() when no
+    borrows can be in flight, e.g. right after seeding.
+    """
+    connection = connection or default_connection
+    with transaction.atomic(using=connection.alias):
+        horizon, _ = JobCheckpoint.objects.select_for_update().get_or_create(name=HORIZON)
+        if until is None:
+            until = horizon.position
+        horizon.position = newest_borrow_id(connection)
+        horizon.save(update_fields=['position', 'updated_at'])
+
+    processed = 0
+    while True:
+        with transaction.atomic(using=connection.alias):
+            checkpoint, _ = JobCheckpoint.objects.select_for_update().get_or_create(name=CHECKPOINT)
+            since = checkpoint.position
+            new = np.array(
+                list(Borrow.objects.filter(id__gt=since, id__lte=until).order_by('id').values_list('id', 'user_id', 'book_id')[:chunk_size]),
+                dtype=np.int64,
+            ).reshape(-1, 3)
+            if not len(new):
+                return processed
+            last = int(new[-1, 0])
+
+            history = [new[:0]]
+            for users in _batches(np.unique(new[:, 1]).tolist()):
+                rows = Borrow.objects.filter(user_id__in=users, id__lte=last).values_list('id', 'user_id', 'book_id')
+                history.append(np.array(list(rows), dtype=np.int64).reshape(-1, 3))
+            books, related, counts = co_borrow_pairs(np.concatenate(history), since)
+
+            _add_pairs(books, related, counts, connection)
+            rank_related(np.unique(books).tolist(), top_k, connection)
+            checkpoint.position = last
+            checkpoint.save(update_fields=['position', 'updated_at'])
+        processed += len(new)
@@ -0,0 +1,149 @@
+"""
+Full-text index over books: name, ISBN, author names and category.
+
+SQLite keeps the index in an FTS5 table and PostgreSQL in a tsvector column
+with a GIN index; other databases fall back to unindexed icontains lookups.
+The index lives in the same database as the books and is updated in the same
+transaction as every write (see signals.py), so it never drifts from them.
+"""
+import re
+
+from django.db import connection as default_connection
+from django.db.models import Q
+
+from .models import Author, Book
+
+
+INDEX_TABLE = 'librarySystem_booksearch'
+BATCH_SIZE = 500
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _tables(connection):
+    quote = connection.ops.quote_name
+    return {
+        'index': quote(INDEX_TABLE),
+        'book': quote(Book._meta.db_table),
+        'book_authors': quote(Book.authors.through._meta.db_table),
+        'author': quote(Author._meta.db_table),
+        'isbn': quote(Book._meta.get_field('ISBN').column),
+    }
+
+
+def create_index(connection):
+    t = _tables(connection)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # rowid is the book id; prefix indexes make "term*" queries cheap
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE {t['index']} USING fts5("
+                "name, isbn, authors, category, "
+                "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+            )
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                f"CREATE TABLE {t['index']} ("
+                f"book_id bigint PRIMARY KEY REFERENCES {t['book']} (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+                "document tsvector NOT NULL)"
+            )
+            cursor.execute(f"CREATE INDEX booksearch_document_idx ON {t['index']} USING GIN (document)")
+
+
+def drop_index(connection):
+    if connection.vendor in ('sqlite', 'postgresql'):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {_tables(connection)['index']}")
+
+
+def index_books(book_ids, connection=None):
+    """(Re)index the given books; ids of deleted books are dropped from the index."""
+    connection = connection or default_connection
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        return
+    t = _tables(connection)
+    book_ids = list(book_ids)
+
+    with connection.cursor() as cursor:
+        for start in range(0, len(book_ids), BATCH_SIZE):
+            batch = book_ids[start:start + BATCH_SIZE]
+            placeholders = ', '.join(['%s'] * len(batch))
+            if connection.vendor == 'sqlite':
+                cursor.execute(f"DELETE FROM {t['index']} WHERE rowid IN ({placeholders})", batch)
+                cursor.execute(
+                    f"INSERT INTO {t['index']} (rowid, name, isbn, authors, category) "
+                    f"SELECT b.id, b.name, b.{t['isbn']}, "
+                    f"COALESCE((SELECT group_concat(a.name, ' ') FROM {t['book_authors']} ba "
+                    f"JOIN {t['author']} a ON a.id = ba.author_id WHERE ba.book_id = b.id), ''), "
+                    f"b.category FROM {t['book']} b WHERE b.id IN ({placeholders})",
+                    batch,
+                )
+            else:
+                cursor.execute(f"DELETE FROM {t['index']} WHERE book_id IN ({placeholders})", batch)
+                cursor.execute(
+                    f"INSERT INTO {t['index']} (book_id, document) "
+                    f"SELECT b.id, "
+                    f"setweight(to_tsvector('simple', b.name), 'A') || "
+                    f"setweight(to_tsvector('simple', b.{t['isbn']}), 'A') || "
+                    f"setweight(to_tsvector('simple', COALESCE((SELECT string_agg(a.name, ' ') FROM {t['book_authors']} ba "
+                    f"JOIN {t['author']} a ON a.id = ba.author_id WHERE ba.book_id = b.id), '')), 'B') || "
+                    f"setweight(to_tsvector('simple', b.category), 'C') "
+                    f"FROM {t['book']} b WHERE b.id IN ({placeholders})",
+                    batch,
+                )
+
+
+def rebuild_index(connection=None):
+    connection = connection or default_connection
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {_tables(connection)['index']}")
+    ids = Book.objects.using(connection.alias).values_list('id', flat=True).order_by('id')
+    batch = []
+    for book_id in ids.iterator(chunk_size=BATCH_SIZE):
+        batch.append(book_id)
+        if len(batch) == BATCH_SIZE:
+            index_books(batch, connection)
+            batch = []
+    index_books(batch, connection)
+
+
+def search_books(query, limit=20, connection=None):
+    """
+    Return ids of books matching every word of `query` (each as a prefix),
+    best matches first.
+    """
+    connection = connection or default_connection
+    tokens = _TOKEN_RE.findall(query.lower())
+    if not tokens:
+        return []
+    t = _tables(connection)
+
+    if connection.vendor == 'sqlite':
+        # name and ISBN matches outrank author matches, which outrank categories
+        match = ' '.join('"%s"*' % token.replace('"', '""') for token in tokens)
+        sql = (
+            f"SELECT rowid FROM {t['index']} WHERE {t['index']} MATCH %s "
+            f"ORDER BY bm25({t['index']}, 10.0, 10.0, 5.0, 1.0), rowid LIMIT %s"
+        )
+        params = [match, limit]
+    elif connection.vendor == 'postgresql':
+        match = ' & '.join('%s:*' % token for token in tokens)
+        sql = (
+            f"SELECT book_id FROM {t['index']}, to_tsquery('simple', %s) query "
+            f"WHERE document @@ query ORDER BY ts_rank(document, query) DESC, book_id LIMIT %s"
+        )
+        params = [match, limit]
+    else:
+        books = Book.objects.all()
+        for token in tokens:
+            books = books.filter(
+                Q(name__icontains=token) | Q(ISBN__icontains=token)
+                | Q(category__icontains=token) | Q(authors__name__icontains=token)
+            )
+        return list(books.values_list('id', flat=True).distinct().order_by('name', 'id')[:limit])
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,84 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
+from django.dispatch import receiver
+
+from . import geo, search
+from .authentication import forget_user
+from .caching import CATALOG_MODELS, bump_version
+from .models import Author, Book, LibraryBranch, User
+
+
+# Catalog versions are bumped once the write commits, so no process can cache
+# a response computed from data that is about to change under the new version.
+@receiver(post_save)
+def catalog_saved(sender, instance, **kwargs):
+    if sender is LibraryBranch:
+        values = (instance.id, instance.library_id, instance.location_lat, instance.location_long)
+        transaction.on_commit(lambda: geo.branch_saved(*values, bump_version(LibraryBranch)))
+    elif sender in CATALOG_MODELS:
+        transaction.on_commit(lambda: bump_version(sender))
+
+
+@receiver(post_delete)
+def catalog_deleted(sender, instance, **kwargs):
+    if sender is LibraryBranch:
+        branch_id = instance.id  # cleared on the instance once the delete finishes
+        transaction.on_commit(lambda: geo.branch_deleted(branch_id, bump_version(LibraryBranch)))
+    elif sender in CATALOG_MODELS:
+        transaction.on_commit(lambda: bump_version(sender))
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+def book_authors_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(lambda: (bump_version(Book), bump_version(Author)))
+
+
+# Cached authentication snapshots (authentication.py) are dropped right away,
+# and again once the change commits in case a concurrent request re-cached the
+# old row in between.
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_cached_user(sender, instance, **kwargs):
+    user_id = instance.pk  # cleared on the instance once a delete finishes
+    forget_user(user_id)
+    transaction.on_commit(lambda: forget_user(user_id))
+
+
+# The search index is written in the same transaction as the books it covers.
+@receiver(post_save, sender=Book)
+def index_saved_book(sender, instance, **kwargs):
+    search.index_books([instance.id])
+
+
+@receiver(post_delete, sender=Book)
+def unindex_deleted_book(sender, instance, **kwargs):
+    search.index_books([instance.id])  # no longer exists, so it is only removed
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+def reindex_book_authors(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # pk_set is not provided for clear(); remember which books lose the author
+        instance._search_book_ids = list(instance.books.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        search.index_books(pk_set if reverse else [instance.id])
+    elif action == 'post_clear':
+        search.index_books(instance.__dict__.pop('_search_book_ids', []) if reverse else [instance.id])
+
+
+@receiver(post_save, sender=Author)
+def reindex_renamed_author(sender, instance, created, **kwargs):
+    if not created:
+        search.index_books(instance.books.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Author)
+def remember_author_books(sender, instance, **kwargs):
+    # the author's book links are gone by post_delete
+    instance._search_book_ids = list(instance.books.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+def reindex_author_books(sender, instance, **kwargs):
+    search.index_books(instance.__dict__.pop('_search_book_ids', []))
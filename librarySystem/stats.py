@@ -0,0 +1,74 @@
+"""
+Circulation rollups.
+
+CirculationStat holds one row per (dimension, day, key) with the number of
+borrows and returns on that day: per book category, per library (of the
+branch the copy came from) and per author. Borrow and return views call
+`record_borrows` / `record_returns` in their transaction; each is a single
+INSERT ... SELECT ... GROUP BY ... ON CONFLICT DO UPDATE statement that adds
+the new rows' counts to their buckets. `rebuild` recomputes every bucket from
+the Borrow history, for backfills and after bulk edits.
+"""
+from django.db import connection as default_connection, transaction
+
+from .models import Book, Borrow, CirculationStat, LibraryBranch
+
+
+def _tables(connection):
+    quote = connection.ops.quote_name
+    return {
+        'stat': quote(CirculationStat._meta.db_table),
+        'key': quote('key'),
+        'borrow': quote(Borrow._meta.db_table),
+        'book': quote(Book._meta.db_table),
+        'branch': quote(LibraryBranch._meta.db_table),
+        'book_authors': quote(Book.authors.through._meta.db_table),
+    }
+
+
+def _rollup(counter, where, params, connection):
+    """Add the borrows matching `where` to `counter` ('borrows' or 'returns') of their buckets."""
+    t = _tables(connection)
+    # borrows count on the day they were made, returns on the day they came back
+    day = 'br.borrow_date' if counter == 'borrows' else 'br.return_date'
+    buckets = {
+        'category': ('bk.category', f"JOIN {t['book']} bk ON bk.id = br.book_id"),
+        'library': ('CAST(lb.library_id AS text)', f"JOIN {t['branch']} lb ON lb.id = br.library_branch_id"),
+        'author': ('CAST(ba.author_id AS text)', f"JOIN {t['book_authors']} ba ON ba.book_id = br.book_id"),
+    }
+    selects = ' UNION ALL '.join(
+        f"SELECT {day} AS day, '{dimension}' AS dimension, {key} AS bucket, COUNT(*) AS total "
+        f"FROM {t['borrow']} br {join} WHERE {where} GROUP BY {day}, {key}"
+        for dimension, (key, join) in buckets.items()
+    )
+    borrows, returns = ('total', '0') if counter == 'borrows' else ('0', 'total')
+
+    with connection.cursor() as cursor:
+        # the WHERE on the outer SELECT keeps SQLite from reading ON CONFLICT as a join clause
+        cursor.execute(
+            f"INSERT INTO {t['stat']} (day, dimension, {t['key']}, borrows, returns) "
+            f"SELECT day, dimension, bucket, {borrows}, {returns} FROM ({selects}) rollup WHERE true "
+            f"ON CONFLICT (dimension, day, {t['key']}) DO UPDATE SET {counter} = {t['stat']}.{counter} + excluded.{counter}",
+            params * len(buckets),
+        )
+
+
+def record_borrows(borrow_ids, connection=None):
+    borrow_ids = list(borrow_ids)
+    if borrow_ids:
+        _rollup('borrows', f"br.id IN ({', '.join(['%s'] * len(borrow_ids))})", borrow_ids, connection or default_connection)
+
+
+def record_returns(borrow_ids, connection=None):
+    borrow_ids = list(borrow_ids)
+    if borrow_ids:
+        _rollup('returns', f"br.id IN ({', '.join(['%s'] * len(borrow_ids))})", borrow_ids, connection or default_connection)
+
+
+def rebuild(connection=None):
+    """Recompute every bucket from the full Borrow history."""
+    connection = connection or default_connection
+    with transaction.atomic(using=connection.alias):
+        CirculationStat.objects.using(connection.alias).all().delete()
+        _rollup('borrows', 'br.borrow_date IS NOT NULL', [], connection)
+        _rollup('returns', 'br.return_date IS NOT NULL', [], connection)
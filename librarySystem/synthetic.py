@@ -0,0 +1,345 @@
+"""
+Synthetic datasets for capacity tests.
+
+`SyntheticDataset` fills the database with libraries, branches, authors,
+books, stock, users and a borrow history shaped like real circulation rather
+than uniform noise:
+
+- libraries cluster in a few cities, big cities getting more of them, and
+  their branches sit around the library's centre;
+- a few prolific authors write most books (Zipf), and each writes mostly in
+  one category;
+- book popularity is Zipf distributed: popular books are stocked at more
+  branches with more copies, and take most of the borrows;
+- user activity is log-normal, so most users borrow a little and a few a lot;
+- borrows grow over the history and peak at weekends; loans are 1 to 4 weeks
+  and about a fifth come back late, some of them very late;
+- borrows still out today respect the stock and every user's max_borrows, and
+  stock counts and User.active_borrows match them.
+
+Everything is generated with NumPy from one seed, so the same options always
+produce the same dataset. Rows are written with bulk_create in batches, which
+bypasses model signals, so the derived data is rebuilt at the end the way the
+maintenance commands do: the search index, the circulation stats, the penalty
+ledger and totals, the "also borrowed" recommendations, and the catalog
+versions that invalidate cached responses.
+
+Every username, library name and ISBN starts with the dataset's `prefix`, and
+every user's password is `password`, which is what the load test logs in with.
+"""
+from datetime import timedelta
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.utils.timezone import now
+from rest_framework.authtoken.models import Token
+
+from . import penalties, recommendations, search, stats
+from .caching import bump_version
+from .models import Author, Book, BookStock, Borrow, Library, LibraryBranch, PenaltyAccrual, User
+
+
+PREFIX = 'syn'
+PASSWORD = 'Synthetic-Pass-1'
+BATCH_SIZE = 5000
+
+# name, lat, long, relative size
+CITIES = [
+    ('New York', 40.71, -74.01, 10), ('London', 51.51, -0.13, 9), ('Tokyo', 35.68, 139.69, 9),
+    ('Paris', 48.86, 2.35, 6), ('Chicago', 41.88, -87.63, 5), ('Berlin', 52.52, 13.40, 4),
+    ('Toronto', 43.65, -79.38, 3), ('Sydney', -33.87, 151.21, 3), ('Mumbai', 19.08, 72.88, 3),
+    ('Sao Paulo', -23.55, -46.63, 2), ('Nairobi', -1.29, 36.82, 1), ('Oslo', 59.91, 10.75, 1),
+]
+CATEGORIES = [
+    'Fiction', 'Mystery', 'Romance', 'Fantasy', 'Science Fiction', 'Biography', 'History', 'Children',
+    'Young Adult', 'Thriller', 'Cooking', 'Travel', 'Science', 'Poetry', 'Philosophy', 'Art', 'Business',
+    'Health', 'Religion', 'Reference',
+]
+FIRST_NAMES = [
+    'Ada', 'Alan', 'Amara', 'Ana', 'Arjun', 'Beatrix', 'Carlos', 'Chen', 'Clara', 'Daniel', 'Dara', 'Elena',
+    'Emeka', 'Farah', 'Gabriel', 'Hana', 'Hugo', 'Ines', 'Isaac', 'Jonas', 'Julia', 'Kenji', 'Lena', 'Liam',
+    'Lucia', 'Malik', 'Maya', 'Mei', 'Nadia', 'Nikolai', 'Omar', 'Priya', 'Rafael', 'Rosa', 'Samuel', 'Sara',
+    'Sofia', 'Tomas', 'Yara', 'Zoe',
+]
+LAST_NAMES = [
+    'Abara', 'Andersen', 'Baptiste', 'Becker', 'Castillo', 'Chandra', 'Costa', 'Dubois', 'Eriksen', 'Fischer',
+    'Garcia', 'Haddad', 'Hughes', 'Ibrahim', 'Ito', 'Jansen', 'Kaur', 'Kim', 'Kowalski', 'Larsen', 'Lopez',
+    'Mbeki', 'Moreau', 'Murphy', 'Nakamura', 'Novak', 'Okafor', 'Oliveira', 'Park', 'Petrov', 'Quinn', 'Rossi',
+    'Sato', 'Schmidt', 'Silva', 'Tanaka', 'Varga', 'Walsh', 'Weber', 'Zhang',
+]
+WORDS = [
+    'Shadow', 'River', 'Garden', 'Silent', 'Winter', 'Empire', 'Night', 'Stone', 'Light', 'Secret', 'House',
+    'Fire', 'Glass', 'Ocean', 'Storm', 'Memory', 'Crown', 'Forest', 'Iron', 'Summer', 'Letters', 'Journey',
+    'Island', 'Kingdom', 'Mirror', 'North', 'Road', 'Star', 'Winds', 'Harbor', 'Lost', 'Golden', 'Hidden',
+    'Last', 'Broken', 'Wild', 'Quiet', 'Bright', 'Paper', 'City', 'Mountain', 'Songs', 'Bridge', 'Dreams',
+    'Machine', 'Tide', 'Orchard', 'Lantern', 'Atlas', 'Compass',
+]
+STREETS = ['Main', 'Park', 'Oak', 'Maple', 'Cedar', 'Elm', 'Lake', 'Hill', 'Church', 'Market', 'Mill', 'Station']
+LOANS = ([7, 14, 21, 28], [0.15, 0.45, 0.2, 0.2])  # loan length in days, and how often it is chosen
+MAX_BORROWS = ([3, 5, 10], [0.7, 0.2, 0.1])
+
+
+def zipf_weights(n, exponent, rng=None):
+    """Probabilities proportional to 1 / rank**exponent, shuffled over the n items when `rng` is given."""
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    if rng is not None:
+        weights = rng.permutation(weights)
+    return weights / weights.sum()
+
+
+class SyntheticDataset:
+    def __init__(self, libraries=20, branches=3, authors=2000, books=20000, users=5000, borrows=50000,
+                 days=365, seed=0, prefix=PREFIX, password=PASSWORD, batch_size=BATCH_SIZE):
+        self.libraries = libraries
+        self.branches = branches  # per library, on average
+        self.authors = authors
+        self.books = books
+        self.users = users
+        self.borrows = borrows
+        self.days = days
+        self.prefix = prefix
+        self.password = password
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.today = now().date()
+
+    def exists(self):
+        return User.objects.filter(username=f'{self.prefix}-admin').exists()
+
+    def run(self, progress=None):
+        """Generate and write the dataset; call `progress(stage, counts)` with the counts of each stage."""
+        totals = {}
+        for stage in (self.write_branches, self.write_books, self.write_users, self.write_borrows, self.rebuild_derived):
+            counts = stage()
+            totals.update(counts)
+            if progress:
+                progress(stage.__name__.split('_', 1)[1], counts)
+        return totals
+
+    def _bulk_create(self, model, objects, **kwargs):
+        created = []
+        for start in range(0, len(objects), self.batch_size):
+            created += model.objects.bulk_create(objects[start:start + self.batch_size], **kwargs)
+        return created
+
+    def write_branches(self):
+        rng = self.rng
+        sizes = np.array([city[3] for city in CITIES], dtype=float)
+        self.city_weights = sizes / sizes.sum()
+        cities = rng.choice(len(CITIES), self.libraries, p=self.city_weights)
+
+        libraries, branches, centres = [], [], []
+        for number, city in enumerate(cities, 1):
+            name, lat, long, _ = CITIES[city]
+            libraries.append(Library(name=f'{self.prefix} {name} Library {number}'))
+            centres.append((city, lat + rng.normal(0, 0.1), long + rng.normal(0, 0.1)))
+        with transaction.atomic():
+            libraries = self._bulk_create(Library, libraries)
+            for library, (city, lat, long) in zip(libraries, centres):
+                for number in range(1 + rng.poisson(max(self.branches - 1, 0))):
+                    branches.append(LibraryBranch(
+                        library=library,
+                        location_lat=round(float(lat + rng.normal(0, 0.03)), 6),
+                        location_long=round(float(long + rng.normal(0, 0.03)), 6),
+                        address=f'{rng.integers(1, 1000)} {STREETS[rng.integers(len(STREETS))]} St, {CITIES[city][0]}',
+                    ))
+            branches = self._bulk_create(LibraryBranch, branches)
+        self.branch_ids = np.array([branch.id for branch in branches], dtype=np.int64)
+        return {'libraries': len(libraries), 'branches': len(branches)}
+
+    def _author_names(self):
+        rng = self.rng
+        names = set()
+        while len(names) < self.authors:
+            first, last = FIRST_NAMES[rng.integers(len(FIRST_NAMES))], LAST_NAMES[rng.integers(len(LAST_NAMES))]
+            name = f'{first} {last}'
+            if name in names:  # the plain combinations run out after a few hundred authors
+                name = f'{first} {chr(65 + rng.integers(26))}. {last}'
+            if name in names:
+                name = f'{name} {len(names)}'
+            names.add(name)
+        return sorted(names)
+
+    def _title(self):
+        rng = self.rng
+        words = [WORDS[i] for i in rng.choice(len(WORDS), rng.integers(1, 4), replace=False)]
+        if rng.random() < 0.4:
+            words.insert(0, 'The')
+        return ' '.join(words)
+
+    def write_books(self):
+        rng = self.rng
+        names = self._author_names()
+        category_weights = zipf_weights(len(CATEGORIES), 1.0)
+        home_category = rng.choice(len(CATEGORIES), len(names), p=category_weights)
+
+        # prolific authors write most books; a tenth of books have a co-author
+        primary = rng.choice(len(names), self.books, p=zipf_weights(len(names), 1.0, rng))
+        co_author = np.where(rng.random(self.books) < 0.1, rng.integers(0, len(names), self.books), -1)
+        category = np.where(
+            rng.random(self.books) < 0.7, home_category[primary], rng.choice(len(CATEGORIES), self.books, p=category_weights),
+        )
+
+        # popular books are stocked at more branches, with more copies
+        self.popularity = zipf_weights(self.books, 0.8, rng)
+        heat = self.popularity / self.popularity.max()
+        branch_count = np.minimum(1 + rng.poisson(1 + 8 * np.sqrt(heat)), len(self.branch_ids))
+
+        with transaction.atomic():
+            # names shared with an existing catalog are reused
+            Author.objects.bulk_create([Author(name=name) for name in names], ignore_conflicts=True, batch_size=self.batch_size)
+            author_ids = {}
+            for start in range(0, len(names), self.batch_size):
+                batch = names[start:start + self.batch_size]
+                author_ids.update(Author.objects.filter(name__in=batch).values_list('name', 'id'))
+            author_ids = np.array([author_ids[name] for name in names], dtype=np.int64)
+
+            books = self._bulk_create(Book, [
+                Book(ISBN=f'{self.prefix}-{number:010d}', name=self._title(), category=CATEGORIES[category[number]])
+                for number in range(self.books)
+            ])
+            self.book_ids = np.array([book.id for book in books], dtype=np.int64)
+
+            Through = Book.authors.through
+            self._bulk_create(Through, [
+                Through(book_id=book_id, author_id=author_ids[author])
+                for book_id, author, other in zip(self.book_ids.tolist(), primary, co_author)
+                for author in ((author, other) if other >= 0 and other != author else (author,))
+            ])
+
+            stock_book, stock_branch = [], []
+            for book, count in enumerate(branch_count):
+                stock_book.append(np.full(count, book))
+                stock_branch.append(rng.choice(len(self.branch_ids), count, replace=False))
+            self.stock_book = np.concatenate(stock_book)
+            self.stock_branch = np.concatenate(stock_branch)
+            self.stock_copies = 1 + rng.poisson(1 + 3 * heat[self.stock_book])
+            # a book's stock rows are contiguous: starts[book] .. starts[book] + branch_count[book]
+            self.stock_starts = np.concatenate([[0], np.cumsum(branch_count)[:-1]])
+            self.branch_count = branch_count
+
+            search.index_books(self.book_ids.tolist())
+        return {'authors': len(names), 'books': len(books)}
+
+    def write_users(self):
+        rng = self.rng
+        cities = rng.choice(len(CITIES), self.users, p=self.city_weights)
+        self.max_borrows = rng.choice(MAX_BORROWS[0], self.users, p=MAX_BORROWS[1])
+        password = make_password(self.password)  # one PBKDF2 hash, shared by every user
+
+        with transaction.atomic():
+            users = self._bulk_create(User, [
+                User(
+                    username=f'{self.prefix}-user-{number}', email=f'{self.prefix}-user-{number}@example.com',
+                    password=password, max_borrows=int(self.max_borrows[number]),
+                    location_lat=round(float(CITIES[city][1] + rng.normal(0, 0.15)), 6),
+                    location_long=round(float(CITIES[city][2] + rng.normal(0, 0.15)), 6),
+                )
+                for number, city in enumerate(cities)
+            ] + [User(username=f'{self.prefix}-admin', email=f'{self.prefix}-admin@example.com', password=password, is_staff=True)])
+            # bulk_create skips Token.save(), which is what generates the key
+            self._bulk_create(Token, [Token(key=Token.generate_key(), user=user) for user in users])
+        self.user_ids = np.array([user.id for user in users[:-1]], dtype=np.int64)
+        return {'users': len(users)}
+
+    def _history(self):
+        """Draw the borrows as arrays: (user, stock row, days ago borrowed, loan days, days kept), oldest first."""
+        rng, n = self.rng, self.borrows
+        user = rng.choice(self.users, n, p=self._activity())
+        book = rng.choice(self.books, n, p=self.popularity)
+        row = self.stock_starts[book] + (rng.random(n) * self.branch_count[book]).astype(np.int64)
+
+        # more borrowing lately, and at weekends
+        days_ago = np.arange(self.days)
+        weekday = np.array([(self.today - timedelta(days=int(d))).weekday() for d in days_ago])
+        day_weights = (1.5 - 0.5 * days_ago / self.days) * np.where(weekday >= 5, 1.4, 1.0)
+        borrowed = rng.choice(self.days, n, p=day_weights / day_weights.sum())
+
+        loan = rng.choice(LOANS[0], n, p=LOANS[1])
+        kept = np.maximum(loan + np.round(rng.normal(-3, 4, n)).astype(np.int64), 1)
+        very_late = rng.random(n) < 0.05
+        kept[very_late] += np.ceil(rng.exponential(20, very_late.sum())).astype(np.int64)
+
+        order = np.argsort(-borrowed, kind='stable')
+        return user[order], row[order], borrowed[order], loan[order], kept[order]
+
+    def _activity(self):
+        weights = self.rng.lognormal(0, 1.0, self.users)
+        return weights / weights.sum()
+
+    def write_borrows(self):
+        user, row, borrowed, loan, kept = self._history()
+        returned = borrowed - kept  # days ago; negative means still out
+        keep = np.ones(len(user), dtype=bool)
+
+        # what is still out must fit the stock and each user's quota; the rest came back
+        open_by_user = np.zeros(self.users, dtype=np.int64)
+        open_by_row = np.zeros(len(self.stock_book), dtype=np.int64)
+        open_pairs = set()
+        for i in np.flatnonzero(returned < 0):
+            pair = (user[i], self.stock_book[row[i]])
+            if open_by_user[user[i]] < self.max_borrows[user[i]] and open_by_row[row[i]] < self.stock_copies[row[i]] \
+                    and pair not in open_pairs:
+                open_by_user[user[i]] += 1
+                open_by_row[row[i]] += 1
+                open_pairs.add(pair)
+            elif borrowed[i] > 0:
+                returned[i] = self.rng.integers(0, borrowed[i])
+            else:
+                keep[i] = False  # borrowed today and nothing to take it from
+        user, row, borrowed, loan, returned = user[keep], row[keep], borrowed[keep], loan[keep], returned[keep]
+
+        user_ids = self.user_ids[user].tolist()
+        book_ids = self.book_ids[self.stock_book[row]].tolist()
+        branch_ids = self.branch_ids[self.stock_branch[row]].tolist()
+        today = self.today
+        late = []  # (borrow, user, days late, returned on) of late returns
+        with transaction.atomic():
+            for start in range(0, len(user_ids), self.batch_size):
+                stop = start + self.batch_size
+                borrows = Borrow.objects.bulk_create([
+                    Borrow(
+                        user_id=user_ids[i], book_id=book_ids[i], library_branch_id=branch_ids[i],
+                        borrow_date=today - timedelta(days=int(borrowed[i])),
+                        expected_return_date=today - timedelta(days=int(borrowed[i] - loan[i])),
+                        return_date=today - timedelta(days=int(returned[i])) if returned[i] >= 0 else None,
+                    )
+                    for i in range(start, min(stop, len(user_ids)))
+                ])
+                late += [
+                    (borrow.id, borrow.user_id, (borrow.return_date - borrow.expected_return_date).days, borrow.return_date)
+                    for borrow in borrows if borrow.return_date and borrow.return_date > borrow.expected_return_date
+                ]
+
+            # late returns left final penalties at the default rate, as return_book records them
+            penalty = User._meta.get_field('penalty_amount').default
+            self._bulk_create(PenaltyAccrual, [
+                PenaltyAccrual(borrow_id=borrow_id, user_id=user_id, days_overdue=days, amount=days * penalty,
+                               accrued_on=returned_on, final=True)
+                for borrow_id, user_id, days, returned_on in late
+            ])
+
+            stock = self._bulk_create(BookStock, [
+                BookStock(book_id=book_id, library_branch_id=branch_id, count=count)
+                for book_id, branch_id, count in zip(
+                    self.book_ids[self.stock_book].tolist(), self.branch_ids[self.stock_branch].tolist(),
+                    (self.stock_copies - open_by_row).tolist(),
+                )
+            ])
+            for count in np.unique(open_by_user[open_by_user > 0]):
+                ids = self.user_ids[open_by_user == count].tolist()
+                for start in range(0, len(ids), self.batch_size):
+                    User.objects.filter(pk__in=ids[start:start + self.batch_size]).update(active_borrows=int(count))
+        return {'stock': len(stock), 'borrows': len(user_ids), 'open_borrows': int(open_by_user.sum()), 'late_returns': len(late)}
+
+    def rebuild_derived(self):
+        stats.rebuild()
+        penalties.accrue_penalties(self.today)
+        # the final penalties of late returns count towards the totals too
+        penalties.refresh_totals(User.objects.filter(username__startswith=f'{self.prefix}-user-').values('id'))
+        # nothing else writes borrows while seeding, so all of them can be read
+        related = recommendations.update_related_books(until=recommendations.newest_borrow_id())
+        for model in (Library, LibraryBranch, Author, Book, BookStock):
+            bump_version(model)
+        return {'related_borrows': related}
@@ -0,0 +1,93 @@
+from datetime import timedelta
+
+from celery import shared_task
+from django.db import transaction
+from django.db.models import F
+from django.utils.timezone import now
+
+from . import outbox, penalties, recommendations
+from .models import Borrow, BorrowReminder, EmailOutbox
+
+
+REMINDER_DAYS = 3  # remind daily from this many days before the due date
+
+
+@shared_task
+def drain_email_outbox(batch_size=100, max_batches=50):
+    """Send queued emails, a batch at a time, until the outbox is drained."""
+    total = 0
+    for _ in range(max_batches):
+        sent = outbox.deliver_pending(batch_size)
+        total += sent
+        if sent < batch_size:
+            break
+    return total
+
+
+@shared_task
+def send_due_reminders(batch_size=1000):
+    """
+    Daily sweep: queue a reminder for every open borrow due within
+    REMINDER_DAYS days. Each borrow is marked once per day in the same
+    transaction as its email, and batches lock their borrows before checking
+    the marks, so neither a re-run nor an overlapping run sends a second
+    reminder.
+    """
+    today = now().date()
+    due = (
+        Borrow.objects.filter(
+            return_date__isnull=True,
+            expected_return_date__range=(today, today + timedelta(days=REMINDER_DAYS)),
+        )
+        .exclude(reminders__sent_on=today)
+        .select_related('user', 'book')
+        .order_by('id')
+    )
+
+    queued = 0
+    batch = []
+    for borrow in due.iterator(chunk_size=batch_size):
+        batch.append(borrow)
+        if len(batch) == batch_size:
+            queued += _queue_reminders(batch, today)
+            batch = []
+    if batch:
+        queued += _queue_reminders(batch, today)
+    return queued
+
+
+def _queue_reminders(borrows, today):
+    with transaction.atomic():
+        # Lock the batch's borrows (a no-op UPDATE, like lock_user, so SQLite takes its write
+        # lock too), then keep those still open and not reminded today: of overlapping runs,
+        # only the first to lock a borrow queues its email
+        ids = [borrow.id for borrow in borrows]
+        Borrow.objects.filter(pk__in=ids).update(return_date=F('return_date'))
+        unclaimed = set(
+            Borrow.objects.filter(pk__in=ids, return_date__isnull=True).exclude(reminders__sent_on=today).values_list('id', flat=True)
+        )
+        borrows = [borrow for borrow in borrows if borrow.id in unclaimed]
+        BorrowReminder.objects.bulk_create([BorrowReminder(borrow=borrow, sent_on=today) for borrow in borrows])
+        emails = [
+            EmailOutbox(
+                subject='Book Return Reminder',
+                body=f'Dear {borrow.user.username},\n\nThis is a reminder that your borrowed book "{borrow.book.name}" is due on {borrow.expected_return_date}. Please return it on time to avoid penalties.\n\nThank you!',
+                from_email=outbox.DEFAULT_FROM_EMAIL,
+                recipient=borrow.user.email,
+            )
+            for borrow in borrows if borrow.user.email
+        ]
+        EmailOutbox.objects.bulk_create(emails)
+    return len(emails)
+
+
+@shared_task
+def accrue_penalties():
+    """Nightly: bring the penalty ledger and totals up to date for every overdue borrow."""
+    return penalties.accrue_penalties()
+
+
+@shared_task
+def update_related_books():
+    """Fold new borrows into the co-borrow matrix and refresh the affected "also borrowed" lists."""
+    return recommendations.update_related_books()
@@ -1,11 +1,41 @@
-from django.test import TestCase
+import json
+import os
+import random
+import tempfile
+from io import StringIO
+from unittest import mock
+import threading
+import time
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.http import http_date
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework import status
 from django.utils.timezone import now, timedelta
-from librarySystem.models import User, Library, LibraryBranch, Author, Book, BookStock, Borrow
+from librarySystem import catalog_import, penalties, recommendations, search, tasks
+from librarySystem.caching import bump_version, get_or_compute, make_key
+from librarySystem.geo import BranchIndex, bounding_box, haversine_km
+from librarySystem.loadtest import MIX
+from librarySystem.models import User, Library, LibraryBranch, Author, Book, BookStock, Borrow, BorrowReminder, CirculationStat, CoBorrow, EmailOutbox, PenaltyAccrual, RelatedBook
+from librarySystem.outbox import queue_email
+from librarySystem.throttling import take_tokens
+from librarySystem.tasks import accrue_penalties, drain_email_outbox, send_due_reminders
+from librarySystem.urls import urlpatterns
+from librarySystem.views.base import stream_json_array
+from librarySystem.views.borrows import reserve_copy, return_book
+from librarySystem.views.library import BookSerializer
 
 class LibrarySystemTestCase(TestCase):
     def setUp(self):
+        cache.clear()
         self.client = APIClient()
         self.user_data = {
             'username': 'testuser',
@@ -32,6 +62,7 @@ class LibrarySystemTestCase(TestCase):
         self.book_stock = BookStock.objects.create(book=self.book, library_branch=self.branch, count=10)
         self.borrow_data = {
             'book': self.book.id,
+            'library_branch': self.branch.id,
             'expected_return_date': (now().date() + timedelta(days=30)).isoformat()
         }
 
@@ -67,28 +98,113 @@ class LibrarySystemTestCase(TestCase):
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
         response = self.client.get('/api/libraries/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertGreater(len(response.data), 0)
+        self.assertGreater(len(response.data['results']), 0)
 
     def test_browse_authors(self):
         self.test_login_user()
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
         response = self.client.get('/api/authors/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertGreater(len(response.data), 0)
+        self.assertGreater(len(response.data['results']), 0)
 
     def test_browse_books(self):
         self.test_login_user()
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
         response = self.client.get('/api/books/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertGreater(len(response.data), 0)
+        self.assertGreater(len(response.data['results']), 0)
 
     def test_browse_loaded_authors(self):
         self.test_login_user()
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
         response = self.client.get('/api/authors/full')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertGreater(len(response.data), 0)
+        self.assertGreater(len(response.data['results']), 0)
+
+    def test_catalog_filters_return_each_row_once(self):
+        second_branch = LibraryBranch.objects.create(library=self.library, location_lat=40.0, location_long=-74.0, address="2 Library St")
+        book = Book.objects.create(ISBN="67890", name="Book Two", category="Fiction")
+        book.authors.add(self.author)
+        BookStock.objects.create(book=book, library_branch=self.branch, count=1)
+        BookStock.objects.create(book=book, library_branch=second_branch, count=1)
+
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        response = self.client.get('/api/libraries/', {'category': 'Fiction', 'author': 'Author One'})
+        self.assertEqual([(l['name'], l['num_branches']) for l in response.data['results']], [("Central Library", 2)])
+        # no library matches, so there are no branches to measure distances to
+        response = self.client.get('/api/libraries/', {'category': 'Poetry'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [])
+
+        response = self.client.get('/api/authors/', {'library': 'Central Library', 'category': 'Fiction'})
+        self.assertEqual(response.data['results'], [{'name': 'Author One', 'book_count': 2}])
+
+        response = self.client.get('/api/books/', {'library': 'Central Library'})
+        self.assertEqual([b['ISBN'] for b in response.data['results']], ["12345", "67890"])
+
+        response = self.client.get('/api/authors/full', {'library': 'Central Library', 'category': 'Fiction'})
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(len(response.data['results'][0]['books']), 2)
+
+    def test_stream_catalog(self):
+        for i in range(4):
+            book = Book.objects.create(ISBN=f"2000{i}", name=f"Book {i}", category="Fiction")
+            book.authors.add(self.author)
+
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        response = self.client.get('/api/books/', {'stream': 'true'})
+        self.assertTrue(response.streaming)
+        books = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([book['ISBN'] for book in books], ["12345", "20000", "20001", "20002", "20003"])
+        self.assertEqual(books[0]['authors'], [{'name': 'Author One'}])
+
+        response = self.client.get('/api/authors/full', {'stream': '1'})
+        authors = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(authors[0]['books']), 5)
+
+        response = stream_json_array(Book.objects.prefetch_related('authors').order_by('ISBN'), BookSerializer, chunk_size=2)
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), books)
+
+    def test_book_search(self):
+        other = Book.objects.create(ISBN="99999", name="Gardening", category="Book Club")
+        Author.objects.create(name="Booker Prize").books.add(other)
+
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        response = self.client.get('/api/books/search', {'q': 'boo'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # title match first, author and category match after it
+        self.assertEqual([book['ISBN'] for book in response.data], ["12345", "99999"])
+
+        response = self.client.get('/api/books/search', {'q': 'author on'})
+        self.assertEqual([book['ISBN'] for book in response.data], ["12345"])
+
+        self.author.name = "Renamed Writer"
+        self.author.save()
+        response = self.client.get('/api/books/search', {'q': 'renamed'})
+        self.assertEqual([book['ISBN'] for book in response.data], ["12345"])
+
+        self.book.delete()
+        response = self.client.get('/api/books/search', {'q': 'book'})
+        self.assertEqual([book['ISBN'] for book in response.data], ["99999"])
+
+    def test_books_cursor_pagination(self):
+        for i in range(4):
+            Book.objects.create(ISBN=f"2000{i}", name=f"Book {i}", category="Fiction")
+
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        isbns = []
+        url = '/api/books/?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 2)
+            isbns += [book['ISBN'] for book in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(isbns, sorted(Book.objects.values_list('ISBN', flat=True)))
 
     def test_borrow_book(self):
         self.test_login_user()
@@ -103,4 +219,1147 @@ class LibrarySystemTestCase(TestCase):
         return_data = {'book': self.book.id}
         response = self.client.post('/api/return/', return_data, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertIn('message', response.data)
\ No newline at end of file
+        self.assertIn('message', response.data)
+
+    def test_borrow_email_goes_through_outbox(self):
+        self.test_borrow_book()
+        self.assertEqual(mail.outbox, [])
+        queued = EmailOutbox.objects.get()
+        self.assertEqual(queued.recipient, 'testuser@example.com')
+
+        self.assertEqual(drain_email_outbox(), 1)
+        self.assertEqual([message.subject for message in mail.outbox], ['Book Borrowed Successfully'])
+        self.assertEqual(mail.outbox[0].to, ['testuser@example.com'])
+        queued.refresh_from_db()
+        self.assertIsNotNone(queued.sent_at)
+        self.assertEqual(drain_email_outbox(), 0)
+
+    def test_outbox_backs_off_when_mail_server_is_down(self):
+        queue_email('Subject', 'Body', 'reader@example.com')
+        with mock.patch('librarySystem.outbox.get_connection') as get_connection:
+            get_connection.return_value.open.side_effect = ConnectionRefusedError("SMTP down")
+            self.assertEqual(drain_email_outbox(), 0)
+
+        queued = EmailOutbox.objects.get()
+        self.assertEqual(queued.attempts, 1)
+        self.assertIsNone(queued.sent_at)
+        self.assertGreater(queued.next_attempt_at, now())
+        self.assertEqual(drain_email_outbox(), 0)  # not due again yet
+
+        EmailOutbox.objects.update(next_attempt_at=now())
+        self.assertEqual(drain_email_outbox(), 1)
+
+    def test_due_reminders_are_sent_once_per_day(self):
+        user = User.objects.get(username='testuser')
+        today = now().date()
+        due_soon = Borrow.objects.create(user=user, book=self.book, borrow_date=today, expected_return_date=today + timedelta(days=2))
+        Borrow.objects.create(user=user, book=self.book, borrow_date=today, expected_return_date=today + timedelta(days=10))
+        Borrow.objects.create(user=user, book=self.book, borrow_date=today, expected_return_date=today + timedelta(days=1), return_date=today)
+
+        self.assertEqual(send_due_reminders(), 1)
+        self.assertEqual(send_due_reminders(), 0)  # a re-run the same day sends nothing
+        self.assertEqual(list(BorrowReminder.objects.values_list('borrow', 'sent_on')), [(due_soon.id, today)])
+
+        drain_email_outbox()
+        self.assertEqual([message.subject for message in mail.outbox], ['Book Return Reminder'])
+        self.assertIn(str(due_soon.expected_return_date), mail.outbox[0].body)
+
+        # an overlapping run that read the same borrows before this one committed
+        tomorrow = today + timedelta(days=1)
+        queue_reminders = tasks._queue_reminders
+
+        def overlapped(borrows, day):
+            queue_reminders(borrows, day)
+            return queue_reminders(borrows, day)
+
+        with mock.patch('librarySystem.tasks.now', return_value=now() + timedelta(days=1)), \
+                mock.patch('librarySystem.tasks._queue_reminders', overlapped):
+            self.assertEqual(send_due_reminders(), 0)
+        self.assertEqual(BorrowReminder.objects.filter(sent_on=tomorrow).count(), 1)
+        self.assertEqual(EmailOutbox.objects.filter(sent_at__isnull=True).count(), 1)
+
+    def test_borrow_quota(self):
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        for _ in range(3):
+            response = self.client.post('/api/borrow/', self.borrow_data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post('/api/borrow/', self.borrow_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('up to 3 books', response.data['non_field_errors'][0])
+
+        user = User.objects.get(username='testuser')
+        self.assertEqual(user.active_borrows, 3)
+        self.book_stock.refresh_from_db()
+        self.assertEqual(self.book_stock.count, 7)  # the rejected borrow kept its copy on the shelf
+
+        response = self.client.post('/api/return/', {'book': self.book.id}, format='json')
+        user.refresh_from_db()
+        self.assertEqual(user.active_borrows, 2)
+
+    def test_reconcile_borrow_counters(self):
+        user = User.objects.get(username='testuser')
+        Borrow.objects.create(user=user, book=self.book, borrow_date=now().date(), expected_return_date=now().date() + timedelta(days=5))
+        User.objects.filter(pk=user.pk).update(active_borrows=3)
+
+        out = StringIO()
+        call_command('reconcile_borrow_counters', stdout=out)
+        user.refresh_from_db()
+        self.assertEqual(user.active_borrows, 1)
+        self.assertIn('for 1 users', out.getvalue())
+
+    def test_import_catalog(self):
+        with tempfile.TemporaryDirectory() as directory:
+            feed = os.path.join(directory, 'feed.csv')
+            with open(feed, 'w', newline='') as stream:
+                stream.write(
+                    "isbn,name,category,authors,library,branch_address,lat,long,count\n"
+                    "12345,Book One Revised,Fiction,,Central Library,123 Library St,,,4\n"
+                    "777,Dune,Science Fiction,Frank Herbert|Author One,Harbor Library,1 Pier Rd,41.0,-73.0,2\n"
+                    "777,Dune,Science Fiction,Frank Herbert|Author One,Central Library,123 Library St,,,6\n"
+                )
+            out = StringIO()
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('import_catalog', feed, batch_size=2, stdout=out)
+            self.assertIn('Imported 3 records', out.getvalue())
+
+            self.book.refresh_from_db()
+            self.assertEqual(self.book.name, "Book One Revised")
+            self.assertEqual(list(self.book.authors.values_list('name', flat=True)), ["Author One"])  # untouched
+            self.book_stock.refresh_from_db()
+            self.assertEqual(self.book_stock.count, 4)
+
+            dune = Book.objects.get(ISBN="777")
+            self.assertEqual(set(dune.authors.values_list('name', flat=True)), {"Frank Herbert", "Author One"})
+            self.assertEqual(
+                dict(dune.bookstock_set.values_list('library_branch__address', 'count')),
+                {"1 Pier Rd": 2, "123 Library St": 6},
+            )
+            self.assertEqual(search.search_books("herbert"), [dune.id])
+
+            feed = os.path.join(directory, 'feed.jsonl')
+            with open(feed, 'w') as stream:
+                stream.write(json.dumps({'isbn': '777', 'name': 'Dune', 'category': 'Classics', 'authors': ['Frank Herbert'],
+                                         'library': 'Harbor Library', 'branch_address': '1 Pier Rd', 'count': 9}) + "\n")
+            harbor = LibraryBranch.objects.get(address="1 Pier Rd")
+            user, today = User.objects.get(username='testuser'), now().date()
+            Borrow.objects.create(user=user, book=dune, library_branch=harbor, borrow_date=today, expected_return_date=today + timedelta(days=7))
+            Borrow.objects.create(user=user, book=dune, library_branch=harbor, borrow_date=today, expected_return_date=today + timedelta(days=7),
+                                  return_date=today)
+            call_command('import_catalog', feed, stdout=out)
+            dune.refresh_from_db()
+            self.assertEqual(dune.category, "Classics")
+            self.assertEqual(list(dune.authors.values_list('name', flat=True)), ["Frank Herbert"])
+            # 9 copies, one of them out on an open borrow
+            self.assertEqual(dune.bookstock_set.get(library_branch=harbor).count, 8)
+            self.assertEqual(LibraryBranch.objects.count(), 2)
+
+            with open(feed, 'w') as stream:
+                stream.write(json.dumps({'isbn': '888', 'name': 'Nowhere', 'category': 'Maps',
+                                         'library': 'Ghost Library', 'branch_address': '0 Void St'}) + "\n")
+            with self.assertRaisesMessage(CommandError, "needs 'lat' and 'long'"):
+                call_command('import_catalog', feed, stdout=out)
+            self.assertFalse(Book.objects.filter(ISBN="888").exists())
+
+            # a full batch of distinct stock lines
+            feed = os.path.join(directory, 'batch.csv')
+            with open(feed, 'w', newline='') as stream:
+                stream.write("isbn,name,category,authors,library,branch_address,lat,long,count\n")
+                for i in range(catalog_import.BATCH_SIZE):
+                    stream.write(f"b{i},Book {i},Fiction,,Central Library,123 Library St,,,2\n")
+            call_command('import_catalog', feed, stdout=out)
+            self.assertEqual(BookStock.objects.filter(book__ISBN__startswith='b', count=2).count(), catalog_import.BATCH_SIZE)
+
+    def test_import_users(self):
+        User.objects.create_user(username='taken', password='Testpass123!')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'users.csv')
+            with open(path, 'w', newline='') as stream:
+                stream.write(
+                    "username,email,password,first_name,last_name,max_borrows,location_lat,location_long\n"
+                    "pupil1,Pupil1@School.example,Secret123!,Ada,One,5,40.7,-74.0\n"
+                    "taken,taken@school.example,Secret123!,,,,,\n"
+                    "pupil2,,Secret456!,,,,,\n"
+                    "pupil1,again@school.example,Secret789!,,,,,\n"
+                )
+            out = StringIO()
+            call_command('import_users', path, batch_size=2, workers=2, stdout=out)
+            self.assertIn('Created 2 users (2 skipped)', out.getvalue())
+
+            pupil = User.objects.get(username='pupil1')
+            self.assertTrue(pupil.check_password('Secret123!'))
+            self.assertEqual((pupil.email, pupil.max_borrows, pupil.location_lat), ('Pupil1@school.example', 5, 40.7))
+            self.assertEqual(User.objects.get(username='pupil2').max_borrows, 3)
+            self.assertEqual(Token.objects.filter(user__username__in=['pupil1', 'pupil2']).count(), 2)
+
+            with open(path, 'w', newline='') as stream:
+                stream.write("username,password,max_borrows\npupil3,Secret123!,many\n")
+            with self.assertRaisesMessage(CommandError, "'max_borrows' must be a number"):
+                call_command('import_users', path, workers=1, stdout=out)
+
+            with open(path, 'w', newline='') as stream:
+                stream.write("username,password,location_lat\npupil3,Secret123!,100\n")
+            with self.assertRaisesMessage(CommandError, "'location_lat' must be between -90 and 90"):
+                call_command('import_users', path, workers=1, stdout=out)
+
+            with open(path, 'w', newline='') as stream:
+                stream.write("username,password\npupil3,Secret123!\npupil4,12345678\n")
+            with self.assertRaisesMessage(CommandError, "record 2: 'password' is invalid"):
+                call_command('import_users', path, batch_size=1, workers=1, stdout=out)
+            self.assertTrue(User.objects.filter(username='pupil3').exists())
+            self.assertFalse(User.objects.filter(username='pupil4').exists())
+
+    def test_batch_borrow_and_return(self):
+        book = Book.objects.create(ISBN="67890", name="Book Two", category="Fiction")
+        BookStock.objects.create(book=book, library_branch=self.branch, count=1)
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+        due = self.borrow_data['expected_return_date']
+        items = [
+            {'book': self.book.id, 'library_branch': self.branch.id, 'expected_return_date': due},
+            {'book': book.id, 'library_branch': self.branch.id, 'expected_return_date': due},
+            {'book': book.id, 'library_branch': self.branch.id, 'expected_return_date': due},
+            {'book': 999, 'library_branch': self.branch.id, 'expected_return_date': due},
+            {'book': self.book.id, 'library_branch': self.branch.id, 'expected_return_date': due},
+            {'book': self.book.id, 'library_branch': self.branch.id, 'expected_return_date': due},
+        ]
+        response = self.client.post('/api/borrow/batch', {'items': items}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['borrowed'], 3)
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            ['borrowed', 'borrowed', 'failed', 'failed', 'borrowed', 'failed'],
+        )
+        self.assertIn("No copies", response.data['results'][2]['error'])
+        self.assertIn("up to 3 books", response.data['results'][5]['error'])
+
+        user = User.objects.get(username='testuser')
+        self.assertEqual(user.active_borrows, 3)
+        self.book_stock.refresh_from_db()
+        self.assertEqual(self.book_stock.count, 8)
+        self.assertEqual(BookStock.objects.get(book=book).count, 0)
+        self.assertEqual(EmailOutbox.objects.count(), 1)
+
+        Borrow.objects.filter(book=book).update(expected_return_date=now().date() - timedelta(days=2))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/return/batch', {'books': [self.book.id, book.id, book.id]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # stock rows are locked in id order, so overlapping batches cannot deadlock on them
+        locks = [query['sql'] for query in queries if query['sql'].startswith('SELECT') and 'FROM "librarySystem_bookstock"' in query['sql']]
+        self.assertTrue(locks)
+        self.assertTrue(all('ORDER BY "librarySystem_bookstock"."id" ASC' in sql for sql in locks), locks)
+        self.assertEqual(response.data['returned'], 2)
+        self.assertEqual([result['status'] for result in response.data['results']], ['returned', 'returned', 'failed'])
+        self.assertEqual(response.data['results'][1]['days_late'], 2)
+        self.assertEqual(response.data['total_penalty'], 10.0)
+
+        user.refresh_from_db()
+        self.assertEqual(user.active_borrows, 1)
+        self.book_stock.refresh_from_db()
+        self.assertEqual(self.book_stock.count, 9)
+        self.assertEqual(BookStock.objects.get(book=book).count, 1)
+
+        response = self.client.post('/api/return/batch', {'books': [book.id]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/api/borrow/batch', {'items': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_penalty_ledger(self):
+        user = User.objects.get(username='testuser')
+        today = now().date()
+        late = Borrow.objects.create(user=user, book=self.book, library_branch=self.branch,
+                                     borrow_date=today - timedelta(days=20), expected_return_date=today - timedelta(days=4))
+        Borrow.objects.create(user=user, book=self.book, library_branch=self.branch,
+                              borrow_date=today - timedelta(days=20), expected_return_date=today - timedelta(days=1))
+        Borrow.objects.create(user=user, book=self.book, library_branch=self.branch,
+                              borrow_date=today, expected_return_date=today + timedelta(days=5))
+        User.objects.filter(pk=user.pk).update(active_borrows=3)
+
+        self.assertEqual(penalties.accrue_penalties(today - timedelta(days=1)), 1)
+        self.assertEqual(accrue_penalties(), 2)  # the nightly task; the earlier row is brought up to date
+        self.assertEqual(sorted(PenaltyAccrual.objects.values_list('days_overdue', flat=True)), [1, 4])
+        user.refresh_from_db()
+        self.assertEqual(user.penalty_total, 25.0)
+
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        response = self.client.get('/api/penalties/')
+        self.assertEqual(response.data['total'], 25.0)
+        self.assertEqual([(row['book'], row['days_overdue'], row['amount']) for row in response.data['overdue']],
+                         [("12345", 4, 20.0), ("12345", 1, 5.0)])
+
+        # returning the oldest open borrow fixes its penalty; the nightly job leaves it alone from then on
+        Borrow.objects.filter(pk=late.pk).update(expected_return_date=today - timedelta(days=6))
+        response = self.client.post('/api/return/', {'book': self.book.id}, format='json')
+        self.assertEqual(response.data['penalty'], 30.0)
+        accrue_penalties()
+        self.assertEqual(PenaltyAccrual.objects.get(borrow=late).amount, 30.0)
+        self.assertTrue(PenaltyAccrual.objects.get(borrow=late).final)
+        response = self.client.get('/api/penalties/')
+        self.assertEqual(response.data['total'], 35.0)
+        self.assertEqual(len(response.data['overdue']), 1)
+
+        self.assertEqual(self.client.get('/api/penalties/totals').status_code, status.HTTP_403_FORBIDDEN)
+        user.is_staff = True
+        user.save(update_fields=['is_staff'])  # also drops the cached auth snapshot
+        User.objects.create_user(username='debtor', password='Testpass123!', penalty_total=50.0)
+        User.objects.create_user(username='clean', password='Testpass123!')
+        response = self.client.get('/api/penalties/totals', {'page_size': 1})
+        self.assertEqual([row['username'] for row in response.data['results']], ['debtor'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([(row['username'], row['penalty_total']) for row in response.data['results']], [('testuser', 35.0)])
+        self.assertIsNone(response.data['next'])
+
+    def test_penalty_accrual_in_python(self):
+        # backends without the date arithmetic in SQL get the same ledger rows
+        user = User.objects.get(username='testuser')
+        today = now().date()
+        for days in (4, 1, -5):
+            Borrow.objects.create(user=user, book=self.book, library_branch=self.branch,
+                                  borrow_date=today - timedelta(days=20), expected_return_date=today - timedelta(days=days))
+        self.assertEqual(penalties.accrue_penalties(today - timedelta(days=1)), 1)
+        with mock.patch.object(penalties, '_days_overdue', return_value=None):
+            self.assertEqual(penalties.accrue_penalties(today), 2)
+        python_rows = sorted(PenaltyAccrual.objects.values_list('borrow_id', 'days_overdue', 'amount', 'accrued_on', 'final'))
+        PenaltyAccrual.objects.all().delete()
+        self.assertEqual(penalties.accrue_penalties(today), 2)
+        self.assertEqual(sorted(PenaltyAccrual.objects.values_list('borrow_id', 'days_overdue', 'amount', 'accrued_on', 'final')), python_rows)
+        user.refresh_from_db()
+        self.assertEqual(user.penalty_total, 25.0)
+
+    def test_penalty_totals_pages_through_equal_totals(self):
+        # more users on one total than CursorPagination's offset cap of 1000
+        User.objects.bulk_create([User(username=f'debtor{i}', email=f'debtor{i}@example.com', penalty_total=5.0) for i in range(1600)])
+        User.objects.create_user(username='big', password='Testpass123!', penalty_total=50.0)
+        expected = list(User.objects.filter(penalty_total__gt=0).order_by('-penalty_total', 'id').values_list('id', flat=True))
+        admin = User.objects.create_user(username='admin', password='Testpass123!', is_staff=True)
+        self.client.force_authenticate(admin)
+
+        seen, pages = [], []
+        response = self.client.get('/api/penalties/totals', {'page_size': 500})
+        while True:
+            pages.append(response.data)
+            seen += [row['id'] for row in response.data['results']]
+            if response.data['next'] is None:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(pages), 4)
+
+        # and back again from the last page
+        response = self.client.get(pages[-1]['previous'])
+        self.assertEqual([row['id'] for row in response.data['results']], expected[1000:1500])
+        self.assertEqual(self.client.get('/api/penalties/totals', {'cursor': 'cD14'}).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_circulation_stats(self):
+        author = Author.objects.create(name="Author Two")
+        book = Book.objects.create(ISBN="67890", name="Book Two", category="History")
+        book.authors.add(self.author, author)
+        BookStock.objects.create(book=book, library_branch=self.branch, count=5)
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+        self.client.post('/api/borrow/', self.borrow_data, format='json')
+        due = self.borrow_data['expected_return_date']
+        self.client.post('/api/borrow/batch', {'items': [
+            {'book': book.id, 'library_branch': self.branch.id, 'expected_return_date': due},
+            {'book': self.book.id, 'library_branch': self.branch.id, 'expected_return_date': due},
+        ]}, format='json')
+        self.client.post('/api/return/', {'book': book.id}, format='json')
+
+        today = now().date()
+        buckets = {
+            (stat.dimension, stat.key): (stat.borrows, stat.returns)
+            for stat in CirculationStat.objects.filter(day=today)
+        }
+        self.assertEqual(buckets, {
+            ('category', 'Fiction'): (2, 0),
+            ('category', 'History'): (1, 1),
+            ('library', str(self.library.id)): (3, 1),
+            ('author', str(self.author.id)): (3, 1),
+            ('author', str(author.id)): (1, 1),
+        })
+
+        self.assertEqual(self.client.get('/api/stats/author/').status_code, status.HTTP_403_FORBIDDEN)
+        staff = User.objects.get(username='testuser')
+        staff.is_staff = True
+        staff.save(update_fields=['is_staff'])
+        response = self.client.get('/api/stats/author/')
+        self.assertEqual(
+            [(row['label'], row['borrows'], row['returns']) for row in response.data['results']],
+            [("Author One", 3, 1), ("Author Two", 1, 1)],
+        )
+        response = self.client.get('/api/stats/category/', {'key': 'History', 'from': today.isoformat()})
+        self.assertEqual([(row['day'], row['label']) for row in response.data['results']], [(today, 'History')])
+        self.assertEqual(self.client.get('/api/stats/weather/').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/api/stats/category/', {'from': 'monday'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+        # a rebuild from the borrow history gives the same buckets
+        call_command('rebuild_circulation_stats', stdout=StringIO())
+        self.assertEqual(
+            {(stat.dimension, stat.key): (stat.borrows, stat.returns) for stat in CirculationStat.objects.all()},
+            buckets,
+        )
+
+    def test_related_books(self):
+        books = [self.book] + [Book.objects.create(ISBN=f"9{i}", name=f"Book {i}", category="Fiction") for i in range(5)]
+        users = [User.objects.create_user(username=f'reader{i}', password='Testpass123!') for i in range(4)]
+
+        def borrow(user, book):
+            Borrow.objects.create(user=user, book=book, borrow_date=now().date(), expected_return_date=now().date() + timedelta(days=5))
+
+        rng = random.Random(7)
+        for _ in range(3):
+            for _ in range(12):
+                borrow(rng.choice(users), rng.choice(books))
+            recommendations.update_related_books(chunk_size=5, until=recommendations.newest_borrow_id())
+
+        # every run only added the new borrows, yet the matrix matches one computed from scratch
+        borrowed = {}
+        for user_id, book_id in Borrow.objects.values_list('user_id', 'book_id'):
+            borrowed.setdefault(user_id, set()).add(book_id)
+        expected = {}
+        for book_ids in borrowed.values():
+            for a in book_ids:
+                for b in book_ids - {a}:
+                    expected[a, b] = expected.get((a, b), 0) + 1
+        self.assertEqual({(row.book_id, row.related_id): row.borrowers for row in CoBorrow.objects.all()}, expected)
+        self.assertEqual(recommendations.update_related_books(), 0)
+
+        # by default a run reads only up to the newest borrow the previous run saw, whose
+        # transaction has ended by then; a lower id that commits late is not skipped
+        borrow(users[0], books[5])
+        self.assertEqual(recommendations.update_related_books(), 0)
+        self.assertEqual(recommendations.update_related_books(), 1)
+
+        Borrow.objects.all().delete()
+        CoBorrow.objects.all().delete()
+        RelatedBook.objects.all().delete()
+        borrow(users[0], books[0])
+        borrow(users[0], books[1])
+        borrow(users[1], books[0])
+        borrow(users[1], books[1])
+        borrow(users[1], books[2])
+        borrow(users[2], books[0])
+        borrow(users[2], books[3])
+        recommendations.update_related_books(top_k=2, until=recommendations.newest_borrow_id())
+
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        response = self.client.get(f'/api/books/{self.book.ISBN}/related')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(row['ISBN'], row['score']) for row in response.data], [(books[1].ISBN, 2), (books[2].ISBN, 1)])
+        self.assertEqual(self.client.get(f'/api/books/{books[4].ISBN}/related').data, [])
+        self.assertEqual(self.client.get('/api/books/nope/related').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_export(self):
+        user = User.objects.get(username='testuser')
+        Borrow.objects.create(user=user, book=self.book, library_branch=self.branch,
+                              borrow_date=now().date(), expected_return_date=now().date() + timedelta(days=5))
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        self.assertEqual(self.client.get('/api/export/books/').status_code, status.HTTP_403_FORBIDDEN)
+
+        user.is_staff = True
+        user.save(update_fields=['is_staff'])
+        response = self.client.get('/api/export/borrows/', {'output': 'csv'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,user_id,book_id,library_branch_id,borrow_date,expected_return_date,return_date')
+        self.assertEqual(lines[1].split(',')[1:5], [str(user.id), str(self.book.id), str(self.branch.id), now().date().isoformat()])
+
+        Book.objects.create(ISBN="67890", name="Book, Two", category="Fiction")
+        response = self.client.get('/api/export/books/')
+        books = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([book['name'] for book in books], ["Book One", "Book, Two"])
+        self.assertEqual(self.client.get('/api/export/users/').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/api/export/books/', {'output': 'xml'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+        out = StringIO()
+        call_command('export_data', 'book_authors', '--chunk-size', '1', stdout=out)
+        self.assertEqual([json.loads(line)['author_id'] for line in out.getvalue().splitlines()], [self.author.id])
+
+    def test_benchmark_borrow_indexes_rolls_back(self):
+        borrows = Borrow.objects.count()
+        out = StringIO()
+        call_command('benchmark_borrow_indexes', borrows=500, users=20, books=10, open_ratio=0.2, repeat=5, stdout=out)
+        self.assertIn('validate return', out.getvalue())
+        self.assertIn('speedup', out.getvalue())
+        self.assertEqual(Borrow.objects.count(), borrows)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Borrow._meta.db_table)
+        self.assertIn('borrow_open_user_book_idx', constraints)
+        self.assertIn('borrow_open_due_idx', constraints)
+
+    def test_benchmark_asgi(self):
+        User.objects.create_user(username='bench', password='Testpass123!')
+        out = StringIO()
+        call_command('benchmark_asgi', requests=4, concurrency=2, routes=['book-list'], username='bench', stdout=out)
+        rows = [line.split() for line in out.getvalue().splitlines() if line.startswith('book-list')]
+        self.assertEqual([row[1] for row in rows], ['wsgi', 'asgi-sync', 'asgi-async'])
+
+    def test_borrow_and_return_update_stock(self):
+        self.book_stock.count = 1
+        self.book_stock.save()
+        self.test_borrow_book()
+        self.book_stock.refresh_from_db()
+        self.assertEqual(self.book_stock.count, 0)
+
+        response = self.client.post('/api/borrow/', self.borrow_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Borrow.objects.count(), 1)
+
+        response = self.client.post('/api/return/', {'book': self.book.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.book_stock.refresh_from_db()
+        self.assertEqual(self.book_stock.count, 1)
+        self.assertEqual(Borrow.objects.get().library_branch, self.branch)
+
+        # a return writes the user's row before the borrow and the stock, in the order batches lock them
+        self.assertEqual(self.client.post('/api/borrow/', self.borrow_data, format='json').status_code, status.HTTP_201_CREATED)
+        user, borrow = User.objects.get(username='testuser'), Borrow.objects.get(return_date__isnull=True)
+        with CaptureQueriesContext(connection) as queries:
+            return_book(user, borrow)
+        updated = [query['sql'].split()[1].strip('"') for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(updated[:3], ['librarySystem_user', 'librarySystem_borrow', 'librarySystem_bookstock'])
+        # one that lost the race to a concurrent return leaves the quota alone
+        User.objects.filter(pk=user.pk).update(active_borrows=2)
+        self.assertIsNone(return_book(user, borrow))
+        self.assertEqual(User.objects.get(pk=user.pk).active_borrows, 2)
+
+    def test_library_distance_uses_nearest_branch(self):
+        library = Library.objects.create(name="Uptown Library")
+        LibraryBranch.objects.create(library=library, location_lat=48.8566, location_long=2.3522, address="Far St")
+        LibraryBranch.objects.create(library=library, location_lat=40.7306, location_long=-73.9352, address="Near St")
+
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        response = self.client.get('/api/libraries/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        distances = {library['name']: library['distance'] for library in response.data['results']}
+        self.assertEqual(distances['Central Library'], 0.0)
+        self.assertAlmostEqual(distances['Uptown Library'], haversine_km(40.7128, -74.0060, 40.7306, -73.9352), places=1)
+
+    def test_nearby_branches(self):
+        library = Library.objects.create(name="Uptown Library")
+        near = LibraryBranch.objects.create(library=library, location_lat=40.7306, location_long=-73.9352, address="Near St")
+        LibraryBranch.objects.create(library=library, location_lat=48.8566, location_long=2.3522, address="Far St")
+
+        self.test_login_user()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        response = self.client.get('/api/branches/nearby/', {'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([branch['id'] for branch in response.data], [self.branch.id, near.id])
+        self.assertEqual(response.data[0]['distance'], 0.0)
+
+        response = self.client.get('/api/branches/nearby/', {'lat': 48.85, 'long': 2.35, 'radius_km': 50})
+        self.assertEqual([branch['address'] for branch in response.data], ["Far St"])
+
+        response = self.client.get('/api/branches/nearby/', {'lat': 'north'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_user_without_location(self):
+        response = self.client.post('/api/register/', {
+            'username': 'nowhere', 'email': 'nowhere@example.com', 'password': 'Testpass123!', 'password_confirm': 'Testpass123!',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        user = User.objects.get(username='nowhere')
+        self.assertEqual((user.location_lat, user.location_long), (None, None))
+        self.client.force_authenticate(user)
+
+        response = self.client.get('/api/libraries/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([library['distance'] for library in response.data['results']], [None])
+        self.assertEqual(self.client.get('/api/async/libraries/').data['results'][0]['distance'], None)
+
+        response = self.client.get('/api/branches/nearby/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], "lat and long are required when the user has no location")
+        response = self.client.get('/api/branches/nearby/', {'lat': 40.7128, 'long': -74.0060})
+        self.assertEqual([branch['id'] for branch in response.data], [self.branch.id])
+
+        response = self.client.post('/api/register/', {
+            'username': 'offmap', 'email': 'offmap@example.com', 'password': 'Testpass123!', 'password_confirm': 'Testpass123!',
+            'location_lat': 100.0, 'location_long': 100.0,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('location_lat', response.data)
+
+class BranchIndexTestCase(SimpleTestCase):
+    def test_nearest_by_library_matches_brute_force(self):
+        rng = random.Random(7)
+        branches = [
+            (branch_id, rng.randrange(40), rng.uniform(-90, 90), rng.uniform(-180, 180))
+            for branch_id in range(2000)
+        ]
+        index = BranchIndex()
+        index.load(branches)
+        index.remove(0)
+        branches = branches[1:]
+
+        for _ in range(20):
+            lat, long = rng.uniform(-90, 90), rng.uniform(-180, 180)
+            expected = {}
+            for _, library_id, branch_lat, branch_long in branches:
+                distance = haversine_km(lat, long, branch_lat, branch_long)
+                expected[library_id] = min(distance, expected.get(library_id, distance))
+
+            nearest = index.nearest_by_library(lat, long)
+            self.assertEqual(nearest.keys(), expected.keys())
+            for library_id, distance in expected.items():
+                self.assertAlmostEqual(nearest[library_id], distance, places=6)
+
+        # an empty page of libraries, or libraries without branches
+        self.assertEqual(index.nearest_by_library(0, 0, []), {})
+        self.assertEqual(index.nearest_by_library(0, 0, [1000]), {})
+
+    def test_bounding_box_wraps_antimeridian(self):
+        min_lat, max_lat, long_ranges = bounding_box(0, 179.9, 50)
+        self.assertLess(min_lat, 0)
+        self.assertGreater(max_lat, 0)
+        self.assertEqual(len(long_ranges), 2)
+        self.assertEqual(bounding_box(89.9, 0, 50)[2], [(-180.0, 180.0)])
+
+
+# Query budget for every route in librarySystem/urls.py: the most queries one
+# request may run. Each budget is checked on a small and a larger catalog, so a
+# view whose query count grows with the data fails even if it starts under it.
+QUERY_BUDGETS = {
+    'library-list': 3,
+    'branch-nearby': 7,
+    'author-list': 2,
+    'book-list': 3,
+    'book-search': 4,
+    'book-related': 2,
+    'author-loaded-list': 4,
+    'borrow-book': 10,
+    'return-book': 10,
+    'borrow-batch': 12,
+    'return-batch': 11,
+    'penalties': 2,
+    'penalty-report': 2,
+    'circulation-stats': 3,
+    'register': 4,
+    'login': 2,
+    'export': 3,
+    'async-library-list': 3,
+    'async-branch-nearby': 7,
+    'async-author-list': 2,
+    'async-book-list': 3,
+    'async-book-search': 4,
+    'async-book-related': 2,
+    'async-author-loaded-list': 4,
+    'async-penalties': 2,
+    'async-borrow-book': 10,
+    'async-return-book': 8,
+    'password_reset': 0,
+    'password_reset_done': 0,
+    'password_reset_confirm': 1,
+    'password_reset_complete': 0,
+}
+
+
+class QueryBudgetTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='budget', password='Testpass123!', email='budget@example.com', location_lat=40.7, location_long=-74.0)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.user).access_token))
+        self.catalog_size = 0
+
+    def grow_catalog(self, size):
+        # libraries with two branches each, authors with two books each, all stocked
+        with self.captureOnCommitCallbacks(execute=True):  # invalidate cached catalog responses
+            self._grow_catalog(size)
+
+    def _grow_catalog(self, size):
+        for i in range(self.catalog_size, size):
+            library = Library.objects.create(name=f"Library {i}")
+            branches = [
+                LibraryBranch.objects.create(library=library, location_lat=40 + i, location_long=-74 + j, address=f"{i}-{j} Main St")
+                for j in range(2)
+            ]
+            author = Author.objects.create(name=f"Author {i}")
+            for j in range(2):
+                book = Book.objects.create(ISBN=f"{i}-{j}", name=f"Book {i}-{j}", category="Fiction")
+                book.authors.add(author)
+                for branch in branches:
+                    BookStock.objects.create(book=book, library_branch=branch, count=5)
+        self.catalog_size = max(self.catalog_size, size)
+
+    def assertWithinBudget(self, name, request):
+        budget = QUERY_BUDGETS[name]
+        for size in (2, 8):
+            self.grow_catalog(size)
+            response = request()
+            self.assertLess(response.status_code, 400, None if response.streaming else response.content)
+            queries = int(response['X-Query-Count'])
+            if response.streaming:
+                # streamed rows are read after the middleware has counted
+                with CaptureQueriesContext(connection) as streamed:
+                    b''.join(response.streaming_content)
+                queries += len(streamed)
+            self.assertLessEqual(queries, budget, f"{name} ran {queries} queries (budget {budget}) with {size} catalog rows")
+
+    def test_cached_catalog_response(self):
+        self.grow_catalog(2)
+        first = self.client.get(reverse('book-list'))
+        cached = self.client.get(reverse('book-list'))
+        self.assertEqual(cached.data, first.data)
+        self.assertEqual(cached['X-Query-Count'], '0')  # the user comes from the cached auth snapshot
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Book.objects.filter(ISBN='0-0').first().authors.clear()
+        response = self.client.get(reverse('book-list'))
+        self.assertEqual(response.data['results'][0]['authors'], [])
+
+    def test_conditional_catalog_requests(self):
+        self.grow_catalog(2)
+        response = self.client.get(reverse('author-list'))
+        etag = response['ETag']
+        # versions can change within a second, so there are no one-second Last-Modified dates to validate
+        self.assertNotIn('Last-Modified', response)
+
+        response = self.client.get(reverse('author-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['X-Query-Count'], '0')
+
+        # a write in the same second as the cached response is not hidden behind If-Modified-Since
+        with self.captureOnCommitCallbacks(execute=True):
+            Author.objects.create(name="Author New")
+        response = self.client.get(reverse('author-list'), HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 1))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.get(reverse('author-list'), HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 1))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # distances follow the user: the ETag includes the location
+        response = self.client.get(reverse('library-list'))
+        etag = response['ETag']
+        self.assertEqual(self.client.get(reverse('library-list'), HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        self.user.location_lat = 48.85
+        self.user.save()
+        response = self.client.get(reverse('library-list'), HTTP_IF_MODIFIED_SINCE=http_date(time.time()))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_cached_authentication(self):
+        self.assertEqual(self.client.get(reverse('penalties')).data['total'], 0.0)
+        # counters updated in bulk are deferred on the cached user and read fresh
+        User.objects.filter(pk=self.user.pk).update(penalty_total=7.5)
+        response = self.client.get(reverse('penalties'))
+        self.assertEqual(response.data['total'], 7.5)
+        self.assertEqual(response['X-Query-Count'], '2')  # the deferred total and the ledger; no user lookup
+
+        self.user.is_active = False
+        self.user.save(update_fields=['is_active'])
+        self.assertEqual(self.client.get(reverse('penalties')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_throttled_before_any_work(self):
+        rates = {'bucket-ip': '30/min', 'bucket-user': '12/min', 'bucket-global': '1000/min'}
+        with self.settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': rates}):
+            # an anonymous login costs 10 tokens of the 30 in the IP bucket
+            anonymous = APIClient()
+            with mock.patch('librarySystem.views.user.authenticate', return_value=None) as authenticate:
+                for _ in range(3):
+                    response = anonymous.post(reverse('login'), {'username': 'budget', 'password': 'wrong'}, format='json')
+                    self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                response = anonymous.post(reverse('login'), {'username': 'budget', 'password': 'wrong'}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(authenticate.call_count, 3)
+            self.assertIn('Retry-After', response)
+
+            # a made-up X-Forwarded-For does not buy a fresh IP bucket
+            cache.clear()
+            with mock.patch('librarySystem.views.user.authenticate', return_value=None):
+                codes = [
+                    anonymous.post(reverse('login'), {'username': f'budget{i}', 'password': 'wrong'}, format='json',
+                                   HTTP_X_FORWARDED_FOR=f'10.0.0.{i}').status_code
+                    for i in range(4)
+                ]
+            self.assertEqual(codes[-1], status.HTTP_429_TOO_MANY_REQUESTS)
+
+            # the loaded author list costs 5 of the user's 12, and is rejected without a query
+            cache.clear()
+            self.assertEqual(self.client.get(reverse('author-loaded-list')).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get(reverse('author-loaded-list')).status_code, status.HTTP_200_OK)
+            response = self.client.get(reverse('author-loaded-list'))
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(response['X-Query-Count'], '0')
+
+        # guesses at one username are limited from any number of addresses
+        cache.clear()
+        rates = {'bucket-ip': '1000/min', 'bucket-user': '1000/min', 'bucket-global': '1000/min', 'bucket-login': '20/min'}
+        with self.settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': rates}):
+            with mock.patch('librarySystem.views.user.authenticate', return_value=None) as authenticate:
+                codes = [
+                    anonymous.post(reverse('login'), {'username': 'Victim', 'password': 'wrong'}, format='json',
+                                   REMOTE_ADDR=f'10.0.0.{i}').status_code
+                    for i in range(3)
+                ]
+                self.assertEqual(codes, [status.HTTP_400_BAD_REQUEST] * 2 + [status.HTTP_429_TOO_MANY_REQUESTS])
+                response = anonymous.post(reverse('login'), {'username': 'victim', 'password': 'wrong'}, format='json')
+                self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+                response = anonymous.post(reverse('login'), {'username': 'other', 'password': 'wrong'}, format='json')
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(authenticate.call_count, 3)
+
+        # a client over its IP limit takes nothing from the global bucket everyone shares
+        cache.clear()
+        rates = {'bucket-ip': '30/min', 'bucket-global': '40/min'}
+        with self.settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': rates}):
+            with mock.patch('librarySystem.views.user.authenticate', return_value=None):
+                codes = [
+                    anonymous.post(reverse('login'), {'username': f'flood{i}', 'password': 'wrong'}, format='json',
+                                   REMOTE_ADDR='10.0.0.1').status_code
+                    for i in range(10)
+                ]
+                self.assertEqual(codes, [status.HTTP_400_BAD_REQUEST] * 3 + [status.HTTP_429_TOO_MANY_REQUESTS] * 7)
+                response = anonymous.post(reverse('login'), {'username': 'other', 'password': 'wrong'}, format='json',
+                                          REMOTE_ADDR='10.0.0.2')
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_every_route_has_a_budget(self):
+        names = {pattern.name for pattern in urlpatterns}
+        self.assertEqual(names, set(QUERY_BUDGETS))
+
+    def test_library_list_budget(self):
+        self.assertWithinBudget('library-list', lambda: self.client.get(reverse('library-list')))
+
+    def test_branch_nearby_budget(self):
+        self.assertWithinBudget('branch-nearby', lambda: self.client.get(reverse('branch-nearby')))
+
+    def test_author_list_budget(self):
+        self.assertWithinBudget('author-list', lambda: self.client.get(reverse('author-list')))
+
+    def test_book_list_budget(self):
+        self.assertWithinBudget('book-list', lambda: self.client.get(reverse('book-list')))
+
+    def test_author_loaded_list_budget(self):
+        self.assertWithinBudget('author-loaded-list', lambda: self.client.get(reverse('author-loaded-list')))
+
+    def test_book_search_budget(self):
+        self.assertWithinBudget('book-search', lambda: self.client.get(reverse('book-search'), {'q': 'book'}))
+
+    def test_borrow_and_return_budget(self):
+        def borrow():
+            stock = BookStock.objects.order_by('-id').first()
+            return self.client.post(reverse('borrow-book'), {
+                'book': stock.book_id,
+                'library_branch': stock.library_branch_id,
+                'expected_return_date': (now().date() + timedelta(days=10)).isoformat(),
+            }, format='json')
+
+        def return_book():
+            book = Borrow.objects.filter(user=self.user, return_date__isnull=True).first().book
+            return self.client.post(reverse('return-book'), {'book': book.id}, format='json')
+
+        self.assertWithinBudget('borrow-book', borrow)
+        self.assertWithinBudget('return-book', return_book)
+
+    def test_batch_borrow_and_return_budget(self):
+        User.objects.filter(pk=self.user.pk).update(max_borrows=50)
+
+        def borrow_batch():
+            due = (now().date() + timedelta(days=10)).isoformat()
+            items = [
+                {'book': stock.book_id, 'library_branch': stock.library_branch_id, 'expected_return_date': due}
+                for stock in BookStock.objects.order_by('-id')[:3]
+            ]
+            return self.client.post(reverse('borrow-batch'), {'items': items}, format='json')
+
+        def return_batch():
+            books = Borrow.objects.filter(user=self.user, return_date__isnull=True).values_list('book_id', flat=True)
+            return self.client.post(reverse('return-batch'), {'books': list(books[:3])}, format='json')
+
+        self.assertWithinBudget('borrow-batch', borrow_batch)
+        self.assertWithinBudget('return-batch', return_batch)
+
+    def test_async_routes_match_sync_routes(self):
+        self.grow_catalog(3)
+        reads = [
+            ('library-list', [], {}), ('branch-nearby', [], {'limit': 3}), ('author-list', [], {'category': 'Fiction'}),
+            ('book-list', [], {'author': 'Author 1'}), ('book-list', [], {'author': 'Nobody'}), ('book-search', [], {'q': 'book 2'}),
+            ('book-search', [], {}), ('book-related', ['0-0'], {}), ('book-related', ['none'], {}), ('author-loaded-list', [], {}),
+            ('penalties', [], {}),
+        ]
+        for name, args, params in reads:
+            sync = self.client.get(reverse(name, args=args), params)
+            response = self.client.get(reverse(f'async-{name}', args=args), params)
+            self.assertEqual(response.status_code, sync.status_code, name)
+            # pagination links differ in the path only
+            data, expected = response.json(), sync.json()
+            if isinstance(expected, dict) and 'results' in expected:
+                data, expected = data['results'], expected['results']
+            self.assertEqual(data, expected, name)
+
+        stock = BookStock.objects.first()
+        borrow = {'book': stock.book_id, 'library_branch': stock.library_branch_id,
+                  'expected_return_date': (now().date() + timedelta(days=10)).isoformat()}
+        response = self.client.post(reverse('async-borrow-book'), borrow, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(BookStock.objects.get(pk=stock.pk).count, stock.count - 1)
+        response = self.client.post(reverse('async-borrow-book'), {**borrow, 'book': 0}, format='json')
+        self.assertEqual(response.json(), {'book': ['Invalid pk "0" - object does not exist.']})
+
+        response = self.client.post(reverse('async-return-book'), {'book': stock.book_id}, format='json')
+        self.assertEqual(response.json(), {'message': 'Book returned successfully'})
+        response = self.client.post(reverse('async-return-book'), {'book': stock.book_id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(BookStock.objects.get(pk=stock.pk).count, stock.count)
+
+    def test_async_library_list_budget(self):
+        self.assertWithinBudget('async-library-list', lambda: self.client.get(reverse('async-library-list')))
+
+    def test_async_branch_nearby_budget(self):
+        self.assertWithinBudget('async-branch-nearby', lambda: self.client.get(reverse('async-branch-nearby')))
+
+    def test_async_author_list_budget(self):
+        self.assertWithinBudget('async-author-list', lambda: self.client.get(reverse('async-author-list')))
+
+    def test_async_book_list_budget(self):
+        self.assertWithinBudget('async-book-list', lambda: self.client.get(reverse('async-book-list')))
+
+    def test_async_author_loaded_list_budget(self):
+        self.assertWithinBudget('async-author-loaded-list', lambda: self.client.get(reverse('async-author-loaded-list')))
+
+    def test_async_book_search_budget(self):
+        self.assertWithinBudget('async-book-search', lambda: self.client.get(reverse('async-book-search'), {'q': 'book'}))
+
+    def test_async_book_related_and_penalties_budget(self):
+        def related():
+            for stock in BookStock.objects.all():
+                Borrow.objects.create(user=self.user, book_id=stock.book_id, borrow_date=now().date(),
+                                      expected_return_date=now().date() + timedelta(days=5))
+            recommendations.update_related_books(until=recommendations.newest_borrow_id())
+            return self.client.get(reverse('async-book-related', args=['0-0']))
+
+        self.assertWithinBudget('async-book-related', related)
+        self.assertWithinBudget('async-penalties', lambda: self.client.get(reverse('async-penalties')))
+
+    def test_async_borrow_and_return_budget(self):
+        def borrow():
+            stock = BookStock.objects.order_by('-id').first()
+            return self.client.post(reverse('async-borrow-book'), {
+                'book': stock.book_id,
+                'library_branch': stock.library_branch_id,
+                'expected_return_date': (now().date() + timedelta(days=10)).isoformat(),
+            }, format='json')
+
+        def return_book():
+            book_id = Borrow.objects.filter(user=self.user, return_date__isnull=True).values_list('book_id', flat=True).first()
+            return self.client.post(reverse('async-return-book'), {'book': book_id}, format='json')
+
+        self.assertWithinBudget('async-borrow-book', borrow)
+        self.assertWithinBudget('async-return-book', return_book)
+
+    def test_penalty_budget(self):
+        def overdue_borrow():
+            self.grow_catalog(self.catalog_size)
+            Borrow.objects.create(user=self.user, book=Book.objects.order_by('-id').first(),
+                                  borrow_date=now().date() - timedelta(days=20), expected_return_date=now().date() - timedelta(days=3))
+            accrue_penalties()
+
+        def penalties_view():
+            overdue_borrow()
+            return self.client.get(reverse('penalties'))
+
+        self.assertWithinBudget('penalties', penalties_view)
+        self.user.is_staff = True
+        self.user.save(update_fields=['is_staff'])
+        self.assertWithinBudget('penalty-report', lambda: self.client.get(reverse('penalty-report')))
+
+    def test_circulation_stats_budget(self):
+        self.user.is_staff = True
+        self.user.save(update_fields=['is_staff'])
+
+        def stats():
+            for stock in BookStock.objects.all():
+                Borrow.objects.create(user=self.user, book_id=stock.book_id, library_branch_id=stock.library_branch_id,
+                                      borrow_date=now().date(), expected_return_date=now().date() + timedelta(days=5))
+            call_command('rebuild_circulation_stats', stdout=StringIO())
+            return self.client.get(reverse('circulation-stats', args=['library']))
+
+        self.assertWithinBudget('circulation-stats', stats)
+
+    def test_book_related_budget(self):
+        def related():
+            for stock in BookStock.objects.all():
+                Borrow.objects.create(user=self.user, book_id=stock.book_id, borrow_date=now().date(),
+                                      expected_return_date=now().date() + timedelta(days=5))
+            recommendations.update_related_books(until=recommendations.newest_borrow_id())
+            return self.client.get(reverse('book-related', args=['0-0']))
+
+        self.assertWithinBudget('book-related', related)
+
+    def test_export_budget(self):
+        admin = User.objects.create_user(username='admin', password='Testpass123!', is_staff=True)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(admin).access_token))
+
+        self.assertWithinBudget('export', lambda: self.client.get(reverse('export', args=['stock'])))
+
+    def test_user_budget(self):
+        counter = iter(range(100))
+
+        def register():
+            n = next(counter)
+            return self.client.post(reverse('register'), {
+                'username': f'new{n}', 'email': f'new{n}@example.com',
+                'password': 'Testpass123!', 'password_confirm': 'Testpass123!',
+            }, format='json')
+
+        self.assertWithinBudget('register', register)
+        self.assertWithinBudget('login', lambda: self.client.post(reverse('login'), {'username': 'budget', 'password': 'Testpass123!'}, format='json'))
+
+    def test_password_reset_budget(self):
+        self.assertWithinBudget('password_reset', lambda: self.client.get(reverse('password_reset')))
+        self.assertWithinBudget('password_reset_done', lambda: self.client.get(reverse('password_reset_done')))
+        self.assertWithinBudget('password_reset_confirm', lambda: self.client.get(
+            reverse('password_reset_confirm', kwargs={'uidb64': 'MQ', 'token': 'set-password'})))
+        self.assertWithinBudget('password_reset_complete', lambda: self.client.get(reverse('password_reset_complete')))
+
+
+class CatalogCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_bump_version_changes_keys(self):
+        key = make_key('test', ['books'], [Book, Author])
+        self.assertEqual(make_key('test', ['books'], [Book, Author]), key)
+        bump_version(Author)
+        self.assertNotEqual(make_key('test', ['books'], [Book, Author]), key)
+
+    def test_concurrent_misses_are_coalesced(self):
+        calls = []
+        started = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_or_compute('coalesce', compute))) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_token_bucket(self):
+        with mock.patch('librarySystem.throttling.time.time', return_value=1000.0) as clock:
+            self.assertIsNone(take_tokens('bucket', 4, 10, 60))
+            self.assertIsNone(take_tokens('bucket', 4, 10, 60))
+            # 2 tokens left; 2 more refill in 12 seconds
+            self.assertAlmostEqual(take_tokens('bucket', 4, 10, 60), 12, places=2)
+            self.assertIsNone(take_tokens('bucket', 2, 10, 60))
+            clock.return_value += 12
+            self.assertIsNone(take_tokens('bucket', 2, 10, 60))
+            # long idle: full again, but never more than the capacity
+            clock.return_value += 3600
+            self.assertIsNone(take_tokens('bucket', 10, 10, 60))
+            self.assertIsNotNone(take_tokens('bucket', 1, 10, 60))
+
+    def test_token_bucket_refill_keeps_concurrent_takes(self):
+        with mock.patch('librarySystem.throttling.time.time', return_value=1000.0):
+            self.assertIsNone(take_tokens('bucket', 1, 10, 60))
+
+        incr, interleaved = cache.incr, []
+
+        def incr_then_interleave(key, delta=1, version=None):
+            value = incr(key, delta, version)
+            if not interleaved:
+                # another request takes tokens between this one's incr and its refill
+                interleaved.append(None)
+                interleaved[0] = take_tokens('bucket', 4, 10, 60)
+            return value
+
+        with mock.patch('librarySystem.throttling.time.time', return_value=1300.0), \
+                mock.patch('librarySystem.throttling.cache.incr', incr_then_interleave):
+            self.assertIsNone(take_tokens('bucket', 4, 10, 60))
+            self.assertEqual(interleaved, [None])
+            # both requests' tokens were taken from the refilled bucket: 2 left
+            self.assertIsNotNone(take_tokens('bucket', 3, 10, 60))
+            self.assertIsNone(take_tokens('bucket', 2, 10, 60))
+
+
+class StockReservationTestCase(TransactionTestCase):
+    def test_concurrent_reservations_never_oversell(self):
+        library = Library.objects.create(name="Central Library")
+        branch = LibraryBranch.objects.create(library=library, location_lat=0, location_long=0, address="1 Main St")
+        book = Book.objects.create(ISBN="12345", name="Book One", category="Fiction")
+        stock = BookStock.objects.create(book=book, library_branch=branch, count=25)
+
+        results = []
+        barrier = threading.Barrier(20)
+
+        def borrow_many():
+            barrier.wait()
+            try:
+                for _ in range(5):
+                    while True:
+                        try:
+                            with transaction.atomic():
+                                results.append(reserve_copy(book, branch))
+                            break
+                        except OperationalError:  # SQLite reports write contention instead of blocking
+                            time.sleep(0.001)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=borrow_many) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stock.refresh_from_db()
+        self.assertEqual(results.count(True), 25)
+        self.assertEqual(results.count(False), 75)
+        self.assertEqual(stock.count, 0)
+
+
+class LoadTestTestCase(TransactionTestCase):
+    # the load test's requests run in other threads, so the dataset must be committed
+
+    def test_mix_covers_every_route(self):
+        self.assertEqual(set(MIX), {pattern.name for pattern in urlpatterns})
+
+    def test_seed_and_load(self):
+        call_command('seed_synthetic', libraries=2, branches_per_library=2, authors=20, books=60, users=15,
+                     borrows=300, days=60, seed=1, prefix='t', stdout=StringIO())
+        self.assertEqual(Book.objects.filter(ISBN__startswith='t-').count(), 60)
+        self.assertEqual(User.objects.filter(username__startswith='t-user-').count(), 15)
+        self.assertTrue(User.objects.get(username='t-admin').is_staff)
+        for user in User.objects.filter(username__startswith='t-user-'):
+            open_borrows = Borrow.objects.filter(user=user, return_date__isnull=True).count()
+            self.assertEqual(user.active_borrows, open_borrows)
+            self.assertLessEqual(open_borrows, user.max_borrows)
+        self.assertTrue(search.search_books(Book.objects.first().name))
+        self.assertTrue(RelatedBook.objects.exists())
+        with self.assertRaises(CommandError):
+            call_command('seed_synthetic', books=1, prefix='t', stdout=StringIO())
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'report.json')
+            call_command('loadtest', prefix='t', requests=120, warmup=0, concurrency=1, users=5, output=path, stdout=StringIO())
+            with open(path) as stream:
+                report = json.load(stream)
+            self.assertEqual(report['total']['requests'], 120)
+            self.assertEqual(report['total']['errors'], 0)
+            self.assertLessEqual(set(report['routes']), set(MIX))
+            for stats in report['routes'].values():
+                self.assertLessEqual(stats['p50_ms'], stats['p95_ms'])
+                self.assertLessEqual(stats['p95_ms'], stats['p99_ms'])
+
+            out = StringIO()
+            call_command('loadtest', prefix='t', requests=60, warmup=0, concurrency=2, users=5, interface='asgi',
+                         routes=['book-list', 'async-book-list'], compare=path, stdout=out)
+            self.assertIn('The runs differ in interface, concurrency, requests, routes', out.getvalue())
@@ -0,0 +1,121 @@
+"""
+Cost-aware token-bucket throttles.
+
+Each bucket holds `N` tokens and refills at N per period, as configured by
+the "N/period" rate of its scope in REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'].
+A request takes `throttle_cost` tokens (1 unless the view says otherwise), so
+expensive views such as login (PBKDF2) drain a bucket faster than cheap
+reads. There is one bucket per user, one per client IP and one shared by
+everyone; a request must fit in all that apply, and is charged to none of
+them if it does not. Logins are anonymous, so
+they also draw from a bucket per submitted username, which bounds password
+guessing against one account however many addresses it comes from.
+
+Client IPs are REMOTE_ADDR, or an X-Forwarded-For entry only when
+REST_FRAMEWORK['NUM_PROXIES'] says how many trusted proxies added to it;
+otherwise a client could pick a fresh bucket with every request.
+
+Buckets live in the shared cache so every worker sees the same state. Each is
+stored as the time, in milliseconds, at which it will be full again (the
+generic cell rate algorithm, equivalent to a token bucket): taking tokens
+pushes that time forward with an atomic cache.incr, and a bucket that has
+filled up is moved forward to the present with another, never a set, so
+concurrent requests never spend the same tokens twice.
+
+DRF checks throttles in APIView.initial(), before the handler runs, so a
+rejected request does no hashing and no database work.
+"""
+import time
+
+from django.core.cache import cache
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle, SimpleRateThrottle
+
+
+def take_tokens(key, cost, capacity, period):
+    """
+    Take `cost` tokens from the bucket at `key`, which holds `capacity` tokens
+    refilled over `period` seconds. Return None if they were taken, otherwise
+    the seconds until they will be available.
+    """
+    now = int(time.time() * 1000)
+    step = max(cost * period * 1000 // capacity, 1)
+    timeout = period * 10
+
+    full_at = cache.get(key)
+    try:
+        if full_at is not None and full_at < now and cache.add(f'{key}:refill', 1, 1):
+            # the bucket has filled up again; move it forward to start full now. An incr,
+            # not a set, so tokens concurrent requests take meanwhile still count. The
+            # marker keeps them from moving it too; for its second, a bucket that fills
+            # up again is not moved, which lets at most a second of refill through early.
+            cache.incr(key, now - full_at)
+        full_at = cache.incr(key, step)
+    except ValueError:
+        # a new or expired bucket
+        cache.add(key, now, timeout)
+        full_at = cache.incr(key, step)
+
+    if full_at - now > period * 1000:
+        cache.decr(key, step)  # give the tokens back
+        # busy buckets are otherwise never rewritten; don't let them expire full
+        cache.touch(key, timeout)
+        return (full_at - now - period * 1000) / 1000
+    return None
+
+
+def give_tokens(key, cost, capacity, period):
+    """Return `cost` tokens taken from the bucket at `key` by take_tokens."""
+    try:
+        cache.decr(key, max(cost * period * 1000 // capacity, 1))
+    except ValueError:
+        pass  # expired meanwhile, and so full
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Every bucket of a request, checked in `scopes` order. When one refuses,
+    the tokens already taken from the earlier ones are given back, so a client
+    over its own limit never drains the buckets it shares with others.
+    """
+    scopes = ('bucket-ip', 'bucket-user', 'bucket-global')
+
+    def get_bucket(self, scope, request, view):
+        """The bucket of `scope` this request draws from, or None if it has none."""
+        if scope == 'bucket-ip':
+            return self.get_ident(request)
+        if scope == 'bucket-user':
+            return request.user.pk if request.user and request.user.is_authenticated else None
+        if scope == 'bucket-login':
+            username = request.data.get('username')
+            return str(username).lower() if username else None
+        if scope == 'bucket-global':
+            return 'all'
+        raise ValueError(f"Unknown throttle scope {scope!r}")
+
+    def allow_request(self, request, view):
+        self.retry_after = None
+        cost = getattr(view, 'throttle_cost', 1)
+        taken = []
+        for scope in self.scopes:
+            rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope)
+            bucket = self.get_bucket(scope, request, view) if rate is not None else None
+            if bucket is None:
+                continue
+            key = f'throttle:{scope}:{bucket}'
+            capacity, period = SimpleRateThrottle.parse_rate(None, rate)
+            self.retry_after = take_tokens(key, cost, capacity, period)
+            if self.retry_after is not None:
+                for args in taken:
+                    give_tokens(*args)
+                return False
+            taken.append((key, cost, capacity, period))
+        return True
+
+    def wait(self):
+        return self.retry_after
+
+
+class LoginTokenBucketThrottle(TokenBucketThrottle):
+    """For login views: logins are anonymous, so a bucket per submitted username instead of per user."""
+    scopes = ('bucket-ip', 'bucket-login', 'bucket-global')
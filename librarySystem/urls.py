@@ -1,6 +1,6 @@
 from django.urls import path
 from django.contrib.auth import views as auth_views
-from .views import library, base, borrows, user
+from .views import asynchronous, library, base, borrows, reports, user
 
 urlpatterns = [
     # Library Management
@@ -9,6 +9,10 @@ urlpatterns = [
     # ability to filter by get params (by book categories, authors)
     # include distances between users and nearby libraries 
 
+    path('branches/nearby/', library.NearbyBranchView.as_view(), name='branch-nearby'),
+    # k closest branches to ?lat=&long= (default: the user's location)
+    # optional radius_km bound and limit, sorted by distance
+
     # Author Management
     path('authors/', library.AuthorListView.as_view(), name='author-list'),  
     # List all authors with book count
@@ -20,6 +24,13 @@ urlpatterns = [
     # ability to filter by category, library, and author
     # results contain author 
 
+    path('books/search', library.BookSearchView.as_view(), name='book-search'),
+    # Full-text search over book name, ISBN, author names and category (?q=)
+    # every word matches as a prefix, best matches first
+
+    path('books/<str:isbn>/related', library.RelatedBookView.as_view(), name='book-related'),
+    # "Also borrowed": books most often borrowed by the same users, precomputed hourly
+
     # Loaded Authors
     path('authors/full', library.LoadedAuthorListView.as_view(), name='author-loaded-list'),  
     # List all authors with their book objects
@@ -28,12 +39,37 @@ urlpatterns = [
     # Borrowing Books
     path('borrow/', borrows.BorrowBookView.as_view(), name='borrow-book'),  # Borrow a book
     path('return/', borrows.ReturnBookView.as_view(), name='return-book'),  # Return a borrowed book
+    path('borrow/batch', borrows.BatchBorrowView.as_view(), name='borrow-batch'),  # Borrow up to 50 books at once
+    path('return/batch', borrows.BatchReturnView.as_view(), name='return-batch'),  # Return up to 50 books at once
     # endpoints for borrowing and returning books in the library management systems, there are some business rules:
     # Allow up to 3 books; return one to borrow a 4th
     # Users must specify a return date (max 1 month); late returns incur a daily penalty
     # Send confirmation emails upon borrowing
     # Schedule to Send daily reminders in the last 3 days of the borrowing period
 
+    path('penalties/', borrows.CalculatePenaltyView.as_view(), name='penalties'),
+    # The user's lifetime penalty total and overdue books, as of the last accrual
+
+    # Reports (admin only)
+    path('export/<str:entity>/', reports.ExportView.as_view(), name='export'),
+    # Stream books, authors, book_authors, branches, stock or borrows as ?output=ndjson (default) or csv
+    path('penalties/totals', reports.PenaltyTotalsView.as_view(), name='penalty-report'),
+    # Users with a penalty total, largest first (cursor paginated)
+    path('stats/<str:dimension>/', reports.CirculationStatsView.as_view(), name='circulation-stats'),
+    # Daily borrows/returns per category, library or author (?from=&to=&key=), read from rollup tables
+
+    # Async (ASGI): the same responses as the routes above, served by async views
+    path('async/libraries/', asynchronous.AsyncLibraryListView.as_view(), name='async-library-list'),
+    path('async/branches/nearby/', asynchronous.AsyncNearbyBranchView.as_view(), name='async-branch-nearby'),
+    path('async/authors/', asynchronous.AsyncAuthorListView.as_view(), name='async-author-list'),
+    path('async/authors/full', asynchronous.AsyncLoadedAuthorListView.as_view(), name='async-author-loaded-list'),
+    path('async/books/', asynchronous.AsyncBookListView.as_view(), name='async-book-list'),
+    path('async/books/search', asynchronous.AsyncBookSearchView.as_view(), name='async-book-search'),
+    path('async/books/<str:isbn>/related', asynchronous.AsyncRelatedBookView.as_view(), name='async-book-related'),
+    path('async/penalties/', asynchronous.AsyncCalculatePenaltyView.as_view(), name='async-penalties'),
+    path('async/borrow/', asynchronous.AsyncBorrowBookView.as_view(), name='async-borrow-book'),
+    path('async/return/', asynchronous.AsyncReturnBookView.as_view(), name='async-return-book'),
+
     # User
     path('register/', user.UserRegisterView.as_view(), name='register'),
     path('login/', user.UserLoginView.as_view(), name='login'),
@@ -0,0 +1,125 @@
+"""
+Bulk user provisioning.
+
+Each CSV row describes one user:
+
+    username, email, password, first_name, last_name, max_borrows, location_lat, location_long
+
+Only username and password are required; empty columns take the model
+defaults. Passwords must pass AUTH_PASSWORD_VALIDATORS, as they must on
+registration. Password hashing (PBKDF2) dominates the cost of creating a user, so
+it runs in a process pool across all cores while the previous batch is being
+written. Every batch is one transaction that bulk creates the User rows and
+their authtoken Token rows, the same pair UserRegisterView creates per call.
+Usernames that already exist are skipped, before their passwords are hashed.
+"""
+import csv
+import os
+
+import django
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.password_validation import validate_password
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+from .models import User
+
+
+FIELDS = ('username', 'email', 'password', 'first_name', 'last_name', 'max_borrows', 'location_lat', 'location_long')
+NUMBERS = {'max_borrows': int, 'location_lat': float, 'location_long': float}
+COORDINATE_LIMITS = {'location_lat': 90, 'location_long': 180}
+BATCH_SIZE = 1000
+
+
+class UserImportError(ValueError):
+    pass
+
+
+def parse_user(record, number):
+    """Validate one CSV row into keyword arguments for User."""
+    row = {field: (record.get(field) or '').strip() for field in FIELDS}
+    for field in ('username', 'password'):
+        if not row[field]:
+            raise UserImportError(f"record {number}: '{field}' is required")
+    row['username'] = User.normalize_username(row['username'])
+    row['email'] = User.objects.normalize_email(row['email'])
+    for field, kind in NUMBERS.items():
+        if not row[field]:
+            del row[field]
+            continue
+        try:
+            row[field] = kind(row[field])
+        except ValueError:
+            raise UserImportError(f"record {number}: '{field}' must be a number")
+    for field, limit in COORDINATE_LIMITS.items():
+        if field in row and not -limit <= row[field] <= limit:
+            raise UserImportError(f"record {number}: '{field}' must be between -{limit} and {limit}")
+    try:
+        # the same checks as UserRegisterSerializer, including similarity to the user's names
+        validate_password(row['password'], User(**{field: row[field] for field in ('username', 'email', 'first_name', 'last_name')}))
+    except ValidationError as exc:
+        raise UserImportError(f"record {number}: 'password' is invalid: {' '.join(exc.messages)}")
+    return row
+
+
+class UserImporter:
+    def __init__(self, batch_size=BATCH_SIZE, workers=None):
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count() or 1
+
+    def run(self, stream, progress=None):
+        """Import the users of CSV `stream`; call `progress(totals)` after each committed batch."""
+        totals = {'records': 0, 'users': 0, 'skipped': 0}
+        numbered = enumerate(csv.DictReader(stream), 1)
+        # workers started with spawn or forkserver rather than fork need django.setup() to hash;
+        # they only import Django itself, never this module and its models
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=django.setup) as pool:
+            pending = None  # the previous batch: its rows and their hashes, still being computed
+            while True:
+                try:
+                    rows = [parse_user(record, number) for number, record in islice(numbered, self.batch_size)]
+                except UserImportError:
+                    if pending:  # keep everything before the failing batch
+                        self.write_batch(*pending)
+                    raise
+                if not rows:
+                    break
+                totals['records'] += len(rows)
+                rows = self._new_users(rows, pending[0] if pending else [], totals)
+
+                passwords = [row.pop('password') for row in rows]
+                hashes = pool.map(make_password, passwords, chunksize=max(len(passwords) // (self.workers * 4), 1))
+                if pending:
+                    totals['users'] += self.write_batch(*pending)
+                    if progress:
+                        progress(totals)
+                pending = (rows, hashes)
+            if pending:
+                totals['users'] += self.write_batch(*pending)
+                if progress:
+                    progress(totals)
+        return totals
+
+    def _new_users(self, rows, pending, totals):
+        """Drop rows whose username exists, is about to be written (`pending`) or repeats; count them as skipped."""
+        taken = {row['username'] for row in pending}
+        taken.update(User.objects.filter(username__in=[row['username'] for row in rows]).values_list('username', flat=True))
+        new = []
+        for row in rows:
+            if row['username'] in taken:
+                totals['skipped'] += 1
+            else:
+                taken.add(row['username'])
+                new.append(row)
+        return new
+
+    def write_batch(self, rows, hashes):
+        with transaction.atomic():
+            users = User.objects.bulk_create([User(password=password, **row) for row, password in zip(rows, hashes)])
+            # bulk_create skips Token.save(), which is what generates the key
+            Token.objects.bulk_create([Token(key=Token.generate_key(), user=user) for user in users])
+        return len(users)
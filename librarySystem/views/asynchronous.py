@@ -0,0 +1,190 @@
+"""
+Async versions of the catalog reads and of borrow/return, under /api/async/.
+
+They answer exactly like their sync counterparts (and inherit their limits,
+parsing and serialization) but read with the async ORM, so under ASGI
+(`uvicorn project.asgi:application`) a request waiting on the database holds
+no thread. Work the async ORM cannot do is offloaded explicitly with
+sync_to_async: cursor pagination, the raw search and spatial index lookups,
+and the borrow and return transactions (Django has no async atomic()).
+"""
+import math
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.utils.timezone import now
+from rest_framework import serializers, status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from .. import search
+from ..geo import EARTH_RADIUS_KM, get_branch_index
+from ..models import Author, Book, Borrow, BookStock, Library, LibraryBranch, User
+from .base import AsyncAPIView, async_cached_catalog_view
+from .borrows import BatchBorrowItemSerializer, CalculatePenaltyView, borrow_book, return_book, returned_response
+from .library import (
+    AuthorListSerializer, AuthorListView, AuthorWithBooksSerializer, BookListView, BookSearchView, BookSerializer,
+    LibraryListSerializer, LibraryListView, LoadedAuthorListView, NearbyBranchView, RelatedBookView,
+    filter_authors, filter_books, filter_libraries, filter_loaded_authors, nearest_branch_distances,
+)
+
+
+class AsyncLibraryListView(AsyncAPIView, LibraryListView):
+    @async_cached_catalog_view(Library, LibraryBranch, BookStock, Book, Author, vary_on_user_location=True)
+    async def get(self, request, *args, **kwargs):
+        user = request.user
+        paginator, page = await self.paginate_queryset(filter_libraries(request.GET), request)
+        # the index is loaded from the database when this process has none yet
+        index = await sync_to_async(get_branch_index)()
+        distances = nearest_branch_distances(index, user, page)
+        serializer = LibraryListSerializer(page, many=True, context={'user': user, 'distances': distances})
+        return paginator.get_paginated_response(serializer.data)
+
+
+class AsyncNearbyBranchView(AsyncAPIView, NearbyBranchView):
+    @async_cached_catalog_view(LibraryBranch, vary_on_user_location=True)
+    async def get(self, request, *args, **kwargs):
+        try:
+            lat, long, radius_km, limit = self.parse_query(request)
+        except ValueError as exc:
+            return Response({"error": str(exc)}, status=400)
+
+        if radius_km is not None:
+            nearest = (await self.branches_within(lat, long, radius_km))[:limit]
+        else:
+            # k-nearest: widen the search box until it holds `limit` branches
+            max_radius_km = math.pi * EARTH_RADIUS_KM
+            search_radius_km = self.initial_radius_km
+            while True:
+                nearest = await self.branches_within(lat, long, search_radius_km)
+                if len(nearest) >= limit or search_radius_km >= max_radius_km:
+                    break
+                search_radius_km = min(search_radius_km * 4, max_radius_km)
+            nearest = nearest[:limit]
+
+        return self.serialize(nearest)
+
+    async def branches_within(self, lat, long, radius_km):
+        candidates = [branch async for branch in self.candidates(lat, long, radius_km)]
+        return self.by_distance(lat, long, radius_km, candidates)
+
+
+class AsyncAuthorListView(AsyncAPIView, AuthorListView):
+    @async_cached_catalog_view(Author, Book, BookStock, LibraryBranch, Library)
+    async def get(self, request, *args, **kwargs):
+        paginator, page = await self.paginate_queryset(filter_authors(request.GET), request)
+        return paginator.get_paginated_response(AuthorListSerializer(page, many=True).data)
+
+
+class AsyncBookListView(AsyncAPIView, BookListView):
+    @async_cached_catalog_view(Book, Author, BookStock, LibraryBranch, Library)
+    async def get(self, request, *args, **kwargs):
+        author = None
+        if request.GET.get('author'):
+            try:
+                author = await Author.objects.aget(name=request.GET['author'])
+            except Author.DoesNotExist:
+                return Response({"error": "Author not found"}, status=404)
+
+        paginator, page = await self.paginate_queryset(filter_books(request.GET, author), request)
+        return paginator.get_paginated_response(BookSerializer(page, many=True).data)
+
+
+class AsyncBookSearchView(AsyncAPIView, BookSearchView):
+    @async_cached_catalog_view(Book, Author)
+    async def get(self, request, *args, **kwargs):
+        try:
+            query, limit = self.parse_query(request)
+        except ValueError as exc:
+            return Response({"error": str(exc)}, status=400)
+
+        # the full-text index is queried with raw SQL
+        book_ids = await sync_to_async(search.search_books)(query, limit=max(limit, 1))
+        books = await Book.objects.prefetch_related('authors').ain_bulk(book_ids)
+        serializer = BookSerializer([books[book_id] for book_id in book_ids if book_id in books], many=True)
+        return Response(serializer.data)
+
+
+class AsyncRelatedBookView(AsyncAPIView, RelatedBookView):
+    async def get(self, request, isbn):
+        results = [self.result(row) async for row in self.related_rows(isbn)]
+        if not results and not await Book.objects.filter(ISBN=isbn).aexists():
+            return Response({"error": "Book not found."}, status=404)
+        return Response(results)
+
+
+class AsyncLoadedAuthorListView(AsyncAPIView, LoadedAuthorListView):
+    @async_cached_catalog_view(Author, Book, BookStock, LibraryBranch, Library)
+    async def get(self, request, *args, **kwargs):
+        paginator, page = await self.paginate_queryset(filter_loaded_authors(request.GET), request)
+        return paginator.get_paginated_response(AuthorWithBooksSerializer(page, many=True).data)
+
+
+class AsyncCalculatePenaltyView(AsyncAPIView, CalculatePenaltyView):
+    async def get(self, request, *args, **kwargs):
+        # penalty_total is not part of the cached user, so read it here rather than lazily
+        total = await User.objects.filter(pk=request.user.pk).values_list('penalty_total', flat=True).aget()
+        return Response({
+            'total': total,
+            'overdue': [self.overdue(row) async for row in self.overdue_rows(request.user)],
+        }, status=status.HTTP_200_OK)
+
+
+def does_not_exist(pk):
+    # the message BorrowBookSerializer's related fields give
+    return [f'Invalid pk "{pk}" - object does not exist.']
+
+
+class AsyncBorrowBookView(AsyncAPIView):
+    permission_classes = [IsAuthenticated]
+
+    async def post(self, request, *args, **kwargs):
+        # plain ids: the rows are fetched with the async ORM below
+        serializer = BatchBorrowItemSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+        user = request.user
+
+        book = await Book.objects.filter(pk=data['book']).afirst()
+        library_branch = await LibraryBranch.objects.filter(pk=data['library_branch']).afirst()
+        errors = {}
+        if book is None:
+            errors['book'] = does_not_exist(data['book'])
+        if library_branch is None:
+            errors['library_branch'] = does_not_exist(data['library_branch'])
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        if data['expected_return_date'] > now().date() + timedelta(days=user.borrow_max_days):
+            return Response(
+                {"non_field_errors": [f"The return date cannot exceed {user.borrow_max_days} days from today."]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            await sync_to_async(borrow_book)(user, book, library_branch, data['expected_return_date'])
+        except serializers.ValidationError as exc:
+            return Response({"non_field_errors": exc.detail}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"message": "Book borrowed successfully"}, status=status.HTTP_201_CREATED)
+
+
+class ReturnItemSerializer(serializers.Serializer):
+    book = serializers.IntegerField()
+
+
+class AsyncReturnBookView(AsyncAPIView):
+    permission_classes = [IsAuthenticated]
+
+    async def post(self, request, *args, **kwargs):
+        serializer = ReturnItemSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        book_id = serializer.validated_data['book']
+
+        borrow = await Borrow.objects.filter(user=request.user, book_id=book_id, return_date__isnull=True).afirst()
+        if borrow is None:
+            if not await Book.objects.filter(pk=book_id).aexists():
+                return Response({'book': does_not_exist(book_id)}, status=status.HTTP_400_BAD_REQUEST)
+            return returned_response(None, None)
+        late = await sync_to_async(return_book)(request.user, borrow)
+        return returned_response(borrow, late)
@@ -0,0 +1,270 @@
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseBase, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.db.models import Q
+from django.utils.http import quote_etag
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.views import APIView
+
+from ..caching import aget_or_compute, get_or_compute, make_key
+
+
+class CatalogCursorPagination(CursorPagination):
+    """
+    Keyset pagination for catalog listings.
+
+    Pages are selected with `WHERE <ordering> > <cursor position>` on the view's
+    `ordering` column, so deep pages cost the same as the first one. Cursors are
+    opaque; the page size can be set per request with `?page_size=`.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, 'ordering', self.ordering)
+        return (ordering,) if isinstance(ordering, str) else tuple(ordering)
+
+
+class KeysetCursorPagination(CatalogCursorPagination):
+    """
+    Keyset pagination on a compound `ordering` whose columns are unique together,
+    such as `('-penalty_total', 'id')`.
+
+    CursorPagination positions a cursor on the first column only and falls back
+    to an offset (capped at 1000) for rows sharing it, so long runs of equal
+    values repeat rows. Here the cursor holds the whole key of the row it stops
+    at and pages are selected with `(a, b) > (last_a, last_b)` over every column,
+    in each column's direction, so no offset is needed.
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        position = None
+        if self.cursor is not None and self.cursor.position is not None:
+            try:
+                position = json.loads(self.cursor.position)
+            except ValueError:
+                raise NotFound(self.invalid_cursor_message)
+            if not isinstance(position, list) or len(position) != len(self.ordering):
+                raise NotFound(self.invalid_cursor_message)
+
+        ordering = [
+            (order[1:] if order.startswith('-') else '-' + order) if reverse else order
+            for order in self.ordering
+        ]
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.following(ordering, position))
+
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_following = len(results) > len(self.page)
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_following
+        else:
+            self.has_next, self.has_previous = has_following, position is not None
+        if self.page:
+            self.next_position = self.key(self.page[-1])
+            self.previous_position = self.key(self.page[0])
+        else:
+            self.next_position = self.previous_position = position
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    @staticmethod
+    def following(ordering, position):
+        """Rows after `position` in `ordering`: a > x, or a = x and b > y, and so on."""
+        condition, equal = Q(pk__in=[]), Q()
+        for order, value in zip(ordering, position):
+            field = order.lstrip('-')
+            condition |= equal & Q(**{f"{field}__{'lt' if order.startswith('-') else 'gt'}": value})
+            equal &= Q(**{field: value})
+        return condition
+
+    def key(self, instance):
+        return [str(getattr(instance, order.lstrip('-'))) for order in self.ordering]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=json.dumps(self.next_position)))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=json.dumps(self.previous_position)))
+
+
+def wants_stream(request):
+    return request.GET.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def stream_json_array(queryset, serializer_class, chunk_size=500, context=None):
+    """
+    Stream `queryset` as a JSON array without building the whole list.
+
+    Rows are read with `queryset.iterator(chunk_size)` (prefetches are applied per
+    chunk) and each chunk is serialized and written out before the next one is
+    fetched, so memory stays bounded by `chunk_size`. Queries run while the body
+    is sent, after middleware has seen the response.
+    """
+    def generate():
+        yield '['
+        separator = ''
+        batch = []
+        rows = queryset.iterator(chunk_size=chunk_size)
+        while True:
+            batch.clear()
+            for obj in rows:
+                batch.append(obj)
+                if len(batch) == chunk_size:
+                    break
+            if not batch:
+                break
+            items = serializer_class(batch, many=True, context=context).data
+            yield separator + ','.join(json.dumps(item, cls=JSONEncoder) for item in items)
+            separator = ','
+        yield ']'
+
+    return StreamingHttpResponse(generate(), content_type='application/json')
+
+
+def catalog_cache_key(request, models, vary_on_user_location=False):
+    """(cache key, ETag) of the catalog response to `request`, from the current versions of `models`."""
+    params = sorted((name, sorted(values)) for name, values in request.GET.lists())
+    parts = [request.get_host(), request.path, params]
+    if vary_on_user_location:
+        parts.append((request.user.location_lat, request.user.location_long))
+    key = make_key('catalog:view', parts, models)
+    return key, quote_etag(key.rsplit(':', 1)[1])
+
+
+def _data_to_cache(response):
+    if isinstance(response, Response) and response.status_code == 200:
+        return response.data
+    return None
+
+
+def _add_etag(response, etag):
+    if response.status_code == 200:
+        response['ETag'] = etag
+    return response
+
+
+def cached_catalog_view(*models, vary_on_user_location=False):
+    """
+    Cache a catalog GET handler's response data, keyed on the endpoint, its
+    normalized query parameters and the versions of `models` it reads.
+
+    The key is also sent as the response's ETag, and If-None-Match requests
+    that still match get a 304 before the handler runs. There is no
+    Last-Modified: versions can change several times within the one-second
+    resolution of HTTP dates.
+
+    Set `vary_on_user_location` for views whose output depends on where the
+    requesting user is; their key and ETag include the location. Streamed
+    responses are never cached.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            if wants_stream(request):
+                return method(view, request, *args, **kwargs)
+
+            key, etag = catalog_cache_key(request, models, vary_on_user_location)
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                return not_modified
+
+            responses = []
+
+            def compute():
+                responses.append(method(view, request, *args, **kwargs))
+                return _data_to_cache(responses[0])
+
+            data = get_or_compute(key, compute)
+            return _add_etag(responses[0] if responses else Response(data), etag)
+        return wrapper
+    return decorator
+
+
+def async_cached_catalog_view(*models, vary_on_user_location=False):
+    """cached_catalog_view for async handlers."""
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(view, request, *args, **kwargs):
+            key, etag = await sync_to_async(catalog_cache_key)(request, models, vary_on_user_location)
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                return not_modified
+
+            responses = []
+
+            async def compute():
+                responses.append(await method(view, request, *args, **kwargs))
+                return _data_to_cache(responses[0])
+
+            data = await aget_or_compute(key, compute)
+            return _add_etag(responses[0] if responses else Response(data), etag)
+        return wrapper
+    return decorator
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView whose handlers are coroutines, for the /api/async/ routes.
+
+    DRF's dispatch is synchronous, so this one awaits the handler instead.
+    Authentication, permissions and throttles (cache lookups, and a user query
+    when the auth cache is cold) run together in one sync_to_async call before
+    it. Handlers use the async ORM and offload any other blocking work the same
+    way; Django views whose handlers are all `async def` are served without a
+    thread under ASGI.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+            response = handler(request, *args, **kwargs)
+            if not isinstance(response, HttpResponseBase):  # OPTIONS is answered synchronously
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def paginate_queryset(self, queryset, request):
+        """
+        (paginator, page of `queryset`). CursorPagination evaluates the page and
+        its prefetches itself, so that runs in one sync_to_async call.
+        """
+        paginator = self.pagination_class()
+        page = await sync_to_async(paginator.paginate_queryset)(queryset, request, view=self)
+        return paginator, page
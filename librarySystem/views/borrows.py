@@ -3,28 +3,30 @@ from rest_framework.response import Response
 from rest_framework import status, serializers
 from django.utils.timezone import now
 from datetime import timedelta
-from celery import shared_task
-from django.core.mail import send_mail
 from rest_framework.permissions import IsAuthenticated
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
 
-from ..models import Borrow
+from ..models import Book, Borrow, BookStock, PenaltyAccrual, User
+from ..outbox import queue_email
+from ..penalties import close_penalties
+from ..stats import record_borrows, record_returns
 
 
 # Serializer
 class BorrowBookSerializer(serializers.ModelSerializer):
     class Meta:
         model = Borrow
-        fields = ['book', 'expected_return_date']
+        fields = ['book', 'library_branch', 'expected_return_date']
+        extra_kwargs = {'library_branch': {'required': True, 'allow_null': False}}
 
     def validate(self, data):
         user = self.context['request'].user
         book = data['book']
         expected_return_date = data['expected_return_date']
-        
-        # Ensure user has not borrowed more than 3 books
-        borrowed_books_count = Borrow.objects.filter(user=user, return_date__isnull=True).count()
-        if borrowed_books_count >= user.max_borrows:
-            raise serializers.ValidationError("You can only borrow up to 3 books at a time. Please return a book to borrow a new one.")
+
+        # The max_borrows quota is enforced atomically when the borrow is saved
 
         # Ensure expected return date is within the allowed period
         max_borrow_period = now().date() + timedelta(days=user.borrow_max_days)
@@ -50,23 +52,158 @@ class ReturnBookSerializer(serializers.ModelSerializer):
     
 
 
+MAX_BATCH_SIZE = 50
+
+
+class BatchBorrowItemSerializer(serializers.Serializer):
+    # plain ids: books and stock are looked up for the whole batch at once
+    book = serializers.IntegerField()
+    library_branch = serializers.IntegerField()
+    expected_return_date = serializers.DateField()
+
+
+class BatchBorrowSerializer(serializers.Serializer):
+    items = BatchBorrowItemSerializer(many=True, allow_empty=False, max_length=MAX_BATCH_SIZE)
+
+
+class BatchReturnSerializer(serializers.Serializer):
+    books = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=MAX_BATCH_SIZE)
+
+
 class CalculatePenaltyView(APIView):
-    def get(self, request, *args, **kwargs):
-        user = request.user
-        borrows = Borrow.objects.filter(user=user, return_date__isnull=True)
-        penalties = {}
+    permission_classes = [IsAuthenticated]
+
+    @staticmethod
+    def overdue_rows(user):
+        # Balance and accruals are precomputed by the nightly accrue_penalties task
+        # and on every return (librarySystem.penalties)
+        return (
+            PenaltyAccrual.objects.filter(user=user, final=False)
+            .order_by('borrow__expected_return_date')
+            .values('borrow__book__ISBN', 'days_overdue', 'amount', 'accrued_on')
+        )
 
-        for borrow in borrows:
-            overdue_days = (now().date() - borrow.expected_return_date).days
-            if overdue_days > 0:
-                penalties[borrow.book.ISBN] = f'{overdue_days} days overdue'
+    @staticmethod
+    def overdue(row):
+        return {'book': row['borrow__book__ISBN'], 'days_overdue': row['days_overdue'], 'amount': row['amount'], 'as_of': row['accrued_on']}
 
-        if not penalties:
-            return Response({'message': 'No overdue books.'}, status=status.HTTP_200_OK)
-        return Response(penalties, status=status.HTTP_200_OK)
+    def get(self, request, *args, **kwargs):
+        return Response({
+            'total': request.user.penalty_total,
+            'overdue': [self.overdue(row) for row in self.overdue_rows(request.user)],
+        }, status=status.HTTP_200_OK)
     
 
 
+# Quota
+def take_borrow_slot(user):
+    """Count a new open borrow against the user's quota; False if it is full."""
+    # guarded UPDATE: two parallel borrows can never both take the last slot
+    taken = User.objects.filter(
+        pk=user.pk, active_borrows__lt=F('max_borrows')
+    ).update(active_borrows=F('active_borrows') + 1)
+    return taken > 0
+
+
+def release_borrow_slot(user):
+    # unconditional, so it also locks the user's row when the count is already 0
+    User.objects.filter(pk=user.pk).update(active_borrows=Greatest(F('active_borrows') - 1, 0))
+
+
+def lock_user(user):
+    """
+    Lock the user's row until the transaction ends; return (active_borrows, max_borrows).
+
+    The no-op UPDATE takes the row lock on PostgreSQL and the write lock on
+    SQLite (where select_for_update does nothing). Every borrow and return
+    writes the user's row before their Borrow and BookStock rows (single ones
+    with take_borrow_slot and release_borrow_slot), so all of them lock in the
+    same order: they wait for each other instead of deadlocking, and the
+    user's open borrows that a batch reads afterwards cannot change under it
+    before it commits.
+    """
+    User.objects.filter(pk=user.pk).update(active_borrows=F('active_borrows'))
+    return User.objects.values_list('active_borrows', 'max_borrows').get(pk=user.pk)
+
+
+# Stock
+def reserve_copy(book, library_branch):
+    """Take one copy off the branch's shelf; False if none are left."""
+    # a single conditional UPDATE, so concurrent borrows can never oversell
+    reserved = BookStock.objects.filter(
+        book=book, library_branch=library_branch, count__gt=0
+    ).update(count=F('count') - 1)
+    return reserved > 0
+
+
+def release_copy(book, library_branch):
+    """Put a returned copy back on the shelf it was taken from."""
+    if library_branch is None:  # borrowed before branches were recorded
+        return
+    BookStock.objects.filter(book=book, library_branch=library_branch).update(count=F('count') + 1)
+
+
+# Borrow and return
+def borrow_book(user, book, library_branch, expected_return_date):
+    """
+    Record a borrow of `book` from `library_branch`; raise ValidationError if
+    the user's quota is full or the branch has no copy left.
+    """
+    with transaction.atomic():
+        # Quota slot, copy and borrow row are taken together or not at all
+        if not take_borrow_slot(user):
+            raise serializers.ValidationError(
+                f"You can only borrow up to {user.max_borrows} books at a time. Please return a book to borrow a new one."
+            )
+        if not reserve_copy(book, library_branch):
+            raise serializers.ValidationError("No copies of this book are available at this branch.")
+        borrow = Borrow.objects.create(
+            user=user, book=book, library_branch=library_branch,
+            borrow_date=now().date(), expected_return_date=expected_return_date,
+        )
+        record_borrows([borrow.id])
+
+        # Confirmation email, sent by the drain_email_outbox task once this commits
+        queue_email(
+            'Book Borrowed Successfully',
+            f'You have successfully borrowed {borrow.book.name}. Please return it by {borrow.expected_return_date}.',
+            user.email,
+        )
+    return borrow
+
+
+def return_book(user, borrow):
+    """
+    Close the open `borrow` and put the copy back; return {borrow id: (days
+    late, penalty)} if it was late, or None if a concurrent return closed it first.
+    """
+    return_date = now().date()
+    with transaction.atomic():
+        # the user's row first, then the borrow and the stock, in lock_user's order
+        release_borrow_slot(user)
+        # Close the borrow only if no concurrent return got there first
+        if not Borrow.objects.filter(pk=borrow.pk, return_date__isnull=True).update(return_date=return_date):
+            transaction.set_rollback(True)  # and keep the slot
+            return None
+        release_copy(borrow.book_id, borrow.library_branch_id)
+        record_returns([borrow.id])
+        borrow.return_date = return_date
+        # Penalty if late, recorded in the ledger with the return
+        return close_penalties(user, [borrow])
+
+
+def returned_response(borrow, late):
+    if late is None:
+        return Response(
+            {"non_field_errors": ["This book is not currently borrowed by the user."]},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if late:
+        days_late, penalty = late[borrow.id]
+        return Response({"message": f"Book returned successfully. Late by {days_late} days. Penalty incurred: ${penalty}.", "penalty" : penalty})
+    return Response({"message": "Book returned successfully"})
+
+
 # Endpoint Views 
 class BorrowBookView(APIView):
     permission_classes = [IsAuthenticated]
@@ -74,27 +211,13 @@ class BorrowBookView(APIView):
     def post(self, request, *args, **kwargs):
         serializer = BorrowBookSerializer(data=request.data, context={'request': request})
         if serializer.is_valid():
-            borrow = serializer.save(user=request.user, borrow_date=now().date())
-
-            # Send confirmation email
-            send_mail(
-                'Book Borrowed Successfully',
-                f'You have successfully borrowed {borrow.book.name}. Please return it by {borrow.expected_return_date}.',
-                'library@example.com',
-                [request.user.email],
-            )
-
-            # Schedule reminders using celery
-            # Inside the BorrowBookView after saving the borrow instance:
-            borrow_period = (borrow.expected_return_date - now().date()).days
-            reminder_start_days = borrow_period - 3  # Start sending reminders 3 days before the return date
+            try:
+                borrow_book(request.user, **serializer.validated_data)
+            except serializers.ValidationError as exc:
+                return Response({"non_field_errors": exc.detail}, status=status.HTTP_400_BAD_REQUEST)
 
-            if reminder_start_days > 0:
-                # Calculate the countdown in seconds until the reminders should start
-                countdown_time = reminder_start_days * 24 * 60 * 60  # days to seconds
-
-                # Schedule the reminder emails using Celery
-                send_reminder_emails.apply_async((borrow.id,), countdown=countdown_time)
+            # Reminders in the last days of the borrow are sent by the daily
+            # send_due_reminders sweep (librarySystem.tasks)
 
             return Response({"message": "Book borrowed successfully"}, status=status.HTTP_201_CREATED)
         
@@ -107,42 +230,143 @@ class ReturnBookView(APIView):
     def post(self, request, *args, **kwargs):
         serializer = ReturnBookSerializer(data=request.data, context={'request': request})
         if serializer.is_valid():
-            borrow = Borrow.objects.get(user=request.user, book=serializer.validated_data['book'], return_date__isnull=True)
-            borrow.return_date = now().date()
-            borrow.save()
-
-            # Calculate penalty if late
-            if borrow.return_date > borrow.expected_return_date:
-                days_late = (borrow.return_date - borrow.expected_return_date).days
-                penalty = days_late * request.user.penalty_amount
-                return Response({"message": f"Book returned successfully. Late by {days_late} days. Penalty incurred: ${penalty}.", "penalty" : penalty})
-
-            return Response({"message": "Book returned successfully"})
+            borrow = Borrow.objects.filter(user=request.user, book=serializer.validated_data['book'], return_date__isnull=True).first()
+            late = return_book(request.user, borrow) if borrow is not None else None
+            return returned_response(borrow, late)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-    
 
-# Tasks
-@shared_task
-def send_reminder_emails(borrow_id):
-    try:
-        borrow = Borrow.objects.get(id=borrow_id)
-        user = borrow.user
-        book = borrow.book
-
-        # Send reminder email
-        send_mail(
-            'Book Return Reminder',
-            f'Dear {user.username},\n\nThis is a reminder that your borrowed book "{book.name}" is due on {borrow.expected_return_date}. Please return it on time to avoid penalties.\n\nThank you!',
-            'library@example.com',
-            [user.email],
+
+class BatchBorrowView(APIView):
+    """
+    Borrow up to MAX_BATCH_SIZE books in one request and one transaction.
+
+    Items are checked in order against the quota and the locked stock rows;
+    each gets its own result, and the ones that pass are written with a
+    constant number of statements whatever the batch size.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = BatchBorrowSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        items = serializer.validated_data['items']
+        user = request.user
+        today = now().date()
+        max_return_date = today + timedelta(days=user.borrow_max_days)
+
+        with transaction.atomic():
+            active_borrows, max_borrows = lock_user(user)
+            books = Book.objects.in_bulk({item['book'] for item in items})
+            pairs = Q()
+            for item in items:
+                pairs |= Q(book_id=item['book'], library_branch_id=item['library_branch'])
+            stock = {
+                (row.book_id, row.library_branch_id): row
+                for row in BookStock.objects.select_for_update().filter(pairs).order_by('id')
+            }
+
+            results, borrows, taken = [], [], {}
+            for item in items:
+                key = (item['book'], item['library_branch'])
+                row = stock.get(key)
+                if item['book'] not in books:
+                    error = "Book not found."
+                elif item['expected_return_date'] > max_return_date:
+                    error = f"The return date cannot exceed {user.borrow_max_days} days from today."
+                elif active_borrows + len(borrows) >= max_borrows:
+                    error = f"You can only borrow up to {max_borrows} books at a time. Please return a book to borrow a new one."
+                elif row is None or row.count <= 0:
+                    error = "No copies of this book are available at this branch."
+                else:
+                    error = None
+                if error:
+                    results.append({'book': item['book'], 'status': 'failed', 'error': error})
+                    continue
+                row.count -= 1
+                taken[key] = row
+                borrows.append(Borrow(
+                    user=user, book=books[item['book']], library_branch_id=item['library_branch'],
+                    borrow_date=today, expected_return_date=item['expected_return_date'],
+                ))
+                results.append({'book': item['book'], 'status': 'borrowed', 'expected_return_date': item['expected_return_date']})
+
+            if borrows:
+                Borrow.objects.bulk_create(borrows)
+                record_borrows(borrow.id for borrow in borrows)
+                BookStock.objects.bulk_update(taken.values(), ['count'])
+                User.objects.filter(pk=user.pk).update(active_borrows=F('active_borrows') + len(borrows))
+                queue_email(
+                    'Books Borrowed Successfully',
+                    'You have successfully borrowed:\n' + '\n'.join(
+                        f'{borrow.book.name}, due {borrow.expected_return_date}' for borrow in borrows
+                    ),
+                    user.email,
+                )
+
+        return Response(
+            {'borrowed': len(borrows), 'results': results},
+            status=status.HTTP_201_CREATED if borrows else status.HTTP_400_BAD_REQUEST,
         )
 
-        # Check if the reminder should continue for the next 2 days
-        days_remaining = (borrow.expected_return_date - now().date()).days
-        if 1 <= days_remaining <= 3 and borrow.return_date is None:
-            # Schedule the next reminder for the following day
-            send_reminder_emails.apply_async((borrow.id,), countdown=24 * 60 * 60)  # 1 day in seconds
 
-    except Borrow.DoesNotExist:
-        pass
\ No newline at end of file
+class BatchReturnView(APIView):
+    """
+    Return up to MAX_BATCH_SIZE books in one request and one transaction,
+    with the penalty of each late item and their total.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = BatchReturnSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        book_ids = serializer.validated_data['books']
+        user = request.user
+        today = now().date()
+
+        with transaction.atomic():
+            lock_user(user)
+            open_borrows = {}  # book id -> open borrows, oldest first
+            for borrow in Borrow.objects.filter(user=user, book_id__in=book_ids, return_date__isnull=True).order_by('id'):
+                open_borrows.setdefault(borrow.book_id, []).append(borrow)
+
+            results, returned, shelved = [], [], {}
+            for book_id in book_ids:
+                if not open_borrows.get(book_id):
+                    results.append({'book': book_id, 'status': 'failed', 'error': "This book is not currently borrowed by the user."})
+                    continue
+                borrow = open_borrows[book_id].pop(0)
+                borrow.return_date = today
+                returned.append(borrow)
+                if borrow.library_branch_id is not None:
+                    key = (borrow.book_id, borrow.library_branch_id)
+                    shelved[key] = shelved.get(key, 0) + 1
+                results.append({'book': book_id, 'status': 'returned', 'borrow': borrow.id})
+
+            if returned:
+                Borrow.objects.bulk_update(returned, ['return_date'])
+                record_returns(borrow.id for borrow in returned)
+                late = close_penalties(user, returned)
+                for result in results:
+                    if 'borrow' in result:
+                        result['days_late'], result['penalty'] = late.get(result.pop('borrow'), (0, 0))
+                if shelved:
+                    pairs = Q()
+                    for book_id, branch_id in shelved:
+                        pairs |= Q(book_id=book_id, library_branch_id=branch_id)
+                    stock = list(BookStock.objects.select_for_update().filter(pairs).order_by('id'))
+                    for row in stock:
+                        row.count += shelved[row.book_id, row.library_branch_id]
+                    BookStock.objects.bulk_update(stock, ['count'])
+                User.objects.filter(pk=user.pk).update(active_borrows=Greatest(F('active_borrows') - len(returned), 0))
+
+        return Response(
+            {
+                'returned': len(returned),
+                'total_penalty': sum(result.get('penalty', 0) for result in results),
+                'results': results,
+            },
+            status=status.HTTP_200_OK if returned else status.HTTP_400_BAD_REQUEST,
+        )
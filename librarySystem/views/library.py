@@ -5,9 +5,24 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework import generics, serializers
 from geopy.distance import geodesic
 # from ..serializers import LibrarySerializer, LoadedAuthorSerializer, AuthorSerializer, BookSerializer
-from django.db.models import Count
+from django.db.models import Count, Prefetch, Q
+import math
 from math import radians, sin, cos, sqrt, atan2
-from ..models import Author, Book, LibraryBranch, Library, Book, BookStock
+from ..models import Author, Book, LibraryBranch, Library, Book, BookStock, RelatedBook
+from .. import search
+from ..geo import EARTH_RADIUS_KM, bounding_box, get_branch_index, haversine_km
+from .base import CatalogCursorPagination, cached_catalog_view, stream_json_array, wants_stream
+
+
+def has_location(user):
+    return user.location_lat is not None and user.location_long is not None
+
+
+def nearest_branch_distances(index, user, libraries):
+    """{library id: km to its closest branch} for `libraries`; empty when the user has no location."""
+    if not has_location(user):
+        return {}
+    return index.nearest_by_library(user.location_lat, user.location_long, [library.id for library in libraries])
 
 
 class LibraryBranchSerializer(serializers.ModelSerializer):
@@ -16,7 +31,7 @@ class LibraryBranchSerializer(serializers.ModelSerializer):
         fields = ['library', 'location_lat', 'location_long', 'address']
     def get_distance(self, obj):
         user = self.context.get('user')
-        if user:
+        if user and has_location(user):
             if obj:
                 user_location = (user.location_lat, user.location_long)
                 branch_location = (obj.location_lat, obj.location_long)
@@ -25,6 +40,16 @@ class LibraryBranchSerializer(serializers.ModelSerializer):
         return None
 
 
+class NearbyBranchSerializer(LibraryBranchSerializer):
+    distance = serializers.SerializerMethodField()
+
+    class Meta(LibraryBranchSerializer.Meta):
+        fields = ['id', 'library', 'location_lat', 'location_long', 'address', 'distance']
+
+    def get_distance(self, obj):
+        return round(self.context['distances'][obj.id], 2)
+
+
 class LibrarySerializer(serializers.ModelSerializer):
     branches = LibraryBranchSerializer(many=True)
     
@@ -35,57 +60,143 @@ class LibrarySerializer(serializers.ModelSerializer):
 
 class LibraryListSerializer(serializers.ModelSerializer):
     distance = serializers.SerializerMethodField()
-    num_branches = serializers.SerializerMethodField()
+    num_branches = serializers.IntegerField(read_only=True)  # annotated by the view
 
     class Meta:
         model = Library
         fields = ['name', 'num_branches','distance']
     def get_distance(self, obj):
-        user = self.context.get('user')
-        if user:
-            closest_branch = obj.librarybranch_set.all().first()
-            if closest_branch:
-                user_location = (user.location_lat, user.location_long)
-                branch_location = (closest_branch.location_lat, closest_branch.location_long)
-                distance = geodesic(user_location, branch_location).km
+        # nearest-branch distances are computed once per request by the view
+        distances = self.context.get('distances')
+        if distances:
+            distance = distances.get(obj.id)
+            if distance is not None:
                 return round(distance, 2)
         return None
-    def get_num_branches(self, obj):
-        return obj.librarybranch_set.count()
+
+def filter_libraries(params):
+    # Filtering by book categories, authors, and optional distance calculation
+    category_filter = params.get('category')
+    author_filter = params.get('author')
+
+    libraries = Library.objects.annotate(num_branches=Count('librarybranch'))
+
+    # Filters are id__in subqueries rather than joins, so a library stocking
+    # several matching books appears once and num_branches stays exact
+    if category_filter:
+        branches = LibraryBranch.objects.filter(bookstock__book__category=category_filter)
+        libraries = libraries.filter(id__in=branches.values('library_id'))
+
+    if author_filter:
+        branches = LibraryBranch.objects.filter(bookstock__book__authors__name=author_filter)
+        libraries = libraries.filter(id__in=branches.values('library_id'))
+
+    return libraries
+
 
 # View for Library Management
 class LibraryListView(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = CatalogCursorPagination
+    ordering = 'name'
 
+    @cached_catalog_view(Library, LibraryBranch, BookStock, Book, Author, vary_on_user_location=True)
     def get(self, request, *args, **kwargs):
-        # Filtering by book categories, authors, and optional distance calculation
-        category_filter = request.GET.get('category')
-        author_filter = request.GET.get('author')
         user = request.user
+        libraries = filter_libraries(request.GET)
+
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(libraries, request, view=self)
 
-        libraries = Library.objects.all()
+        # Distance to each library's closest branch, from the spatial index (none without a user location)
+        distances = nearest_branch_distances(get_branch_index(), user, page)
 
-        if category_filter:
-            # books = Book.objects.filter(category=category_filter)
-            # branch_ids = BookStock.objects.filter(book__in=books).values_list('library_branch', flat=True).distinct()
-            # libraries = libraries.filter(librarybranch__id__in=branch_ids)
+        # Serialize the libraries with distance data
+        serializer = LibraryListSerializer(page, many=True, context={'user': user, 'distances': distances})
 
-            libraries = libraries.filter(librarybranch__bookstock__book__category=category_filter)
-        
-        if author_filter:
-            # authors = Author.objects.filter(name=author_filter)
-            # books = Book.objects.filter(authors__in=authors)
-            # branch_ids = BookStock.objects.filter(book__in=books).values_list('library_branch', flat=True).distinct()
-            # libraries = libraries.filter(librarybranch__id__in=branch_ids)
+        return paginator.get_paginated_response(serializer.data)
 
-            libraries = libraries.filter(librarybranch__bookstock__book__authors__name=author_filter)
 
-        # Serialize the libraries with distance data
-        serializer = LibraryListSerializer(libraries, many=True, context={'user': user})
 
-        return Response(serializer.data)
 
+# View for nearby branch search
+class NearbyBranchView(APIView):
+    permission_classes = [IsAuthenticated]
+    initial_radius_km = 25
+    default_limit = 10
+    max_limit = 100
+
+    @cached_catalog_view(LibraryBranch, vary_on_user_location=True)
+    def get(self, request, *args, **kwargs):
+        try:
+            lat, long, radius_km, limit = self.parse_query(request)
+        except ValueError as exc:
+            return Response({"error": str(exc)}, status=400)
+
+        if radius_km is not None:
+            nearest = self.branches_within(lat, long, radius_km)[:limit]
+        else:
+            # k-nearest: widen the search box until it holds `limit` branches
+            max_radius_km = math.pi * EARTH_RADIUS_KM
+            search_radius_km = self.initial_radius_km
+            while True:
+                nearest = self.branches_within(lat, long, search_radius_km)
+                if len(nearest) >= limit or search_radius_km >= max_radius_km:
+                    break
+                search_radius_km = min(search_radius_km * 4, max_radius_km)
+            nearest = nearest[:limit]
+
+        return self.serialize(nearest)
+
+    def parse_query(self, request):
+        """(lat, long, radius_km or None, limit) from the query string; ValueError if invalid."""
+        # Defaults to the requesting user's location
+        user = request.user
+        if not has_location(user) and ('lat' not in request.GET or 'long' not in request.GET):
+            raise ValueError("lat and long are required when the user has no location")
+        try:
+            lat = float(request.GET.get('lat', user.location_lat))
+            long = float(request.GET.get('long', user.location_long))
+            radius_km = request.GET.get('radius_km')
+            radius_km = float(radius_km) if radius_km is not None else None
+            limit = min(int(request.GET.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            raise ValueError("lat, long, radius_km and limit must be numbers")
+        if not (-90 <= lat <= 90 and -180 <= long <= 180):
+            raise ValueError("lat/long out of range")
+        if limit < 1 or (radius_km is not None and radius_km <= 0):
+            raise ValueError("radius_km and limit must be positive")
+        return lat, long, radius_km, limit
+
+    def serialize(self, nearest):
+        distances = {branch.id: distance for distance, branch in nearest}
+        serializer = NearbyBranchSerializer([branch for _, branch in nearest], many=True, context={'distances': distances})
+        return Response(serializer.data)
 
+    @staticmethod
+    def candidates(lat, long, radius_km):
+        """Branches in the bounding box of the `radius_km` circle."""
+        min_lat, max_lat, long_ranges = bounding_box(lat, long, radius_km)
+        in_long_range = Q()
+        for min_long, max_long in long_ranges:
+            in_long_range |= Q(location_long__range=(min_long, max_long))
+        return LibraryBranch.objects.filter(in_long_range, location_lat__range=(min_lat, max_lat))
+
+    @staticmethod
+    def by_distance(lat, long, radius_km, candidates):
+        """`candidates` within `radius_km`, as (distance, branch) pairs sorted by distance."""
+        # Exact distances for the prefiltered rows only
+        nearest = [
+            (haversine_km(lat, long, branch.location_lat, branch.location_long), branch)
+            for branch in candidates
+        ]
+        nearest = [pair for pair in nearest if pair[0] <= radius_km]
+        nearest.sort(key=lambda pair: (pair[0], pair[1].id))
+        return nearest
+
+    def branches_within(self, lat, long, radius_km):
+        """Branches within `radius_km`, as (distance, branch) pairs sorted by distance."""
+        return self.by_distance(lat, long, radius_km, self.candidates(lat, long, radius_km))
 
 
 ## Authors
@@ -102,42 +213,48 @@ class AuthorSerializer(serializers.ModelSerializer):
 
 
 class AuthorListSerializer(serializers.ModelSerializer):
-    book_count = serializers.SerializerMethodField()
+    book_count = serializers.IntegerField(read_only=True)  # annotated by the view
     
     class Meta:
         model = Author
         fields = ['name', 'book_count']
-
-    def get_book_count(self, obj):
-        # Return the count of books written by the author
-        return obj.books.count()
     
+def filter_authors(params):
+    # Get filters for library and book category
+    library_filter = params.get('library')
+    category_filter = params.get('category')
+
+    authors = Author.objects.annotate(book_count=Count('books'))
+
+    if library_filter:
+        # Filter by library: authors whose books are in the given library
+        books_in_library = Book.objects.filter(bookstock__library_branch__library__name=library_filter)
+        authors = authors.filter(id__in=books_in_library.values('authors'))
+
+    if category_filter:
+        # Filter by book category: authors whose books are in the given category
+        books_in_category = Book.objects.filter(category=category_filter)
+        authors = authors.filter(id__in=books_in_category.values('authors'))
+
+    return authors
+
+
 # View for Authors
 class AuthorListView(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = CatalogCursorPagination
+    ordering = 'name'
 
+    @cached_catalog_view(Author, Book, BookStock, LibraryBranch, Library)
     def get(self, request, *args, **kwargs):
-        # Get filters for library and book category
-        library_filter = request.GET.get('library')
-        category_filter = request.GET.get('category')
-
-        authors = Author.objects.all()
-
-        if library_filter:
-            # Filter by library: authors whose books are in the given library
-            authors = authors.filter(
-                book__bookstock__library_branch__library__name=library_filter
-            ).distinct()
-
-        if category_filter:
-            # Filter by book category: authors whose books are in the given category
-            books_in_category = Book.objects.filter(category=category_filter)
-            authors = authors.filter(book__in=books_in_category)
+        authors = filter_authors(request.GET)
 
         # Serialize the authors with book count
-        serializer = AuthorListSerializer(authors, many=True)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(authors, request, view=self)
+        serializer = AuthorListSerializer(page, many=True)
 
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
 
 
 ## Books
@@ -153,42 +270,111 @@ class BookSerializer(serializers.ModelSerializer):
         model = Book
         fields = ['ISBN', 'name', 'category', 'authors']
 
-# View for books endpoint
-class BookListView(APIView):
-    permission_classes = [IsAuthenticated]
+def filter_books(params, author=None):
+    # Get filters for category and library; the view looks up the author
+    category_filter = params.get('category')
+    library_filter = params.get('library')
 
-    def get(self, request, *args, **kwargs):
-        # Get filters for category, library, and author
-        category_filter = request.GET.get('category')
-        library_filter = request.GET.get('library')
-        author_filter = request.GET.get('author')
+    books = Book.objects.prefetch_related('authors')
 
-        books = Book.objects.all()
+    if category_filter:
+        # Filter by book category
+        books = books.filter(category=category_filter)
 
-        if category_filter:
-            # Filter by book category
-            books = books.filter(category=category_filter)
+    if library_filter:
+        # Filter by library: books available in a specific library
+        stock = BookStock.objects.filter(library_branch__library__name=library_filter)
+        books = books.filter(id__in=stock.values('book_id'))
 
-        if library_filter:
-            # Filter by library: books available in a specific library
-            try:
-                books = books.filter(bookstock__library_branch__library__name=library_filter)
-            except LibraryBranch.DoesNotExist:
-                return Response({"error": "Library branch not found"}, status=404)
+    if author is not None:
+        books = books.filter(authors=author)
+
+    return books
+
+
+# View for books endpoint
+class BookListView(APIView):
+    permission_classes = [IsAuthenticated]
+    pagination_class = CatalogCursorPagination
+    ordering = 'ISBN'
 
-        if author_filter:
+    @cached_catalog_view(Book, Author, BookStock, LibraryBranch, Library)
+    def get(self, request, *args, **kwargs):
+        author = None
+        if request.GET.get('author'):
             # Filter by author: books written by a specific author
             try:
-                author = Author.objects.get(name=author_filter)
-                books = books.filter(authors=author)
+                author = Author.objects.get(name=request.GET['author'])
             except Author.DoesNotExist:
                 return Response({"error": "Author not found"}, status=404)
+        books = filter_books(request.GET, author)
+
+        if wants_stream(request):
+            # Every matching book, written out as it is serialized
+            return stream_json_array(books.order_by(self.ordering), BookSerializer)
 
         # Serialize the books with their authors' names
-        serializer = BookSerializer(books, many=True)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(books, request, view=self)
+        serializer = BookSerializer(page, many=True)
+
+        return paginator.get_paginated_response(serializer.data)
+
+
+# View for full-text book search
+class BookSearchView(APIView):
+    permission_classes = [IsAuthenticated]
+    default_limit = 20
+    max_limit = 100
+
+    @cached_catalog_view(Book, Author)
+    def get(self, request, *args, **kwargs):
+        try:
+            query, limit = self.parse_query(request)
+        except ValueError as exc:
+            return Response({"error": str(exc)}, status=400)
+
+        # Ranked ids from the search index, then the books themselves in that order
+        book_ids = search.search_books(query, limit=max(limit, 1))
+        books = Book.objects.prefetch_related('authors').in_bulk(book_ids)
+        serializer = BookSerializer([books[book_id] for book_id in book_ids if book_id in books], many=True)
 
         return Response(serializer.data)
 
+    def parse_query(self, request):
+        query = request.GET.get('q', '').strip()
+        if not query:
+            raise ValueError("q is required")
+        try:
+            limit = min(int(request.GET.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            raise ValueError("limit must be a number")
+        return query, limit
+
+
+class RelatedBookView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @staticmethod
+    def related_rows(isbn):
+        # Precomputed by the update_related_books task (librarySystem.recommendations);
+        # one lookup on the (book, position) index
+        return (
+            RelatedBook.objects.filter(book__ISBN=isbn)
+            .order_by('position')
+            .values('related__ISBN', 'related__name', 'related__category', 'score')
+        )
+
+    @staticmethod
+    def result(row):
+        return {'ISBN': row['related__ISBN'], 'name': row['related__name'], 'category': row['related__category'], 'score': row['score']}
+
+    def get(self, request, isbn):
+        results = [self.result(row) for row in self.related_rows(isbn)]
+        if not results and not Book.objects.filter(ISBN=isbn).exists():
+            return Response({"error": "Book not found."}, status=404)
+        return Response(results)
+
 
 ## Loaded Authors Endpoint
 class AuthorWithBooksSerializer(serializers.ModelSerializer):
@@ -198,33 +384,47 @@ class AuthorWithBooksSerializer(serializers.ModelSerializer):
         model = Author
         fields = ['name', 'books']
 
+def filter_loaded_authors(params):
+    # Get filters for category and library
+    category_filter = params.get('category')
+    library_filter = params.get('library')
+
+    authors = Author.objects.prefetch_related(
+        Prefetch('books', queryset=Book.objects.prefetch_related('authors'))
+    )
+
+    if category_filter:
+        # Filter by book category: authors who have books in the specified category
+        books_in_category = Book.objects.filter(category=category_filter)
+        authors = authors.filter(id__in=books_in_category.values('authors'))
+
+    if library_filter:
+        # Filter by library: authors who have books available in a specific library
+        books_in_library = Book.objects.filter(bookstock__library_branch__library__name=library_filter)
+        authors = authors.filter(id__in=books_in_library.values('authors'))
+
+    return authors
+
+
 class LoadedAuthorListView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_cost = 5
+    pagination_class = CatalogCursorPagination
+    ordering = 'name'
 
+    @cached_catalog_view(Author, Book, BookStock, LibraryBranch, Library)
     def get(self, request, *args, **kwargs):
-        # Get filters for category and library
-        category_filter = request.GET.get('category')
-        library_filter = request.GET.get('library')
+        authors = filter_loaded_authors(request.GET)
 
-        authors = Author.objects.all()
-
-        if category_filter:
-            # Filter by book category: authors who have books in the specified category
-            books_in_category = Book.objects.filter(category=category_filter)
-            authors = authors.filter(book__in=books_in_category)
-
-        if library_filter:
-            # Filter by library: authors who have books available in a specific library
-            try:
-                authors = authors.filter(
-                    book__bookstock__library_branch__library__name=library_filter
-                ).distinct()
-            except LibraryBranch.DoesNotExist:
-                return Response({"error": "Library branch not found"}, status=404)            
+        if wants_stream(request):
+            # Every matching author, written out as it is serialized
+            return stream_json_array(authors.order_by(self.ordering), AuthorWithBooksSerializer, chunk_size=200)
 
         # Serialize the authors with their books and associated libraries
-        serializer = AuthorWithBooksSerializer(authors, many=True)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(authors, request, view=self)
+        serializer = AuthorWithBooksSerializer(page, many=True)
 
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
 
 
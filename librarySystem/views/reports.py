@@ -0,0 +1,89 @@
+from datetime import date, timedelta
+
+from django.http import StreamingHttpResponse
+from django.utils.timezone import now
+from rest_framework import serializers
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework import status
+
+from ..export import CONTENT_TYPES, EXPORTS, export_lines
+from ..models import Author, CirculationStat, Library, User
+from .base import KeysetCursorPagination
+
+
+class ExportView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, entity):
+        if entity not in EXPORTS:
+            return Response({"error": f"Unknown export. Choose one of: {', '.join(sorted(EXPORTS))}."}, status=status.HTTP_404_NOT_FOUND)
+        # not ?format=, which DRF reserves for renderer selection
+        output = request.GET.get('output', 'ndjson')
+        if output not in CONTENT_TYPES:
+            return Response({"error": "output must be ndjson or csv."}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(export_lines(entity, output), content_type=CONTENT_TYPES[output])
+        response['Content-Disposition'] = f'attachment; filename="{entity}.{output}"'
+        return response
+
+
+class PenaltyTotalSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'email', 'penalty_total']
+
+
+class PenaltyTotalsView(APIView):
+    """Users who have incurred penalties, largest lifetime total first."""
+    permission_classes = [IsAdminUser]
+    pagination_class = KeysetCursorPagination
+    # many users share the same total, so pages are keyed on the total and the id together;
+    # both are columns of the partial user_penalty_total_idx index
+    ordering = ('-penalty_total', 'id')
+
+    def get(self, request):
+        users = User.objects.filter(penalty_total__gt=0).only('id', 'username', 'email', 'penalty_total')
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(users, request, view=self)
+        return paginator.get_paginated_response(PenaltyTotalSerializer(page, many=True).data)
+
+
+class CirculationStatsView(APIView):
+    """
+    Daily borrow and return counts per category, library or author over
+    ?from=&to= (ISO dates, the last 30 days by default). Reads only the
+    CirculationStat rollups, so the cost follows the number of buckets,
+    not the borrow history.
+    """
+    permission_classes = [IsAdminUser]
+    default_days = 30
+    max_days = 366
+    labels = {'library': Library, 'author': Author}
+
+    def get(self, request, dimension):
+        if dimension not in CirculationStat.DIMENSIONS:
+            return Response({"error": f"Unknown dimension. Choose one of: {', '.join(CirculationStat.DIMENSIONS)}."}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            end = date.fromisoformat(request.GET['to']) if 'to' in request.GET else now().date()
+            start = date.fromisoformat(request.GET['from']) if 'from' in request.GET else end - timedelta(days=self.default_days - 1)
+        except ValueError:
+            return Response({"error": "from and to must be dates (YYYY-MM-DD)."}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 <= (end - start).days < self.max_days:
+            return Response({"error": f"from must be before to, at most {self.max_days} days apart."}, status=status.HTTP_400_BAD_REQUEST)
+
+        rows = CirculationStat.objects.filter(dimension=dimension, day__range=(start, end))
+        if 'key' in request.GET:
+            rows = rows.filter(key=request.GET['key'])
+        rows = list(rows.order_by('day', 'key').values('day', 'key', 'borrows', 'returns'))
+
+        # library and author buckets are keyed by id; add the current names
+        model = self.labels.get(dimension)
+        if model is not None:
+            names = model.objects.filter(id__in={int(row['key']) for row in rows}).values_list('id', 'name')
+            names = {str(pk): name for pk, name in names}
+        for row in rows:
+            row['label'] = row['key'] if model is None else names.get(row['key'])
+
+        return Response({'dimension': dimension, 'from': start, 'to': end, 'results': rows})
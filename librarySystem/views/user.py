@@ -6,6 +6,7 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate, get_user_model
 from django.contrib.auth.password_validation import validate_password
 from ..models import User
+from ..throttling import LoginTokenBucketThrottle
 
 
 # User = get_user_model()
@@ -31,6 +32,8 @@ class UserRegisterSerializer(serializers.ModelSerializer):
 
 # View for registering a new user
 class UserRegisterView(APIView):
+    throttle_cost = 10  # hashes the password
+
     def post(self, request, *args, **kwargs):
         serializer = UserRegisterSerializer(data=request.data)
         if serializer.is_valid():
@@ -46,6 +49,10 @@ class UserRegisterView(APIView):
     
 
 class UserLoginView(APIView):
+    # authenticate() runs PBKDF2; the buckets are checked before it is called
+    throttle_cost = 10
+    throttle_classes = [LoginTokenBucketThrottle]
+
     def post(self, request, *args, **kwargs):
         username = request.data.get("username")
         password = request.data.get("password")
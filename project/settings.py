@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from celery.schedules import crontab
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -45,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'librarySystem.middleware.QueryInstrumentationMiddleware',  # outermost, so it sees every query
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -86,6 +90,26 @@ DATABASES = {
 }
 
 
+# Cache
+# Shared Redis cache when REDIS_CACHE_URL is set, per-process memory otherwise
+if os.environ.get('REDIS_CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_CACHE_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+CATALOG_CACHE_TIMEOUT = 300  # seconds; entries are also invalidated on every catalog write
+AUTH_USER_CACHE_TIMEOUT = 60  # seconds an authenticated user snapshot is reused; dropped on every user save
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 AUTH_USER_MODEL = 'librarySystem.User'
@@ -136,9 +160,28 @@ REST_FRAMEWORK = {
         'rest_framework.parsers.JSONParser',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # simplejwt's JWTAuthentication with the user served from a cached snapshot
+        'librarySystem.authentication.CachedJWTAuthentication',
     ],
-
+    # catalog listings paginate with librarySystem.views.base.CatalogCursorPagination
+    'DEFAULT_PAGINATION_CLASS': 'librarySystem.views.base.CatalogCursorPagination',
+    'PAGE_SIZE': 50,
+    # token buckets in the shared cache; views weigh requests with `throttle_cost`
+    # (see librarySystem/throttling.py)
+    # one class for all the buckets: DRF asks every throttle class even after one refuses
+    'DEFAULT_THROTTLE_CLASSES': [
+        'librarySystem.throttling.TokenBucketThrottle',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'bucket-ip': os.environ.get('THROTTLE_IP_RATE', '600/min'),
+        'bucket-user': os.environ.get('THROTTLE_USER_RATE', '1200/min'),
+        'bucket-global': os.environ.get('THROTTLE_GLOBAL_RATE', '20000/min'),
+        # per submitted username on login, which costs 10: 20 attempts an hour
+        'bucket-login': os.environ.get('THROTTLE_LOGIN_RATE', '200/hour'),
+    },
+    # trusted reverse proxies in front of the app; with 0, X-Forwarded-For is ignored and
+    # throttles key on REMOTE_ADDR (DRF's default, None, trusts the whole header)
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 0)),
 }
 
 # For the emails
@@ -153,4 +196,47 @@ DEFAULT_FROM_EMAIL = 'webmaster@localhost'
 
 # Celery
 CELERY_BROKER_URL = 'redis://redis:6379/0'  # Adjust if using a different broker
-CELERY_RESULT_BACKEND = 'redis://redis:6379/0'  # For storing task results
\ No newline at end of file
+CELERY_RESULT_BACKEND = 'redis://redis:6379/0'  # For storing task results
+CELERY_BEAT_SCHEDULE = {
+    # deliver queued emails (librarySystem.outbox) in batches
+    'drain-email-outbox': {
+        'task': 'librarySystem.tasks.drain_email_outbox',
+        'schedule': 10.0,
+    },
+    # queue return reminders for borrows due in the next few days
+    'send-due-reminders': {
+        'task': 'librarySystem.tasks.send_due_reminders',
+        'schedule': crontab(hour=8, minute=0),
+    },
+    # recompute the penalty ledger for overdue borrows (librarySystem.penalties)
+    'accrue-penalties': {
+        'task': 'librarySystem.tasks.accrue_penalties',
+        'schedule': crontab(hour=1, minute=0),
+    },
+    # incremental "also borrowed" recommendations (librarySystem.recommendations)
+    'update-related-books': {
+        'task': 'librarySystem.tasks.update_related_books',
+        'schedule': crontab(minute=30),
+    },
+}
+
+# Per-request query instrumentation (librarySystem.middleware)
+QUERY_LOG_SLOWEST = 3  # statements kept per request
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'librarySystem.queries': {
+            'handlers': ['console'],
+            # one INFO record per request; set QUERY_LOG_LEVEL=INFO to see them
+            'level': os.environ.get('QUERY_LOG_LEVEL', 'WARNING'),
+            'propagate': False,
+        },
+    },
+}